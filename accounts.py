@@ -0,0 +1,379 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from client_pool import ClientPool
+
+log = logging.getLogger(__name__)
+
+METERED_MODES = ('pro', 'reasoning', 'deep research')
+
+RATE_LIMIT_STATUSES = (403, 429)
+RATE_LIMIT_MARKERS = ('too many requests', 'rate limit')
+QUOTA_EXHAUSTED_MARKERS = ('used all of your enhanced',)
+
+# Seconds between reads of the other worker processes' account state.
+SHARED_POLL_INTERVAL = 0.05
+
+
+class AccountUnavailableError(Exception):
+    """Raised when no account can serve a request (cooldown, quota or timeout)."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EmptyUpstreamResponseError(Exception):
+    """
+    Raised when a search returned nothing at all.
+
+    perplexity_async does not check HTTP status codes: a rate-limited or
+    refused session just yields no messages, so search() returns None or
+    an empty stream. The pool treats this like a 429.
+    """
+
+
+def http_status(error):
+    """The HTTP status code an exception carries (on itself, its response or its arguments), or None."""
+    candidates = [error, getattr(error, 'response', None), *getattr(error, 'args', ())]
+    for candidate in candidates:
+        status = getattr(candidate, 'status_code', None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_rate_limited(error):
+    """True if `error` means Perplexity refused the account's request (429/403 or no response)."""
+    if isinstance(error, EmptyUpstreamResponseError) or http_status(error) in RATE_LIMIT_STATUSES:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in RATE_LIMIT_MARKERS)
+
+
+def parse_quota_spec(spec):
+    """
+    Parses a quota specification such as 'pro=300,reasoning=50,deep-research=5'.
+
+    Returns:
+        A dictionary mapping Perplexity modes to request limits per quota window.
+    """
+    quotas = {}
+    if not spec:
+        return quotas
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        mode, _, limit = item.partition('=')
+        mode = mode.strip().replace('-', ' ')
+        if mode not in METERED_MODES:
+            raise ValueError(f"Unknown quota mode '{mode}' (expected one of {METERED_MODES})")
+        quotas[mode] = int(limit)
+    return quotas
+
+
+class Account:
+    """One Perplexity account: its client pool, load and quota bookkeeping."""
+
+    def __init__(self, name, cookies, max_concurrency, quotas, quota_window, **pool_kwargs):
+        self.name = name
+        self.client_pool = ClientPool(cookies, **pool_kwargs)
+        self.max_concurrency = max_concurrency
+        self.quotas = quotas
+        self.quota_window = quota_window
+        self.in_flight = 0
+        # Requests other worker processes are running on this account (multi-worker mode).
+        self.remote_in_flight = 0
+        self.usage = {mode: deque() for mode in METERED_MODES}
+        self.cooldown_until = 0.0
+        self.mode_blocked_until = {}
+        self.strikes = 0
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def _trim_usage(self, mode, now):
+        usage = self.usage[mode]
+        while usage and now - usage[0] > self.quota_window:
+            usage.popleft()
+
+    def quota_left(self, mode, now):
+        """Remaining requests for a metered mode in the current window (None = unlimited)."""
+        if mode not in METERED_MODES:
+            return None
+        if self.mode_blocked_until.get(mode, 0) > now:
+            return 0
+        limit = self.quotas.get(mode)
+        if limit is None:
+            return None
+        self._trim_usage(mode, now)
+        return max(0, limit - len(self.usage[mode]))
+
+    def can_serve(self, mode, now):
+        if self.cooldown_until > now:
+            return False
+        if self.max_concurrency and self.in_flight + self.remote_in_flight >= self.max_concurrency:
+            return False
+        left = self.quota_left(mode, now)
+        return left is None or left > 0
+
+    def load(self):
+        in_flight = self.in_flight + self.remote_in_flight
+        if self.max_concurrency:
+            return in_flight / self.max_concurrency
+        return float(in_flight)
+
+    def status(self):
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight,
+            "remote_in_flight": self.remote_in_flight,
+            "max_concurrency": self.max_concurrency,
+            "cooling_down_for": max(0.0, round(self.cooldown_until - now, 1)),
+            "quota_left": {mode: self.quota_left(mode, now) for mode in METERED_MODES},
+            "requests": self.total_requests,
+            "failures": self.total_failures,
+            "client_pool": self.client_pool.status(),
+        }
+
+
+class AccountPool:
+    """
+    Spreads requests across several Perplexity accounts.
+
+    Each request for a given mode goes to the least-loaded account that is not
+    cooling down, is below its concurrency cap and still has quota for that
+    mode. Rate-limit style failures (429/403, or a search that returned
+    nothing) put the account on an exponentially growing cooldown; running out of enhanced queries blocks
+    the mode on that account for the rest of the quota window.
+
+    With a SharedState the pool also sees the other worker processes' load,
+    cooldowns and quota use, so limits hold across the whole gateway. One
+    poller task per process reads them every SHARED_POLL_INTERVAL seconds
+    on the database thread, keeps a snapshot and wakes waiting requests when
+    it changes. This process's own changes are deferred writes; requests
+    themselves never wait on the database.
+    """
+
+    def __init__(self, accounts, acquire_timeout=30, cooldown=60, max_cooldown=900, shared=None):
+        """
+        Args:
+            accounts: List of Account objects (at least one).
+            acquire_timeout: Seconds to wait for a free account before giving up.
+            cooldown: Base cooldown in seconds after a rate-limit failure.
+            max_cooldown: Upper bound for the exponential cooldown.
+            shared: Optional SharedState of a multi-worker gateway.
+        """
+        if not accounts:
+            raise ValueError("AccountPool needs at least one account")
+        self.accounts = accounts
+        self.acquire_timeout = acquire_timeout
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.shared = shared
+        self._changed = None
+        self._poller = None
+        self._snapshot = None
+        # Bumped whenever this process publishes; a read that overlaps a publish is stale.
+        self._published = 0
+
+    @classmethod
+    def from_cookies(cls, named_cookies, max_concurrency=4, quotas=None, quota_window=86400,
+                     acquire_timeout=30, cooldown=60, shared=None, **pool_kwargs):
+        """Builds a pool from a list of (name, cookies_dict_or_None) pairs."""
+        accounts = [
+            Account(name, cookies, max_concurrency, quotas or {}, quota_window, **pool_kwargs)
+            for name, cookies in named_cookies
+        ]
+        return cls(accounts, acquire_timeout=acquire_timeout, cooldown=cooldown, shared=shared)
+
+    @property
+    def _condition(self):
+        # Created lazily so it binds to the serving event loop.
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    async def start(self):
+        await asyncio.gather(*(account.client_pool.start() for account in self.accounts))
+        if self.shared is not None and self._poller is None:
+            self._apply(await self.shared.read(self._read_shared))
+            self._poller = asyncio.create_task(self._poll())
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+        await asyncio.gather(*(account.client_pool.close() for account in self.accounts))
+
+    def _read_shared(self):
+        """The other workers' in-flight counts, cooldowns and quota use (runs on the database thread)."""
+        since = time.monotonic() - max(account.quota_window for account in self.accounts)
+        usage = {mode: self.shared.usage(mode, since) for mode in METERED_MODES
+                 if any(mode in account.quotas for account in self.accounts)}
+        return self.shared.other_counters('account:'), self.shared.account_health(), usage
+
+    def _apply(self, snapshot):
+        """Adopts a snapshot from _read_shared(); returns False if nothing changed."""
+        if snapshot == self._snapshot:
+            return False
+        self._snapshot = snapshot
+        remote, health, usage = snapshot
+        for account in self.accounts:
+            account.remote_in_flight = remote.get(f"account:{account.name}", 0)
+            if account.name in health:
+                account.cooldown_until, account.strikes, account.mode_blocked_until = health[account.name]
+            for mode, timestamps in usage.items():
+                account.usage[mode] = deque(timestamps.get(account.name, ()))
+        return True
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            published = self._published
+            try:
+                snapshot = await self.shared.read(self._read_shared)
+            except Exception as e:
+                log.warning("Could not read shared account state", extra={"error": str(e)})
+                continue
+            if published != self._published:
+                # This process published while the read ran; the next read includes it.
+                continue
+            if self._apply(snapshot):
+                async with self._condition:
+                    self._condition.notify_all()
+
+    def _publish(self, account, health=False):
+        self._published += 1
+        self.shared.defer(self.shared.set_counter, f"account:{account.name}", account.in_flight)
+        if health:
+            self.shared.defer(self.shared.set_account_health, account.name, account.cooldown_until,
+                              account.strikes, dict(account.mode_blocked_until))
+
+    def _ranked(self, mode, account_name=None):
+        now = time.monotonic()
+        candidates = [a for a in self.accounts
+                      if (account_name is None or a.name == account_name) and a.can_serve(mode, now)]
+        return sorted(candidates, key=lambda a: (a.load(), len(a.usage.get(mode, ())), a.total_requests))
+
+    def _pick(self, mode, account_name=None):
+        candidates = self._ranked(mode, account_name)
+        return candidates[0] if candidates else None
+
+    def candidates(self, mode):
+        """Names of the accounts that could take a `mode` request right now, best first."""
+        return [account.name for account in self._ranked(mode)]
+
+    def _retry_after(self, mode):
+        """Seconds until some account could take this mode again, or None if only busy."""
+        now = time.monotonic()
+        waits = []
+        for account in self.accounts:
+            wait = max(0.0, account.cooldown_until - now)
+            if account.quota_left(mode, now) == 0:
+                blocked = account.mode_blocked_until.get(mode, 0) - now
+                usage = account.usage.get(mode)
+                expires = account.quota_window - (now - usage[0]) if usage else 0
+                wait = max(wait, blocked, expires)
+            waits.append(wait)
+        return min(waits) if waits else None
+
+    def available(self, account_name, mode):
+        """True if the named account is neither cooling down nor out of quota for `mode` (it may be busy)."""
+        now = time.monotonic()
+        for account in self.accounts:
+            if account.name == account_name:
+                return account.cooldown_until <= now and account.quota_left(mode, now) != 0
+        return False
+
+    async def acquire(self, mode, account_name=None):
+        """
+        Reserves a slot on an account for `mode`, waiting up to acquire_timeout.
+
+        With `account_name` only that account is considered (e.g. to continue
+        an upstream thread that lives on it).
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+        async with self._condition:
+            while True:
+                account = self._pick(mode, account_name)
+                if account is not None:
+                    now = time.monotonic()
+                    account.in_flight += 1
+                    account.total_requests += 1
+                    # Usage only matters against a quota; without one it is not kept at all.
+                    metered = mode in account.quotas
+                    if metered:
+                        account.usage[mode].append(now)
+                        account._trim_usage(mode, now)
+                    if self.shared is not None:
+                        self._publish(account)
+                        if metered:
+                            self.shared.defer(self.shared.record_usage, account.name, mode, now)
+                    return account
+                remaining = deadline - time.monotonic()
+                retry_after = self._retry_after(mode)
+                if remaining <= 0 or (retry_after is not None and retry_after > remaining):
+                    raise AccountUnavailableError(
+                        f"No Perplexity account available for mode '{mode}' "
+                        f"(retry in ~{int(retry_after or 0)}s)", max(1, math.ceil(retry_after or 1)))
+                # Other workers' releases arrive through _poll(), which notifies as well.
+                timeout = min(remaining, retry_after or remaining)
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, account, mode, error=None):
+        now = time.monotonic()
+        account.in_flight -= 1
+        health_changed = account.strikes > 0
+        if error is None:
+            account.strikes = 0
+        else:
+            account.total_failures += 1
+            message = str(error).lower()
+            if any(marker in message for marker in QUOTA_EXHAUSTED_MARKERS):
+                account.mode_blocked_until[mode] = now + account.quota_window
+                log.warning("Account ran out of enhanced queries; blocking mode",
+                            extra={"account": account.name, "mode": mode})
+            elif is_rate_limited(error):
+                account.strikes += 1
+                cooldown = min(self.cooldown * 2 ** (account.strikes - 1), self.max_cooldown)
+                account.cooldown_until = now + cooldown
+                log.warning("Account rate limited; cooling down",
+                            extra={"account": account.name, "cooldown_s": round(cooldown)})
+            health_changed = True
+        if self.shared is not None:
+            self._publish(account, health=health_changed)
+        async with self._condition:
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def lease(self, mode, account_name=None):
+        """Checks out a pooled client from the best account for `mode`; yields (account, client)."""
+        account = await self.acquire(mode, account_name)
+        error = None
+        try:
+            async with account.client_pool.client() as perplexity_cli:
+                yield account, perplexity_cli
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            await self.release(account, mode, error)
+
+    @asynccontextmanager
+    async def client(self, mode):
+        """Checks out a pooled client from the best account for `mode`."""
+        async with self.lease(mode) as (account, perplexity_cli):
+            yield perplexity_cli
+
+    def status(self):
+        return [account.status() for account in self.accounts]
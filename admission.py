@@ -0,0 +1,338 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+
+log = logging.getLogger(__name__)
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request is turned away by admission control (HTTP 429)."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_mode_limits(spec, modes):
+    """
+    Parses per-mode concurrency limits such as 'pro=8,reasoning=4,deep-research=2'.
+
+    Dashes in mode names stand for spaces.
+
+    Returns:
+        A dictionary mapping modes to their concurrency limit.
+    """
+    limits = {}
+    if not spec:
+        return limits
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        mode, _, limit = item.partition('=')
+        mode = mode.strip().replace('-', ' ')
+        if mode not in modes:
+            raise ValueError(f"Unknown mode '{mode}' (expected one of {tuple(modes)})")
+        limits[mode] = int(limit)
+    return limits
+
+
+def parse_key_priorities(spec):
+    """
+    Parses API key classes such as 'key-a=10,key-b=-5:120'.
+
+    Each entry is `key=priority`, optionally followed by `:seconds`, the
+    longest time that key's requests wait in the queue.
+
+    Returns:
+        A dictionary mapping API keys to (priority, queue_timeout or None).
+    """
+    priorities = {}
+    if not spec:
+        return priorities
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, value = item.rpartition('=')
+        priority, _, timeout = value.partition(':')
+        priorities[key.strip()] = (int(priority), float(timeout) if timeout else None)
+    return priorities
+
+
+class _Waiter:
+    __slots__ = ('sort_key', 'mode', 'priority', 'future', 'enqueued_at')
+
+    def __init__(self, sort_key, mode, priority, future):
+        self.sort_key = sort_key
+        self.mode = mode
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+
+class AdmissionController:
+    """
+    Limits how many upstream searches run at once.
+
+    A request needs a free slot both globally and for its mode. When none is
+    free it joins a bounded wait queue ordered by priority (then arrival);
+    released slots go to the first queued request whose mode has room. A
+    request is rejected straight away when the queue is full (unless it
+    outranks the lowest-priority waiter, which is rejected instead) and when
+    its queue deadline passes. Rejections carry a Retry-After estimate based
+    on recent slot hold times.
+
+    With a SharedState the limits cover all worker processes. A poller task
+    started by start() reads the other workers' running slots every
+    poll_interval seconds on the database thread. A request that fits that
+    snapshot claims its slot with one check-and-set transaction on the
+    database thread, so two workers cannot take the same free slot, and
+    released slots are handed to queued requests the same way. The event
+    loop never waits on the database; releases are deferred writes.
+    """
+
+    def __init__(self, max_concurrency=0, mode_limits=None, max_queue=100, queue_timeout=30, shared=None,
+                 poll_interval=0.05):
+        """
+        Args:
+            max_concurrency: Upstream searches allowed at once (0 for unlimited).
+            mode_limits: Optional per-mode limits, e.g. {'deep research': 2}.
+            max_queue: Requests allowed to wait for a slot (0 rejects as soon as all slots are busy).
+            queue_timeout: Default seconds a request waits in the queue before a 429.
+            shared: Optional SharedState of a multi-worker gateway.
+            poll_interval: Seconds between reads of the slots other workers hold.
+        """
+        self.max_concurrency = max_concurrency
+        self.mode_limits = mode_limits or {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._running = 0
+        self._running_by_mode = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._hold_time = {}
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self._remote = {}
+        self._poller = None
+        self._released = None
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0,
+                      "rejected_timeout": 0, "wait_seconds_total": 0.0}
+
+    def _has_room(self, mode):
+        if self.max_concurrency and self._running + self._remote.get('admission:', 0) >= self.max_concurrency:
+            return False
+        limit = self.mode_limits.get(mode)
+        return not limit or self._running_by_mode.get(mode, 0) + self._remote.get(f'admission:{mode}', 0) < limit
+
+    @property
+    def _wakeup(self):
+        # Created lazily so it binds to the serving event loop.
+        if self._released is None:
+            self._released = asyncio.Event()
+        return self._released
+
+    async def start(self):
+        if self.shared is not None and self._poller is None:
+            self._remote = await self.shared.read(self.shared.other_counters, 'admission:')
+            self._poller = asyncio.create_task(self._poll())
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+    def _publish(self, mode):
+        if self.shared is not None:
+            self.shared.defer(self.shared.set_counter, 'admission:', self._running)
+            self.shared.defer(self.shared.set_counter, f'admission:{mode}', self._running_by_mode[mode])
+
+    def _take(self, mode, publish=True):
+        self._running += 1
+        self._running_by_mode[mode] = self._running_by_mode.get(mode, 0) + 1
+        self.stats["admitted"] += 1
+        if publish:
+            self._publish(mode)
+
+    def _give_back(self, mode):
+        """Undoes _take() for a slot that was never used."""
+        self._running -= 1
+        self._running_by_mode[mode] -= 1
+        self.stats["admitted"] -= 1
+        self._publish(mode)
+
+    async def _claim(self, mode):
+        """Takes a slot for `mode` if the shared counters still have room; returns False otherwise."""
+        self._take(mode, publish=False)
+        counts = {'admission:': self._running, f'admission:{mode}': self._running_by_mode[mode]}
+        limits = {'admission:': self.max_concurrency, f'admission:{mode}': self.mode_limits.get(mode, 0)}
+        try:
+            others = await self.shared.read(self.shared.claim_counters, counts, limits)
+        except BaseException:
+            self._give_back(mode)
+            raise
+        if others is None:
+            return True
+        self._give_back(mode)
+        self._remote.update(others)
+        return False
+
+    def _dispatch(self):
+        if self.shared is not None:
+            # Slots are claimed on the database thread; the poller does it.
+            self._wakeup.set()
+            return
+        for waiter in list(self._queue):
+            if not self._has_room(None):
+                return
+            if waiter.future.done() or not self._has_room(waiter.mode):
+                continue
+            self._queue.remove(waiter)
+            self._take(waiter.mode)
+            waiter.future.set_result(None)
+
+    async def _dispatch_shared(self):
+        for waiter in list(self._queue):
+            if not self._has_room(None):
+                return
+            if waiter.future.done() or not self._has_room(waiter.mode):
+                continue
+            if not await self._claim(waiter.mode):
+                continue
+            if waiter not in self._queue or waiter.future.done():
+                # Timed out or cancelled while the claim ran.
+                self._give_back(waiter.mode)
+                continue
+            self._queue.remove(waiter)
+            waiter.future.set_result(None)
+
+    def retry_after(self, mode):
+        """Rough seconds until a queued request for `mode` would get a slot."""
+        hold = self._hold_time.get(mode) or (max(self._hold_time.values()) if self._hold_time else 1.0)
+        slots = self.mode_limits.get(mode) or self.max_concurrency or 1
+        return max(1, math.ceil(hold * (len(self._queue) + 1) / slots))
+
+    def _reject(self, mode, reason):
+        self.stats[f"rejected_{reason}"] += 1
+        retry_after = self.retry_after(mode)
+        if reason == 'queue_full':
+            message = "Too many requests are waiting for an upstream slot."
+        else:
+            message = "Timed out waiting for an upstream slot."
+        return AdmissionRejectedError(f"{message} Retry in about {retry_after}s.", retry_after)
+
+    async def acquire(self, mode, priority=0, timeout=None):
+        """
+        Waits for a slot for `mode`.
+
+        Args:
+            mode: Perplexity mode of the request.
+            priority: Higher values are served first.
+            timeout: Seconds to wait in the queue (defaults to queue_timeout).
+
+        Returns:
+            The monotonic time the slot was granted (pass it to release()).
+
+        Raises:
+            AdmissionRejectedError: The queue is full or the wait timed out.
+        """
+        # Queued requests are always waiting on a limit of their own mode, so a
+        # request that fits right now does not jump ahead of anyone.
+        if self._has_room(mode):
+            if self.shared is None:
+                self._take(mode)
+                return time.monotonic()
+            if await self._claim(mode):
+                return time.monotonic()
+
+        if len(self._queue) >= self.max_queue:
+            lowest = self._queue[-1] if self._queue else None
+            if lowest is None or lowest.priority >= priority:
+                raise self._reject(mode, 'queue_full')
+            self._queue.pop()
+            lowest.future.set_exception(self._reject(lowest.mode, 'queue_full'))
+
+        waiter = _Waiter((-priority, next(self._sequence)), mode, priority,
+                         asyncio.get_running_loop().create_future())
+        bisect.insort(self._queue, waiter)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future),
+                                   self.queue_timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            if not (waiter.future.done() and waiter.future.exception() is None):
+                self._forget(waiter)
+                raise self._reject(mode, 'timeout')
+            # Granted just as the deadline passed; keep the slot.
+        except asyncio.CancelledError:
+            self._forget(waiter)
+            raise
+        finally:
+            self.stats["wait_seconds_total"] += time.monotonic() - waiter.enqueued_at
+        return time.monotonic()
+
+    async def _poll(self):
+        """Keeps the snapshot of other workers' slots fresh and hands freed slots to queued requests."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                self._remote = await self.shared.read(self.shared.other_counters, 'admission:')
+                if self._queue:
+                    await self._dispatch_shared()
+            except Exception as e:
+                log.warning("Could not read shared admission state", extra={"error": str(e)})
+
+    def _forget(self, waiter):
+        if waiter in self._queue:
+            self._queue.remove(waiter)
+        elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+            # The slot was granted while the waiter was being cancelled: hand it back.
+            self.release(waiter.mode, None)
+
+    def release(self, mode, granted_at):
+        """Frees a slot; `granted_at` (from acquire) feeds the Retry-After estimate."""
+        self._running -= 1
+        self._running_by_mode[mode] -= 1
+        self._publish(mode)
+        if granted_at is not None:
+            held = time.monotonic() - granted_at
+            previous = self._hold_time.get(mode)
+            self._hold_time[mode] = held if previous is None else 0.8 * previous + 0.2 * held
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, mode, priority=0, timeout=None):
+        """Holds a slot for `mode` for the duration of the `async with` block."""
+        granted_at = await self.acquire(mode, priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(mode, granted_at)
+
+    def status(self):
+        queued_by_mode = {}
+        for waiter in self._queue:
+            queued_by_mode[waiter.mode] = queued_by_mode.get(waiter.mode, 0) + 1
+        oldest = min((w.enqueued_at for w in self._queue), default=None)
+        return {
+            "running": self._running,
+            "running_by_mode": dict(self._running_by_mode),
+            "running_elsewhere": self._remote.get('admission:', 0),
+            "queue_depth": len(self._queue),
+            "queued_by_mode": queued_by_mode,
+            "oldest_wait_seconds": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            **self.stats,
+        }
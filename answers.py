@@ -0,0 +1,70 @@
+import jsoncodec
+
+
+def _decode_answer(answer_content_raw, partial=False):
+    """Unwraps the JSON-encoded answer payload Perplexity puts in a step."""
+    if answer_content_raw[:1] != '{' and answer_content_raw.lstrip()[:1] != '{':
+        # Only an object can carry an 'answer' field; plain text is the answer itself.
+        return answer_content_raw
+    try:
+        parsed_answer = jsoncodec.loads(answer_content_raw)
+    except jsoncodec.JSONDecodeError:
+        # Mid-stream the JSON payload is usually incomplete; don't leak it as text.
+        return None if partial else answer_content_raw
+    if isinstance(parsed_answer, dict) and 'answer' in parsed_answer:
+        return parsed_answer['answer']
+    return answer_content_raw
+
+
+def _step_answer(step):
+    content = step.get('content')
+    return content.get('answer') if isinstance(content, dict) else None
+
+
+def extract_answer(resp, partial=False):
+    """
+    Extracts the plain text answer from a Perplexity response (or stream chunk).
+
+    The answer normally sits JSON-encoded in the FINAL step, which is decoded
+    once. Only if that yields nothing are the answers of all steps joined
+    and decoded instead, and a join that would just repeat the FINAL step's
+    text is skipped.
+
+    Args:
+        resp: A response dictionary as returned by perplexity_async search().
+            Its 'text' is either a list of steps or, for some modes, the
+            FINAL step's content as a dict.
+        partial: True for intermediate stream chunks, where undecodable JSON
+            payloads are skipped instead of being returned verbatim.
+
+    Returns:
+        The answer string, or None if no answer could be found.
+    """
+    if not resp:
+        return None
+    steps = resp.get('text')
+    if not steps:
+        return None
+
+    if isinstance(steps, dict):
+        if resp.get('step_type') != 'FINAL':
+            return None
+        answer = steps.get('answer')
+        return answer if answer and isinstance(answer, str) else None
+
+    if not isinstance(steps, list):
+        return None
+    answer = None
+    final_raw = None
+    final_step = steps[-1]
+    if final_step.get('step_type') == 'FINAL':
+        final_raw = _step_answer(final_step)
+        if final_raw:
+            answer = _decode_answer(final_raw, partial)
+            if answer:
+                return answer
+
+    parts = [part for part in map(_step_answer, steps) if part]
+    if not parts or (len(parts) == 1 and parts[0] is final_raw):
+        return answer
+    return _decode_answer(parts[0] if len(parts) == 1 else " ".join(parts), partial)
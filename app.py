@@ -1,15 +1,45 @@
 import asyncio
-import perplexity_async
+import math
 import time
-from flask import Flask, request, jsonify, Response
+from quart import Quart, request, jsonify, Response, g
+from quart.json.provider import DefaultJSONProvider
+from quart.wrappers import Request
 import json
 import os
-from flask_cors import CORS
+from quart_cors import cors
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
 import argparse
+import logging
+import sys
 import ast
-import base64
 import re
 from functools import wraps
+from accounts import AccountPool, AccountUnavailableError, EmptyUpstreamResponseError, parse_quota_spec
+from response_cache import ResponseCache, parse_ttl_spec
+from single_flight import SingleFlight
+from file_store import FileStore, sha256_of_base64
+from uploads import UpstreamUploads
+from backends import BACKEND_NAMES, make_client_factory
+from jobs import JobManager, JobQueueFullError, WebhookURLError
+from conversations import ConversationIndex, ConversationThread
+from batches import BatchManager, BatchValidationError
+from routing import LatencyRouter
+from tokens import TokenCounter, parse_budget_spec
+from resilience import CircuitBreaker, LatencyTracker, hedged, parse_fallback_chains
+from answers import extract_answer
+import jsoncodec
+from shared_state import SharedState
+from workers import Supervisor, bind_socket
+from admission import AdmissionController, AdmissionRejectedError, parse_mode_limits, parse_key_priorities
+from telemetry import (setup_logging, start_request, finish_request, finish_after_stream,
+                       annotate, stage, record_stage, status_collector, render_metrics, slow_requests,
+                       CONTENT_TYPE as METRICS_CONTENT_TYPE, UPSTREAM_IN_FLIGHT, UPLOAD_BYTES, TOKENS,
+                       PROMPT_MESSAGES_DROPPED)
+from ingest import (ByteBudget, UploadBudget, PayloadTooLargeError, make_stream_factory,
+                    base64_decoded_size, decode_base64_chunked)
+
+log = logging.getLogger("pplx_gateway")
 
 PERPLEXITY_MODES_MODELS = {
     'pro': [None, 'sonar', 'gpt-4.5', 'gpt-4o', 'claude 3.7 sonnet', 'gemini 2.0 flash', 'grok-2'],
@@ -18,28 +48,147 @@ PERPLEXITY_MODES_MODELS = {
     'deep research': [None]
 }
 
+# Virtual models routed per request to the quickest concrete model of these modes.
+ROUTING_ALIASES = {
+    'fastest': ('auto', 'pro', 'reasoning'),
+    'fastest-pro': ('pro',),
+}
+
 ALL_MODELS_WITH_PREFIX = []
 MODEL_ID_TO_API_PARAMS_MAP = {}
+ROUTED_MODELS = {}
 DEFAULT_MODEL_ID = None
 DEFAULT_PREFIX = "perplexity-chat/"
 DEFAULT_MODE_FOR_FALLBACK = None
 DEFAULT_MODEL_FOR_FALLBACK = None
 
+SEARCH_SOURCES = []
+SEARCH_LANGUAGE = 'en-US'
+SEARCH_INCOGNITO = False
+
 EXPECTED_API_KEY = os.environ.get("PPLX_OPENAI_KEY", "your-secret-api-key")
+# Extra API keys with their admission priority and queue timeout: {key: (priority, timeout)}.
+API_KEY_PRIORITIES = {}
+
+UPLOAD_SPOOL_THRESHOLD = 1024 * 1024
+MAX_FILE_BYTES = 50 * 1024 * 1024
+MAX_REQUEST_FILE_BYTES = 100 * 1024 * 1024
+upload_bytes_in_flight = ByteBudget(1024 * 1024 * 1024)
+
+perplexity_accounts = []
+# None means perplexity_async.Client; see backends.make_client_factory().
+client_factory = None
+account_pool = None
+response_cache = None
+single_flight = SingleFlight()
+file_store = None
+upstream_uploads = UpstreamUploads()
+admission = AdmissionController(max_concurrency=32, max_queue=256, queue_timeout=30)
+job_manager = JobManager()
+conversation_index = ConversationIndex()
+batch_manager = None
+BATCH_PRIORITY = -10
+circuit_breaker = CircuitBreaker()
+upstream_latency = LatencyTracker()
+FALLBACK_CHAINS = {}
+HEDGE_MODES = set()
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_DELAY = 2.0
+resilience_stats = {"fallbacks": 0, "hedges": 0, "hedge_wins": 0}
+latency_router = LatencyRouter()
+token_counter = TokenCounter()
+PROMPT_BUDGETS = {}
+# Set in multi-worker mode (--workers): state the worker processes share.
+shared_state = None
+SHARED_STATE_FILE = "gateway.sqlite3"
+# Modes whose non-streaming requests always run as background jobs.
+BACKGROUND_MODES = set()
+# Longest a GET /v1/jobs/<id>?wait=... long poll is held open.
+JOB_MAX_WAIT = 60
+# Whether chat completion responses carry a Server-Timing header with their stage breakdown.
+SERVER_TIMING = False
+
+class GatewayRequest(Request):
+    """Request whose multipart uploads spool to disk and respect the per-file limit."""
+
+    def make_form_data_parser(self):
+        return self.form_data_parser_class(
+            max_content_length=self.max_content_length,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            stream_factory=make_stream_factory(UPLOAD_SPOOL_THRESHOLD, MAX_FILE_BYTES),
+            cls=self.parameter_storage_class,
+        )
+
+
+def max_body_bytes(max_request_file_bytes):
+    """Largest accepted request body: base64 overhead on the attachments plus room for text."""
+    return max_request_file_bytes * 4 // 3 + 4 * 1024 * 1024
+
+
+class GatewayJSONProvider(DefaultJSONProvider):
+    """Parses request bodies and renders jsonify() responses with jsoncodec (orjson when installed)."""
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        return jsoncodec.dumps(obj, default=self.default)
+
+    def loads(self, s, **kwargs):
+        return jsoncodec.loads(s)
+
+    def response(self, *args, **kwargs):
+        if self._app.debug:
+            return super().response(*args, **kwargs)
+        # Hand the encoded bytes over directly instead of round-tripping through str.
+        body = jsoncodec.dumps_bytes(self._prepare_response_obj(args, kwargs), default=self.default)
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+app = Quart(__name__)
+app.request_class = GatewayRequest
+app.json = GatewayJSONProvider(app)
+app = cors(app, allow_origin="*")
+# Deep research answers can stream for minutes; don't cut responses off.
+app.config['RESPONSE_TIMEOUT'] = None
+app.config['MAX_CONTENT_LENGTH'] = max_body_bytes(MAX_REQUEST_FILE_BYTES)
+
+def metrics_model_label(model_id):
+    """Model ID as a metrics label; unknown IDs share one label to keep series bounded."""
+    return model_id if model_id in MODEL_ID_TO_API_PARAMS_MAP or model_id in ROUTED_MODELS else "other"
+
+
+def resolve_model(model_id_with_prefix):
+    """
+    Maps a virtual model ID (see ROUTING_ALIASES) to the concrete model that
+    should serve this request; other model IDs are returned unchanged.
+    """
+    candidates = ROUTED_MODELS.get(model_id_with_prefix)
+    if candidates is None:
+        return model_id_with_prefix
+    closed = [model_id for model_id in candidates if not circuit_breaker.is_open(model_id)]
+    return latency_router.choose(closed or candidates)
+
+
+def bearer_token():
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header.split('Bearer ')[1]
+    return None
 
-app = Flask(__name__)
-CORS(app)
 
 def require_api_key(f):
-    """Decorator to ensure an API key is present and valid."""
+    """Decorator to ensure an API key is present and valid (async views)."""
     @wraps(f)
-    def decorated_function(*args, **kwargs):
-        api_key = None
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith('Bearer '):
-            api_key = auth_header.split('Bearer ')[1]
-
-        if not api_key or api_key != EXPECTED_API_KEY:
+    async def decorated_function(*args, **kwargs):
+        started = time.perf_counter()
+        api_key = bearer_token()
+        valid = api_key and (api_key == EXPECTED_API_KEY or api_key in API_KEY_PRIORITIES)
+        # Picked up by chat_completions() as the first stage of its timing trace.
+        g.auth_timing = (started, time.perf_counter() - started)
+        if not valid:
             return jsonify({
                 "error": {
                     "message": "Invalid or missing API key.",
@@ -47,11 +196,39 @@ def require_api_key(f):
                     "code": 401
                 }
             }), 401
-        return f(*args, **kwargs)
+        return await f(*args, **kwargs)
     return decorated_function
 
 
-async def get_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID, files_dict=None):
+async def prepare_attachments(account, perplexity_cli, files_dict, thread=None):
+    """
+    Resolves attachments for one search on `account`.
+
+    Stored files already uploaded through this account are sent as attachment
+    URLs (via search()'s follow_up parameter) instead of being uploaded again.
+    When continuing `thread`, follow_up also points at its latest entry.
+
+    Returns:
+        A tuple (files_for_search, follow_up) to pass to search().
+    """
+    search_files, attachment_urls = await upstream_uploads.prepare(account.name, perplexity_cli, files_dict)
+    if thread is not None:
+        return search_files, {'backend_uuid': thread.backend_uuid,
+                              'attachments': thread.attachments + attachment_urls}
+    follow_up = {'backend_uuid': None, 'attachments': attachment_urls} if attachment_urls else None
+    return search_files, follow_up
+
+
+def report_thread(on_answer, account, resp, follow_up, answer):
+    """Hands the upstream thread an answer came from to `on_answer` (if any)."""
+    if on_answer is None or not answer or not resp or not resp.get('backend_uuid'):
+        return
+    on_answer(ConversationThread(account.name, resp['backend_uuid'],
+                                 follow_up['attachments'] if follow_up else ()), answer)
+
+
+async def get_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID, files_dict=None,
+                                  thread=None, on_answer=None, account_name=None):
     """
     Sends a request to the Perplexity API and returns an OpenAI-compatible response.
 
@@ -59,6 +236,9 @@ async def get_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID,
         prompt: The user's prompt string.
         model_id_with_prefix: The model ID string (e.g., 'perplexity-chat/pro-default').
         files_dict: An optional dictionary of filenames to file content (bytes or str).
+        thread: Optional ConversationThread to send `prompt` to as a follow-up.
+        on_answer: Optional callback(thread, answer) told which upstream thread answered.
+        account_name: Optional account to send the search through (the pool picks otherwise).
 
     Returns:
         A dictionary representing the OpenAI-compatible chat completion response,
@@ -71,69 +251,36 @@ async def get_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID,
 
     try:
 
-        print("-" * 20)
-        print(f"Calling get_perplexity_response with:")
-        print(f"  Prompt: {prompt[:100]}...")
-        print(f"  Model ID: {model_id_with_prefix}")
-        print(f"  Mode for API: {mode_for_api}")
-        print(f"  Model for API: {model_for_api}")
-        if files_dict:
-            print(f"  Files Dict ({len(files_dict)} files):")
-            for filename, filedata in files_dict.items():
-
-                print(f"    - {filename}: type={type(filedata)}, size={len(filedata) if isinstance(filedata, bytes) else 'N/A'}")
-        else:
-            print("  Files Dict: None")
-        print("-" * 20)
-
-        perplexity_cli = await perplexity_async.Client(perplexity_cookies if perplexity_cookies else None)
-        resp = await perplexity_cli.search(
-            prompt,
-            mode=mode_for_api,
-            model=model_for_api,
-            sources=[],
-            files=files_dict if files_dict else {},
-            stream=False,
-            language='en-US',
-            follow_up=None,
-            incognito=False
-        )
-
-        plain_text_answer = None
-
-        if resp and resp.get('text') and isinstance(resp['text'], list) and len(resp['text']) > 0:
-            final_step = resp['text'][-1]
-            if final_step.get('step_type') == 'FINAL' and final_step.get('content'):
-                answer_content_raw = final_step['content'].get('answer')
-                if answer_content_raw:
-                    try:
-                        parsed_answer = json.loads(answer_content_raw)
-                        if isinstance(parsed_answer, dict) and 'answer' in parsed_answer:
-                            plain_text_answer = parsed_answer['answer']
-                        else:
-                            plain_text_answer = str(answer_content_raw)
-                    except json.JSONDecodeError:
-                        plain_text_answer = str(answer_content_raw)
-
-            if not plain_text_answer:
-                 full_text_raw = " ".join([step.get('content', {}).get('answer', '')
-                                           for step in resp.get('text', [])
-                                           if step.get('content', {}).get('answer')])
-                 if full_text_raw:
-                      try:
-                           parsed_fallback = json.loads(full_text_raw)
-                           if isinstance(parsed_fallback, dict) and 'answer' in parsed_fallback:
-                                plain_text_answer = parsed_fallback['answer']
-                           else:
-                                plain_text_answer = str(full_text_raw)
-                      except json.JSONDecodeError:
-                           plain_text_answer = str(full_text_raw)
-
-        elif resp and resp.get('text') and isinstance(resp['text'], dict) and resp.get('step_type') == 'FINAL':
-             answer_content_raw = resp['text'].get('answer')
-             if answer_content_raw and isinstance(answer_content_raw, str):
-                 plain_text_answer = answer_content_raw
-
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Calling Perplexity", extra={
+                "model": model_id_with_prefix, "mode": mode_for_api, "model_for_api": model_for_api,
+                "prompt_chars": len(prompt), "files": len(files_dict) if files_dict else 0})
+
+        acquire_started = time.perf_counter()
+        account_name = thread.account if thread else account_name
+        async with account_pool.lease(mode_for_api, account_name) as (account, perplexity_cli):
+            record_stage('client_acquisition', time.perf_counter() - acquire_started)
+            with stage('attachment_upload'):
+                search_files, follow_up = await prepare_attachments(account, perplexity_cli, files_dict, thread)
+            with stage('upstream_search'), UPSTREAM_IN_FLIGHT.labels(metrics_model_label(model_id_with_prefix)).track_inprogress():
+                resp = await perplexity_cli.search(
+                    prompt,
+                    mode=mode_for_api,
+                    model=model_for_api,
+                    sources=SEARCH_SOURCES,
+                    files=search_files,
+                    stream=False,
+                    language=SEARCH_LANGUAGE,
+                    follow_up=follow_up,
+                    incognito=SEARCH_INCOGNITO
+                )
+            if not resp:
+                # A refused session gets no messages at all; fail the lease so the account cools down.
+                raise EmptyUpstreamResponseError("Perplexity returned no response")
+
+        with stage('answer_extraction'):
+            plain_text_answer = extract_answer(resp)
+        report_thread(on_answer, account, resp, follow_up, plain_text_answer)
         if plain_text_answer:
             openai_compatible_response = {
                 "id": resp.get('uuid', f"pplx-{int(time.time())}"),
@@ -155,12 +302,19 @@ async def get_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID,
             return openai_compatible_response
         else:
              error_msg = "Error: Could not extract answer from Perplexity response structure."
-             print(f"{error_msg} Raw response: {str(resp)[:500]}...")
+             log.warning(error_msg, extra={"model": model_id_with_prefix, "raw_response": str(resp)[:500]})
              return {"error": {"message": error_msg, "type": "api_error", "code": 502}}, 502
 
+    except EmptyUpstreamResponseError as e:
+        error_msg = "Error: Could not extract answer from Perplexity response structure."
+        log.warning(error_msg, extra={"model": model_id_with_prefix, "error": str(e)})
+        return {"error": {"message": error_msg, "type": "api_error", "code": 502}}, 502
+    except (AccountUnavailableError, FileNotFoundError) as e:
+        log.warning("Search not started", extra={"model": model_id_with_prefix, "error": str(e)})
+        return local_failure(e)
     except Exception as e:
         error_msg = f"Perplexity API Error: {e}"
-        print(error_msg)
+        log.warning(error_msg, extra={"model": model_id_with_prefix})
         return {"error": {"message": error_msg, "type": "perplexity_api_error", "code": 503}}, 503
     except json.JSONDecodeError as e:
 
@@ -170,23 +324,442 @@ async def get_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID,
          except NameError:
               pass
          error_msg = f"Failed to decode JSON response from Perplexity API: {e}. Raw Response: {raw_resp_info}"
-         print(error_msg)
+         log.warning(error_msg)
          return {"error": {"message": "Received invalid JSON from Perplexity API.", "type": "perplexity_api_error", "code": 502}}, 502
     except Exception as e:
         error_msg = f"Internal Server Error during Perplexity request: {e}"
-        print(error_msg)
-        import traceback
-        traceback.print_exc()
+        log.exception(error_msg)
         return {"error": {"message": error_msg, "type": "internal_server_error", "code": 500}}, 500
 
 
+def local_failure(error):
+    """
+    Error response for a search that failed on the gateway's side: no account
+    could take it (429 with Retry-After) or an attachment has left the file
+    store (404). Neither counts against the model's circuit breaker.
+    """
+    if isinstance(error, AccountUnavailableError):
+        return ({"error": {"message": str(error), "type": "rate_limit_error", "code": 429}},
+                429, {"Retry-After": str(error.retry_after)})
+    return ({"error": {"message": "An attached file is no longer in the file store; upload it again.",
+                       "type": "invalid_request_error", "code": 404}}, 404, {})
+
+
+def mode_for_model(model_id_with_prefix):
+    return MODEL_ID_TO_API_PARAMS_MAP.get(model_id_with_prefix, (DEFAULT_MODE_FOR_FALLBACK, None))[0]
+
+
+def prompt_budget(model_id_with_prefix):
+    """Prompt token budget for a model ID (or its mode), or None for no limit."""
+    if model_id_with_prefix in PROMPT_BUDGETS:
+        return PROMPT_BUDGETS[model_id_with_prefix]
+    return PROMPT_BUDGETS.get(mode_for_model(model_id_with_prefix))
+
+
+def fit_prompt(messages, model_id_with_prefix):
+    """
+    Applies the model's prompt budget to `messages` (see TokenCounter.fit).
+
+    Returns:
+        A tuple (messages_to_send, prompt_tokens).
+    """
+    messages, prompt_tokens, dropped = token_counter.fit(messages, prompt_budget(model_id_with_prefix))
+    if dropped:
+        PROMPT_MESSAGES_DROPPED.labels(metrics_model_label(model_id_with_prefix)).inc(dropped)
+        log.debug("Trimmed prompt to its token budget", extra={
+            "model": model_id_with_prefix, "dropped_messages": dropped, "prompt_tokens": prompt_tokens})
+    return messages, prompt_tokens
+
+
+def usage_for(model_id_with_prefix, prompt_tokens, answer):
+    """An OpenAI `usage` object from local token counts; also feeds the token metrics."""
+    completion_tokens = token_counter.count_text(answer)
+    label = metrics_model_label(model_id_with_prefix)
+    TOKENS.labels(label, 'prompt').inc(prompt_tokens)
+    TOKENS.labels(label, 'completion').inc(completion_tokens)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def fill_usage(response_data, prompt_tokens):
+    """Replaces a completion's placeholder usage with local token counts."""
+    response_data["usage"] = usage_for(response_data.get("model"), prompt_tokens,
+                                       response_data["choices"][0]["message"]["content"])
+
+
+def admission_class():
+    """(priority, queue_timeout) of the current request's API key."""
+    return API_KEY_PRIORITIES.get(bearer_token(), (0, None))
+
+
+def rejection(error):
+    """Error payload and headers for a request turned away by admission control."""
+    return ({"error": {"message": str(error), "type": "rate_limit_error", "code": 429}},
+            429, {"Retry-After": str(error.retry_after)})
+
+
+async def get_admitted_response(prompt, model_id_with_prefix, files_dict, priority=0, queue_timeout=None,
+                                thread=None, on_answer=None, account_name=None):
+    """
+    get_perplexity_response() behind admission control.
+
+    Returns:
+        The same values as get_perplexity_response(), or a tuple
+        (dict, 429, headers) when no upstream slot could be obtained.
+    """
+    if admission is None:
+        return await get_perplexity_response(prompt, model_id_with_prefix, files_dict=files_dict,
+                                             thread=thread, on_answer=on_answer, account_name=account_name)
+    mode_for_api = mode_for_model(model_id_with_prefix)
+    try:
+        with stage('admission_queue'):
+            granted_at = await admission.acquire(mode_for_api, priority, queue_timeout)
+    except AdmissionRejectedError as e:
+        return rejection(e)
+    try:
+        return await get_perplexity_response(prompt, model_id_with_prefix, files_dict=files_dict,
+                                             thread=thread, on_answer=on_answer, account_name=account_name)
+    finally:
+        admission.release(mode_for_api, granted_at)
+
+
+def is_upstream_failure(response_data):
+    """True for the errors that count against a model's circuit breaker (not rejections or bad input)."""
+    return isinstance(response_data, tuple) and response_data[1] in (502, 503)
+
+
+def circuit_open_error(chain):
+    """The 503 returned when every model in `chain` has an open circuit."""
+    retry_after = max(1, math.ceil(min(circuit_breaker.retry_after(model_id) for model_id in chain)))
+    return ({"error": {"message": (f"Model '{chain[0]}' is temporarily unavailable after repeated upstream "
+                                   f"errors; retry in about {retry_after}s."),
+                       "type": "perplexity_api_error", "code": 503}},
+            503, {"Retry-After": str(retry_after)})
+
+
+def choose_model(model_id_with_prefix):
+    """
+    The first model in the fallback chain of `model_id_with_prefix` whose circuit is closed.
+
+    Returns:
+        A model ID, or None when every circuit in the chain is open.
+    """
+    chain = FALLBACK_CHAINS.get(model_id_with_prefix, [model_id_with_prefix])
+    return next((model_id for model_id in chain if circuit_breaker.allow(model_id)), None)
+
+
+async def get_model_response(prompt, model_id_with_prefix, files_dict, priority=0, queue_timeout=None,
+                             thread=None, on_answer=None, account_name=None):
+    """
+    get_admitted_response() for one model, hedged on a second account in HEDGE_MODES.
+
+    Once enough latencies are known, a request still unanswered after the
+    model's HEDGE_QUANTILE latency (at least HEDGE_MIN_DELAY) is also sent
+    through the next best account; the first answer wins.
+    """
+    async def attempt_on(name):
+        started = time.perf_counter()
+        response_data = await get_admitted_response(prompt, model_id_with_prefix, files_dict, priority,
+                                                    queue_timeout, thread, on_answer, name)
+        elapsed = time.perf_counter() - started
+        if isinstance(response_data, dict):
+            upstream_latency.record(model_id_with_prefix, elapsed)
+            latency_router.record(model_id_with_prefix, elapsed, True)
+            circuit_breaker.record(model_id_with_prefix, True)
+        elif is_upstream_failure(response_data):
+            latency_router.record(model_id_with_prefix, elapsed, False)
+            circuit_breaker.record(model_id_with_prefix, False)
+        return response_data
+
+    mode_for_api = mode_for_model(model_id_with_prefix)
+    delay = upstream_latency.quantile(model_id_with_prefix, HEDGE_QUANTILE)
+    # Threads live on one account and pinned requests stay where they were sent.
+    if mode_for_api not in HEDGE_MODES or delay is None or thread is not None or account_name is not None:
+        return await attempt_on(account_name)
+    candidates = account_pool.candidates(mode_for_api)
+    if len(candidates) < 2:
+        return await attempt_on(None)
+
+    def attempt(index):
+        if index == 0:
+            return attempt_on(candidates[0])
+        others = [name for name in account_pool.candidates(mode_for_api) if name != candidates[0]]
+        return attempt_on(others[0]) if others else None
+
+    response_data, hedge_launched, hedge_won = await hedged(attempt, max(delay, HEDGE_MIN_DELAY))
+    resilience_stats["hedges"] += hedge_launched
+    resilience_stats["hedge_wins"] += hedge_won
+    return response_data
+
+
+async def get_resilient_response(prompt, model_id_with_prefix, files_dict, priority=0, queue_timeout=None,
+                                 thread=None, on_answer=None, account_name=None):
+    """
+    get_model_response() along the requested model's fallback chain.
+
+    Models whose circuit breaker is open are skipped, and an upstream error
+    (502/503) moves on to the next model. The completion's "model" field
+    names the model that actually answered.
+
+    Returns:
+        The same values as get_admitted_response(), or a 503 tuple with a
+        Retry-After header when every model in the chain is unavailable.
+    """
+    chain = FALLBACK_CHAINS.get(model_id_with_prefix, [model_id_with_prefix])
+    response_data = None
+    for model_id in chain:
+        if not circuit_breaker.allow(model_id):
+            continue
+        if response_data is not None:
+            resilience_stats["fallbacks"] += 1
+            log.info("Falling back to another model", extra={"model": model_id_with_prefix, "fallback": model_id})
+        response_data = await get_model_response(prompt, model_id, files_dict, priority, queue_timeout,
+                                                 thread, on_answer, account_name)
+        if not is_upstream_failure(response_data):
+            return response_data
+    return response_data if response_data is not None else circuit_open_error(chain)
+
+
+async def run_background_completion(prompt, model_id_with_prefix, files_dict, priority, cache_key,
+                                    thread=None, on_answer=None, prompt_tokens=0):
+    """Body of a background job: the non-streaming completion, stored in the response cache on success."""
+    # Nobody is waiting on the HTTP connection, so a job may queue for an upstream slot much longer.
+    response_data = await get_resilient_response(prompt, model_id_with_prefix, files_dict, priority,
+                                                queue_timeout=3600, thread=thread, on_answer=on_answer)
+    if isinstance(response_data, dict):
+        response_data.setdefault("model", model_id_with_prefix)
+        fill_usage(response_data, prompt_tokens)
+        if cache_key is not None:
+            response_cache.put(cache_key, response_data,
+                               response_cache.ttl_for(model_id_with_prefix, mode_for_model(model_id_with_prefix)))
+    return response_data
+
+
+def batch_line_prompt(messages):
+    """
+    Flattens a batch line's messages into a prompt and attachments.
+
+    Batch lines carry text and `file` references to the file store; inline
+    images would have to be decoded per line and are not accepted.
+
+    Returns:
+        A tuple (prompt, files_dict or None).
+
+    Raises:
+        ValueError: A message part is not supported or names an unknown file.
+    """
+    text_parts = []
+    files = {}
+    for msg in messages:
+        content = msg.get('content')
+        if isinstance(content, str):
+            text_parts.append(content)
+            continue
+        for part in content or ():
+            if part.get('type') == 'text':
+                text_parts.append(part.get('text', ''))
+            elif part.get('type') == 'file':
+                file_id = (part.get('file') or {}).get('file_id')
+                stored = file_store.get(file_id) if (file_store is not None and file_id) else None
+                if stored is None:
+                    raise ValueError(f"Unknown file id '{file_id}'")
+                filename = (part.get('file') or {}).get('filename') or stored.filename
+                files[filename] = stored.renamed(filename)
+            else:
+                raise ValueError(f"Unsupported content part '{part.get('type')}' in a batch request")
+    prompt = "\n".join(text_parts).strip()
+    return prompt or ("Describe the attached file(s)." if files else "Hello."), files or None
+
+
+async def run_batch_line(body):
+    """
+    Runs one batch request body as a low-priority non-streaming completion.
+
+    Lines are paced per account (see AccountPacer) and queue behind
+    interactive traffic for an upstream slot.
+    """
+    model_id_with_prefix = resolve_model(body.get("model", DEFAULT_MODEL_ID))
+    messages, prompt_tokens = fit_prompt(body['messages'], model_id_with_prefix)
+    try:
+        prompt, files_dict = batch_line_prompt(messages)
+    except ValueError as e:
+        return {"error": {"message": str(e), "type": "invalid_request_error", "code": 400}}, 400
+    mode_for_api = mode_for_model(model_id_with_prefix)
+    for stored in (files_dict or {}).values():
+        file_store.pin(stored.digest)
+    try:
+        account_name = await batch_manager.pacer.wait(
+            [account.name for account in account_pool.accounts
+             if account_pool.available(account.name, mode_for_api)])
+        response_data = await get_resilient_response(prompt, model_id_with_prefix, files_dict, BATCH_PRIORITY,
+                                                    queue_timeout=3600, account_name=account_name)
+    finally:
+        for stored in (files_dict or {}).values():
+            file_store.unpin(stored.digest)
+    if isinstance(response_data, dict):
+        response_data.setdefault("model", model_id_with_prefix)
+        fill_usage(response_data, prompt_tokens)
+    return response_data
+
+
+def publish_batch_file(batch, kind, data):
+    """Stores a finished batch's output or error JSONL in the file store; returns its file ID."""
+    return file_store.put(data, f"{batch.id}_{kind}.jsonl", purpose='batch_output').file_id
+
+
+async def stream_perplexity_response(prompt, model_id_with_prefix=DEFAULT_MODEL_ID, files_dict=None,
+                                     thread=None, on_answer=None, usage_prompt_tokens=None):
+    """
+    Streams a Perplexity answer as OpenAI-style `chat.completion.chunk` SSE events.
+
+    perplexity_async yields cumulative answers, so each event carries only the
+    text appended since the previous one. The stream always ends with `[DONE]`;
+    upstream failures are reported as an `error` event before it.
+
+    Args:
+        prompt: The user's prompt string.
+        model_id_with_prefix: The model ID string (e.g., 'perplexity-chat/pro-default').
+        files_dict: An optional dictionary of filenames to file content (bytes or str).
+        thread: Optional ConversationThread to send `prompt` to as a follow-up.
+        on_answer: Optional callback(thread, answer) told which upstream thread answered.
+        usage_prompt_tokens: If given, a final chunk reports token usage
+            (OpenAI's stream_options.include_usage).
+
+    Yields:
+        Server-Sent Event strings.
+    """
+    mode_for_api, model_for_api = MODEL_ID_TO_API_PARAMS_MAP.get(
+        model_id_with_prefix,
+        (DEFAULT_MODE_FOR_FALLBACK, DEFAULT_MODEL_FOR_FALLBACK)
+    )
+    completion_id = f"pplx-{int(time.time())}"
+    created = int(time.time())
+
+    def sse_chunk(delta, finish_reason=None):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_id_with_prefix,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {jsoncodec.dumps(chunk)}\n\n"
+
+    log.debug("Streaming from Perplexity", extra={
+        "model": model_id_with_prefix, "mode": mode_for_api, "model_for_api": model_for_api,
+        "prompt_chars": len(prompt), "files": len(files_dict) if files_dict else 0})
+
+    yield sse_chunk({"role": "assistant", "content": ""})
+
+    sent_text = ""
+    finish_reason = "length"
+    resp = None
+    try:
+        acquire_started = time.perf_counter()
+        async with account_pool.lease(mode_for_api, thread.account if thread else None) as (account, perplexity_cli):
+            record_stage('client_acquisition', time.perf_counter() - acquire_started)
+            with stage('attachment_upload'):
+                search_files, follow_up = await prepare_attachments(account, perplexity_cli, files_dict, thread)
+            with UPSTREAM_IN_FLIGHT.labels(metrics_model_label(model_id_with_prefix)).track_inprogress():
+                search_started = time.perf_counter()
+                upstream = await perplexity_cli.search(
+                    prompt,
+                    mode=mode_for_api,
+                    model=model_for_api,
+                    sources=SEARCH_SOURCES,
+                    files=search_files,
+                    stream=True,
+                    language=SEARCH_LANGUAGE,
+                    follow_up=follow_up,
+                    incognito=SEARCH_INCOGNITO
+                )
+                async for resp in upstream:
+                    if not sent_text:
+                        record_stage('upstream_first_chunk', time.perf_counter() - search_started)
+                    with stage('answer_extraction'):
+                        answer = extract_answer(resp, partial=True)
+                    if answer and len(answer) > len(sent_text) and answer.startswith(sent_text):
+                        yield sse_chunk({"content": answer[len(sent_text):]})
+                        sent_text = answer
+                    if resp.get('status') == 'completed':
+                        finish_reason = "stop"
+                record_stage('upstream_search', time.perf_counter() - search_started)
+            if resp is None:
+                raise EmptyUpstreamResponseError("Perplexity returned an empty stream")
+
+        circuit_breaker.record(model_id_with_prefix, bool(sent_text))
+        latency_router.record(model_id_with_prefix, time.perf_counter() - search_started, bool(sent_text))
+        if finish_reason == "stop":
+            report_thread(on_answer, account, resp, follow_up, sent_text)
+        if not sent_text:
+            error_msg = "Error: Could not extract answer from Perplexity response structure."
+            log.warning(error_msg, extra={"model": model_id_with_prefix})
+            yield f"data: {jsoncodec.dumps({'error': {'message': error_msg, 'type': 'api_error', 'code': 502}})}\n\n"
+    except EmptyUpstreamResponseError as e:
+        circuit_breaker.record(model_id_with_prefix, False)
+        latency_router.record(model_id_with_prefix, time.perf_counter() - search_started, False)
+        error_msg = "Error: Could not extract answer from Perplexity response structure."
+        log.warning(error_msg, extra={"model": model_id_with_prefix, "error": str(e)})
+        yield f"data: {jsoncodec.dumps({'error': {'message': error_msg, 'type': 'api_error', 'code': 502}})}\n\n"
+    except (AccountUnavailableError, FileNotFoundError) as e:
+        log.warning("Search not started", extra={"model": model_id_with_prefix, "error": str(e)})
+        yield f"data: {jsoncodec.dumps(local_failure(e)[0])}\n\n"
+    except Exception as e:
+        circuit_breaker.record(model_id_with_prefix, False)
+        latency_router.record(model_id_with_prefix, time.perf_counter() - acquire_started, False)
+        error_msg = f"Perplexity API Error: {e}"
+        log.warning(error_msg, extra={"model": model_id_with_prefix})
+        yield f"data: {jsoncodec.dumps({'error': {'message': error_msg, 'type': 'perplexity_api_error', 'code': 503}})}\n\n"
+
+    yield sse_chunk({}, finish_reason)
+    if usage_prompt_tokens is not None:
+        usage_chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model_id_with_prefix, "choices": [],
+                       "usage": usage_for(model_id_with_prefix, usage_prompt_tokens, sent_text)}
+        yield f"data: {jsoncodec.dumps(usage_chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.before_serving
+async def start_account_pool():
+    """Creates and warms the per-account Perplexity client pools on the serving event loop."""
+    global account_pool
+    if account_pool is None:
+        account_pool = AccountPool.from_cookies(perplexity_accounts or [("anonymous", None)],
+                                                client_factory=client_factory)
+    await account_pool.start()
+    if admission is not None:
+        await admission.start()
+    if job_manager is not None:
+        await job_manager.start()
+    if batch_manager is not None:
+        await batch_manager.start()
+
+
+@app.after_serving
+async def stop_account_pool():
+    if batch_manager is not None:
+        await batch_manager.close()
+    if job_manager is not None:
+        await job_manager.close()
+    if account_pool is not None:
+        await account_pool.close()
+    if admission is not None:
+        await admission.close()
+    if response_cache is not None:
+        response_cache.close()
+    if shared_state is not None:
+        # Writes out what is still deferred before the worker exits.
+        await asyncio.to_thread(shared_state.close)
+
+
 @app.route('/v1/models', methods=['GET'])
 @require_api_key
-def list_models():
+async def list_models():
     """Returns a list of available models in OpenAI format."""
     models_data = []
     created_time = int(time.time())
-    for model_id in ALL_MODELS_WITH_PREFIX:
+    for model_id in list(ROUTED_MODELS) + ALL_MODELS_WITH_PREFIX:
         models_data.append({
             "id": model_id,
             "object": "model",
@@ -197,15 +770,250 @@ def list_models():
     return jsonify({"object": "list", "data": models_data})
 
 
+@app.errorhandler(413)
+async def payload_too_large(error):
+    return jsonify({
+        "error": {
+            "message": "Request body is larger than the configured limit.",
+            "type": "invalid_request_error",
+            "code": 413
+        }
+    }), 413
+
+
+@app.route('/cache/stats', methods=['GET'])
+@require_api_key
+async def cache_stats():
+    """Returns response cache hit/miss counters."""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **response_cache.status()})
+
+
+def gateway_status_metrics():
+    """Reports the status counters of the gateway's pools and caches to /metrics."""
+    upload_status = {"upload_bytes_in_flight": upload_bytes_in_flight.in_use,
+                     "upload_rejections": upload_bytes_in_flight.rejections,
+                     **{f"upstream_uploads_{key}": value for key, value in upstream_uploads.stats.items()}}
+    for name, value in upload_status.items():
+        yield name, "Attachment upload bookkeeping.", {}, value
+    if admission is not None:
+        status = admission.status()
+        for key in ("running", "queue_depth", "oldest_wait_seconds", "admitted", "queued",
+                    "rejected_queue_full", "rejected_timeout", "wait_seconds_total"):
+            yield f"admission_{key}", "Admission control status.", {}, status[key]
+        for mode in PERPLEXITY_MODES_MODELS:
+            yield ("admission_running_by_mode", "Upstream searches running, by mode.", {"mode": mode},
+                   status["running_by_mode"].get(mode, 0))
+            yield ("admission_queued_by_mode", "Requests waiting for an upstream slot, by mode.", {"mode": mode},
+                   status["queued_by_mode"].get(mode, 0))
+    if job_manager is not None:
+        for key, value in job_manager.status().items():
+            yield f"jobs_{key}", "Background job status.", {}, value
+    for key, value in {**resilience_stats, **circuit_breaker.status()}.items():
+        yield f"resilience_{key}", "Hedging, fallback and circuit breaker counters.", {}, value
+    for model_id in ALL_MODELS_WITH_PREFIX:
+        yield ("circuit_open", "1 while the model's circuit breaker is open.", {"model": model_id},
+               int(circuit_breaker.is_open(model_id)))
+    for key, value in token_counter.status().items():
+        yield f"token_counter_{key}", "Per-message token count cache.", {}, value
+    for key, value in latency_router.stats.items():
+        yield f"routing_{key}", "Requests for virtual models such as 'fastest'.", {}, value
+    for model_id, entry in latency_router.status().items():
+        labels = {"model": metrics_model_label(model_id)}
+        yield "routing_latency_seconds", "Decayed average upstream latency used for routing.", labels, entry["latency"]
+        yield "routing_error_rate", "Decayed upstream error rate used for routing.", labels, entry["error_rate"]
+    if batch_manager is not None:
+        for key, value in batch_manager.status().items():
+            yield f"batches_{key}", "Batch API status.", {}, value
+    if conversation_index is not None:
+        for key, value in conversation_index.status().items():
+            yield f"conversation_{key}", "Conversation follow-up index status.", {}, value
+    if single_flight is not None:
+        yield "coalesce_in_flight", "Distinct upstream calls shared by coalesced requests.", {}, single_flight.in_flight()
+        for key, value in single_flight.stats.items():
+            yield f"coalesce_{key}", "Request coalescing counters.", {}, value
+    if response_cache is not None:
+        for key, value in response_cache.status().items():
+            yield f"cache_{key}", "Response cache status.", {}, value
+    if file_store is not None:
+        for key, value in file_store.status().items():
+            yield f"file_store_{key}", "Attachment store status.", {}, value
+    if account_pool is not None:
+        for account in account_pool.status():
+            labels = {"account": account["name"]}
+            for key in ("in_flight", "cooling_down_for", "requests", "failures"):
+                yield f"account_{key}", "Per-account upstream status.", labels, account[key]
+            for mode, left in account["quota_left"].items():
+                yield "account_quota_left", "Remaining metered queries in the current window.", {**labels, "mode": mode}, left
+            for key, value in account["client_pool"].items():
+                yield f"account_client_pool_{key}", "Per-account client pool status.", labels, value
+
+
+status_collector.add(gateway_status_metrics)
+
+
+@app.route('/admin/slow-requests', methods=['GET'])
+@require_api_key
+async def slow_request_log():
+    """
+    The slowest recent chat completions with their stage timings, slowest first.
+
+    Query parameters: `model` to show one model only, `limit` to cap the list.
+    Entries carry sizes and flags but never prompt or answer text.
+    """
+    entries = slow_requests.entries(request.args.get('model'))
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit >= 0:
+        entries = entries[:limit]
+    return jsonify({"object": "list", "enabled": slow_requests.size > 0, "window_seconds": slow_requests.window,
+                    "data": entries})
+
+
+@app.route('/metrics', methods=['GET'])
+@require_api_key
+async def metrics():
+    """Prometheus metrics: request counts, stage latencies, in-flight gauges and pool status."""
+    return Response(render_metrics(), mimetype=METRICS_CONTENT_TYPE)
+
+
+def read_upload(file_storage, upload_budget):
+    """Reads a spooled multipart upload once, charging it to the request's upload budget."""
+    stream = file_storage.stream
+    file_size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    upload_budget.reserve(file_size, file_storage.filename)
+    data = stream.read()
+    file_storage.close()
+    return data
+
+
+async def store_attachment(data, filename):
+    """Puts an attachment in the file store (when enabled) so later requests can reuse it."""
+    if file_store is None:
+        return data
+    return await file_store.put_async(data, filename)
+
+
+def use_stored_file(stored, upload_budget):
+    """Pins a stored file against eviction until the request releases its upload budget."""
+    file_store.pin(stored.digest)
+    upload_budget.on_release(lambda: file_store.unpin(stored.digest))
+
+
+def file_store_disabled():
+    return jsonify({
+        "error": {"message": "File store is disabled.", "type": "invalid_request_error", "code": 404}
+    }), 404
+
+
+def file_not_found(file_id):
+    return jsonify({
+        "error": {"message": f"No such file: '{file_id}'", "type": "invalid_request_error", "code": 404}
+    }), 404
+
+
+@app.route('/v1/files', methods=['POST'])
+@require_api_key
+async def upload_file():
+    """Stores an uploaded file and returns an OpenAI-style file object."""
+    if file_store is None:
+        return file_store_disabled()
+    upload_budget = UploadBudget(upload_bytes_in_flight, MAX_FILE_BYTES, MAX_REQUEST_FILE_BYTES)
+    try:
+        upload_budget.reserve_body(request.content_length or 0)
+        form = await request.form
+        uploaded_files = await request.files
+        file_storage = uploaded_files.get('file')
+        if not file_storage or not file_storage.filename:
+            return jsonify({"error": "Missing 'file' field in multipart/form-data request"}), 400
+        data = read_upload(file_storage, upload_budget)
+        stored = await file_store.put_async(data, file_storage.filename, purpose=form.get('purpose', 'assistants'))
+        UPLOAD_BYTES.labels('files_api').inc(stored.size)
+        log.info("Stored uploaded file", extra={"file_id": stored.file_id, "size": stored.size})
+        return jsonify(stored.to_openai())
+    except PayloadTooLargeError as e:
+        return jsonify({
+            "error": {"message": str(e), "type": "invalid_request_error", "code": 413}
+        }), 413
+    finally:
+        upload_budget.release()
+
+
+@app.route('/v1/files', methods=['GET'])
+@require_api_key
+async def list_files():
+    if file_store is None:
+        return file_store_disabled()
+    return jsonify({"object": "list", "data": [stored.to_openai() for stored in file_store.list()]})
+
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+@require_api_key
+async def retrieve_file(file_id):
+    if file_store is None:
+        return file_store_disabled()
+    stored = file_store.get(file_id)
+    if stored is None:
+        return file_not_found(file_id)
+    return jsonify(stored.to_openai())
+
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+@require_api_key
+async def retrieve_file_content(file_id):
+    if file_store is None:
+        return file_store_disabled()
+    stored = file_store.get(file_id)
+    if stored is None:
+        return file_not_found(file_id)
+    return Response(await asyncio.to_thread(file_store.read, stored.digest), mimetype='application/octet-stream')
+
+
+@app.route('/v1/files/<file_id>', methods=['DELETE'])
+@require_api_key
+async def delete_file(file_id):
+    if file_store is None:
+        return file_store_disabled()
+    if not file_store.delete(file_id):
+        return file_not_found(file_id)
+    return jsonify({"id": file_id, "object": "file", "deleted": True})
+
+
 @app.route('/v1/chat/completions', methods=['POST'])
 @require_api_key
-def chat_completions():
+async def chat_completions():
     """
     Endpoint compatible with OpenAI Chat Completion API.
 
     Supports file uploads via multipart/form-data or image URLs in messages.
     """
+    auth_started, auth_seconds = g.get('auth_timing', (None, 0.0))
+    timer = start_request(auth_started)
+    timer.add('auth', auth_seconds)
+    annotate(request_bytes=request.content_length or 0)
+    status = 500
     try:
+        response = await app.make_response(await handle_chat_completion(timer))
+        status = response.status_code
+        if not timer.fields.get('stream'):
+            annotate(response_bytes=response.content_length or 0)
+        if SERVER_TIMING:
+            # For streams this covers the work done before the first byte.
+            response.headers['Server-Timing'] = timer.server_timing()
+        return response
+    finally:
+        # Streaming responses are recorded by finish_after_stream once the body is sent.
+        if not timer.fields.get('stream'):
+            finish_request(timer, status)
+
+
+async def handle_chat_completion(timer):
+    """Parses a chat completion request and produces its response (see chat_completions)."""
+    upload_budget = UploadBudget(upload_bytes_in_flight, MAX_FILE_BYTES, MAX_REQUEST_FILE_BYTES)
+    release_upload_budget = True
+    try:
+        upload_budget.reserve_body(request.content_length or 0)
         prompt_text = ""
         files_to_pass = {}
         data = None
@@ -214,71 +1022,84 @@ def chat_completions():
         is_multipart = 'multipart/form-data' in content_type
 
         if is_multipart:
-            json_payload_str = request.form.get('json_payload')
+            with stage('request_parsing'):
+                form = await request.form
+                uploaded_files = await request.files
+            json_payload_str = form.get('json_payload')
             if not json_payload_str:
                 return jsonify({
                     "error": ("Missing 'json_payload' field in "
                               "multipart/form-data request")
                 }), 400
             try:
-                data = json.loads(json_payload_str)
-            except json.JSONDecodeError:
+                data = jsoncodec.loads(json_payload_str)
+            except jsoncodec.JSONDecodeError:
                 return jsonify({
                     "error": "Invalid JSON in 'json_payload' field"
                 }), 400
 
 
-            if request.files:
-                for field_name, file_storage in request.files.items():
+            if uploaded_files:
+                for field_name, file_storage in uploaded_files.items():
                     if file_storage and file_storage.filename:
                         filename = file_storage.filename
-                        mimetype = file_storage.mimetype
-                        print(f"Processing uploaded file: {filename}, mimetype: {mimetype}")
-
-                        text_extensions = ('.txt', '.md', '.py', '.json', '.csv',
-                                           '.html', '.css', '.js', '.xml', '.log',
-                                           '.srt')
-                        is_text_file = (
-                            filename.lower().endswith(text_extensions) or
-                            (mimetype and mimetype.startswith('text/'))
-                        )
 
                         try:
-                            if is_text_file:
-                                file_content = file_storage.stream.read().decode('utf-8', errors='replace')
-                                files_to_pass[filename] = file_content
-                                print(f"  Read {filename} as text (str), size: {len(file_content)}")
-                            else:
-                                file_content = file_storage.read()
-                                files_to_pass[filename] = file_content
-                                print(f"  Read {filename} as bytes, size: {len(file_content)}")
+                            with stage('file_decoding'):
+                                file_content = read_upload(file_storage, upload_budget)
+                                files_to_pass[filename] = await store_attachment(file_content, filename)
+                            UPLOAD_BYTES.labels('multipart').inc(len(file_content))
+                            log.debug("Read uploaded file", extra={
+                                "filename": filename, "mimetype": file_storage.mimetype, "size": len(file_content)})
+                        except PayloadTooLargeError:
+                            raise
                         except Exception as read_err:
-                             print(f"Error reading file {filename}: {read_err}")
+                             log.warning("Error reading uploaded file", extra={"filename": filename, "error": str(read_err)})
                              continue
                     else:
-                         print(f"Warning: Received empty file field '{field_name}'")
+                         log.warning("Received empty file field", extra={"field": field_name})
             if not files_to_pass:
                 files_to_pass = None
 
         else:
             try:
-                 data = request.get_json()
+                 with stage('request_parsing'):
+                     data = await request.get_json()
 
                  if not data:
                      raise ValueError("Empty JSON data")
             except Exception as json_err:
-                 raw_body = request.get_data(as_text=True)
-                 print(f"Failed to parse JSON. Raw body: {raw_body}")
+                 raw_body = await request.get_data(as_text=True)
+                 log.info("Failed to parse JSON request body", extra={"error": str(json_err), "body_bytes": len(raw_body)})
                  return jsonify({"error": f"Invalid JSON request. Error: {json_err}. Raw Body: {raw_body[:500]}..."}), 400
 
 
         if not data or 'messages' not in data:
-             print("Error: Missing 'messages' in payload.")
              return jsonify({"error": "Missing 'messages' field in the request payload"}), 400
 
+        requested_model = data.get("model", DEFAULT_MODEL_ID)
+        model_id_with_prefix = resolve_model(requested_model)
+        annotate(model=metrics_model_label(requested_model))
+
+        # A history that continues one of our earlier answers goes to that
+        # upstream thread as a follow-up carrying only the new messages.
+        messages = data['messages']
+        thread = on_answer = None
+        if conversation_index is not None:
+            thread, prefix_length, conversation_hasher = await conversation_index.lookup(requested_model, messages)
+            if thread is not None and not account_pool.available(thread.account, mode_for_model(model_id_with_prefix)):
+                conversation_index.stats["unavailable"] += 1
+                thread = None
+            if thread is not None:
+                messages = messages[prefix_length:]
+            on_answer = lambda new_thread, answer: conversation_index.remember(conversation_hasher, answer, new_thread)
+        annotate(follow_up=thread is not None)
+        with stage('prompt_fitting'):
+            messages, prompt_tokens = fit_prompt(messages, model_id_with_prefix)
+
         image_count = 0
         all_text_parts = []
-        for msg in data['messages']:
+        for msg in messages:
             content = msg.get('content')
             if isinstance(content, str):
                 all_text_parts.append(content)
@@ -286,61 +1107,306 @@ def chat_completions():
                  for part in content:
                      if part.get('type') == 'text':
                          all_text_parts.append(part.get('text', ''))
+                     elif part.get('type') == 'file':
+                         file_id = (part.get('file') or {}).get('file_id')
+                         stored = file_store.get(file_id) if (file_store is not None and file_id) else None
+                         if stored is None:
+                             return jsonify({"error": f"Unknown file id '{file_id}'"}), 400
+                         filename = (part.get('file') or {}).get('filename') or stored.filename
+                         if files_to_pass is None: files_to_pass = {}
+                         if filename in files_to_pass:
+                             filename = f"{stored.digest[:8]}_{filename}"
+                         upload_budget.reserve(stored.size, filename)
+                         use_stored_file(stored, upload_budget)
+                         files_to_pass[filename] = stored.renamed(filename)
+                         UPLOAD_BYTES.labels('file_ref').inc(stored.size)
                      elif not is_multipart and part.get('type') == 'image_url':
                          image_url_data = part.get('image_url', {}).get('url')
                          if image_url_data and image_url_data.startswith('data:image'):
                               try:
-                                  header, encoded_data = image_url_data.split(',', 1)
+                                  payload_start = image_url_data.index(',') + 1
+                                  header = image_url_data[:payload_start]
                                   mime_match = re.search(r'data:(image/[a-zA-Z+]+);base64', header)
                                   mime_type = mime_match.group(1) if mime_match else 'image/png'
                                   extension = mime_type.split('/')[-1]
-                                  decoded_bytes = base64.b64decode(encoded_data)
                                   image_count += 1
                                   filename = f"image_{image_count}.{extension}"
                                   if files_to_pass is None: files_to_pass = {}
-                                  files_to_pass[filename] = decoded_bytes
-                                  print(f"Decoded and added image from data URL: "
-                                        f"{filename}, size: {len(decoded_bytes)}")
+                                  encoded_digest = None
+                                  if file_store is not None:
+                                      encoded_digest = await asyncio.to_thread(
+                                          sha256_of_base64, image_url_data, payload_start)
+                                      stored = file_store.lookup_base64(encoded_digest)
+                                      if stored is not None:
+                                          upload_budget.reserve(stored.size, filename)
+                                          use_stored_file(stored, upload_budget)
+                                          files_to_pass[filename] = stored.renamed(filename)
+                                          UPLOAD_BYTES.labels('data_url').inc(stored.size)
+                                          continue
+                                  upload_budget.reserve(base64_decoded_size(image_url_data, payload_start), filename)
+                                  with stage('file_decoding'):
+                                      decoded_bytes = decode_base64_chunked(image_url_data, payload_start)
+                                      files_to_pass[filename] = await store_attachment(decoded_bytes, filename)
+                                      if encoded_digest is not None:
+                                          file_store.remember_base64(encoded_digest, files_to_pass[filename].digest)
+                                  UPLOAD_BYTES.labels('data_url').inc(len(decoded_bytes))
+                              except PayloadTooLargeError:
+                                  raise
                               except Exception as e:
-                                  print(f"Error decoding base64 image URL: {e}")
+                                  log.warning("Error decoding base64 image URL", extra={"error": str(e)})
 
         prompt_text = "\n".join(all_text_parts).strip()
 
 
-        print(f"Extracted prompt_text to send to Perplexity: '{prompt_text}'")
-        if not files_to_pass:
-            print("No files extracted from this request to pass directly.")
-        else:
-            print(f"Files extracted to pass: {list(files_to_pass.keys())}")
-        print("-" * 20)
-
-
         if not prompt_text:
              if files_to_pass:
                   prompt_text = "Describe the attached file(s)."
              else:
                   prompt_text = "Hello."
-             print(f"Prompt text was empty, using default: '{prompt_text}'")
-
-        model_id_with_prefix = data.get("model", DEFAULT_MODEL_ID)
 
-        response_data = asyncio.run(get_perplexity_response(prompt_text, model_id_with_prefix, files_dict=files_to_pass))
+        log.debug("Parsed chat completion request", extra={
+            "model": model_id_with_prefix, "prompt_chars": len(prompt_text), "follow_up": thread is not None,
+            "files": list(files_to_pass.keys()) if files_to_pass else []})
+        # Sizes only; the slow-request log never sees the prompt itself.
+        annotate(messages=len(messages), prompt_chars=len(prompt_text), prompt_tokens=prompt_tokens,
+                 files=len(files_to_pass) if files_to_pass else 0, file_bytes=upload_budget.attachment_bytes)
+
+        priority, queue_timeout = admission_class()
+        background = (bool(data.get("background"))
+                      or 'respond-async' in request.headers.get('Prefer', '').lower())
+        if background and data.get("stream"):
+            return jsonify({"error": "'background' and 'stream' cannot be combined"}), 400
+        webhook_url = data.get("webhook_url")
+        if webhook_url and job_manager is not None:
+            try:
+                await job_manager.check_webhook(webhook_url)
+            except WebhookURLError as e:
+                return jsonify({"error": str(e)}), 400
+
+        if data.get("stream"):
+            # Streams cannot switch models midway, so the fallback chain is only consulted up front.
+            served_model = choose_model(model_id_with_prefix)
+            if served_model is None:
+                error_body, status, headers = circuit_open_error(
+                    FALLBACK_CHAINS.get(model_id_with_prefix, [model_id_with_prefix]))
+                return jsonify(error_body), status, headers
+            include_usage = bool((data.get("stream_options") or {}).get("include_usage"))
+            body = stream_perplexity_response(prompt_text, served_model, files_dict=files_to_pass,
+                                              thread=thread, on_answer=on_answer,
+                                              usage_prompt_tokens=prompt_tokens if include_usage else None)
+            # Everything the stream holds is freed by its outermost wrapper, the only
+            # object whose aclose() runs when a client disconnects before the first chunk.
+            releases = [upload_budget.release]
+            if admission is not None:
+                mode_for_api = mode_for_model(served_model)
+                with stage('admission_queue'):
+                    granted_at = await admission.acquire(mode_for_api, priority, queue_timeout)
+                releases.append(lambda: admission.release(mode_for_api, granted_at))
+            release_upload_budget = False
+            annotate(stream=True)
+            return Response(
+                finish_after_stream(body, timer, releases=releases),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        cache_key = None
+        cache_control = request.headers.get('Cache-Control', '').lower()
+        # A follow-up's prompt is only the new turn, so its key also names the thread it continues.
+        key_prompt = f"{thread.backend_uuid}\n{prompt_text}" if thread is not None else prompt_text
+        request_key = ResponseCache.make_key(model_id_with_prefix, key_prompt, files_to_pass,
+                                             SEARCH_LANGUAGE, SEARCH_SOURCES)
+        if response_cache is not None:
+            cache_key = request_key
+            if 'no-cache' in cache_control or 'no-store' in cache_control:
+                response_cache.stats["bypasses"] += 1
+            else:
+                cached_response = response_cache.get(cache_key)
+                if cached_response is not None:
+                    response = jsonify(cached_response)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+        if job_manager is not None and (background or mode_for_model(model_id_with_prefix) in BACKGROUND_MODES):
+            job_cache_key = cache_key if 'no-store' not in cache_control else None
+            try:
+                job = job_manager.submit(
+                    lambda: run_background_completion(prompt_text, model_id_with_prefix, files_to_pass,
+                                                      priority, job_cache_key, thread, on_answer,
+                                                      prompt_tokens),
+                    model_id_with_prefix,
+                    webhook_url=webhook_url,
+                    cleanup=upload_budget.release
+                )
+            except JobQueueFullError as e:
+                return jsonify({"error": {"message": str(e), "type": "rate_limit_error", "code": 429}}), 429
+            release_upload_budget = False
+            return jsonify(job.to_dict()), 202, {"Location": f"/v1/jobs/{job.id}"}
+
+        no_coalesce = request.headers.get('X-No-Coalesce', '').lower() in ('1', 'true', 'yes')
+        if single_flight is not None and not no_coalesce:
+            response_data = await single_flight.do(
+                request_key,
+                lambda: get_resilient_response(prompt_text, model_id_with_prefix, files_to_pass,
+                                              priority, queue_timeout, thread, on_answer)
+            )
+        else:
+            response_data = await get_resilient_response(prompt_text, model_id_with_prefix, files_to_pass,
+                                                        priority, queue_timeout, thread, on_answer)
 
         if isinstance(response_data, tuple):
-             return jsonify(response_data[0]), response_data[1]
+             return (jsonify(response_data[0]),) + response_data[1:]
         else:
              if isinstance(response_data, dict) and "model" not in response_data:
                  response_data["model"] = model_id_with_prefix
-             return jsonify(response_data)
-
-    except Exception as e:
-        print(f"Error in /v1/chat/completions: {e}")
-        import traceback
-        traceback.print_exc()
+             fill_usage(response_data, prompt_tokens)
+             with stage('serialization'):
+                 response = jsonify(response_data)
+             if cache_key is not None:
+                 if 'no-store' not in cache_control:
+                     response_cache.put(cache_key, response_data,
+                                        response_cache.ttl_for(model_id_with_prefix,
+                                                               mode_for_model(model_id_with_prefix)))
+                 response.headers['X-Cache'] = 'MISS'
+             return response
+
+    except AdmissionRejectedError as e:
+        error_body, status, headers = rejection(e)
+        return jsonify(error_body), status, headers
+    except PayloadTooLargeError as e:
+        log.info("Rejected upload in /v1/chat/completions", extra={"error": str(e)})
+        return jsonify({
+            "error": {"message": str(e), "type": "invalid_request_error", "code": 413}
+        }), 413
+    except Exception:
+        log.exception("Error in /v1/chat/completions")
         return jsonify({
             "error": {"message": "Internal Server Error",
                       "type": "internal_server_error"}
         }), 500
+    finally:
+        if release_upload_budget:
+            upload_budget.release()
+
+def jobs_disabled():
+    return jsonify({
+        "error": {"message": "Background jobs are disabled.", "type": "invalid_request_error", "code": 404}
+    }), 404
+
+
+def job_not_found(job_id):
+    return jsonify({
+        "error": {"message": f"No such job: '{job_id}'", "type": "invalid_request_error", "code": 404}
+    }), 404
+
+
+@app.route('/v1/jobs', methods=['GET'])
+@require_api_key
+async def list_jobs():
+    if job_manager is None:
+        return jobs_disabled()
+    return jsonify({"object": "list", "data": [job.to_dict() for job in await job_manager.list()]})
+
+
+@app.route('/v1/jobs/<job_id>', methods=['GET'])
+@require_api_key
+async def retrieve_job(job_id):
+    """
+    Returns a background job. With `?wait=<seconds>` the request is held until
+    the job finishes or the wait (capped at JOB_MAX_WAIT) runs out.
+    """
+    if job_manager is None:
+        return jobs_disabled()
+    job = await job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_MAX_WAIT)
+    except ValueError:
+        return jsonify({"error": "'wait' must be a number of seconds"}), 400
+    job = await job_manager.wait(job, wait)
+    return jsonify(job.to_dict())
+
+
+@app.route('/v1/jobs/<job_id>/cancel', methods=['POST'])
+@require_api_key
+async def cancel_job(job_id):
+    if job_manager is None:
+        return jobs_disabled()
+    job = await job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    job_manager.cancel(job)
+    job = await job_manager.wait(job, 5)
+    return jsonify(job.to_dict())
+
+
+def batches_disabled():
+    return jsonify({
+        "error": {"message": "The batch API is disabled.", "type": "invalid_request_error", "code": 404}
+    }), 404
+
+
+def batch_not_found(batch_id):
+    return jsonify({
+        "error": {"message": f"No such batch: '{batch_id}'", "type": "invalid_request_error", "code": 404}
+    }), 404
+
+
+@app.route('/v1/batches', methods=['POST'])
+@require_api_key
+async def create_batch():
+    """
+    Creates a batch from a JSONL file uploaded to /v1/files, in OpenAI's
+    batch format. Results become output/error files once it finishes.
+    """
+    if batch_manager is None:
+        return batches_disabled()
+    data = await request.get_json(silent=True) or {}
+    input_file_id = data.get("input_file_id")
+    stored = file_store.get(input_file_id) if input_file_id else None
+    if stored is None:
+        return file_not_found(input_file_id)
+    try:
+        input_data = await asyncio.to_thread(file_store.read, stored.digest)
+        batch = batch_manager.create(input_file_id, input_data,
+                                     data.get("endpoint", "/v1/chat/completions"),
+                                     data.get("completion_window", "24h"), data.get("metadata"))
+    except (BatchValidationError, UnicodeDecodeError) as e:
+        return jsonify({"error": {"message": str(e), "type": "invalid_request_error", "code": 400}}), 400
+    return jsonify(batch.to_dict())
+
+
+@app.route('/v1/batches', methods=['GET'])
+@require_api_key
+async def list_batches():
+    if batch_manager is None:
+        return batches_disabled()
+    return jsonify({"object": "list", "data": [batch.to_dict() for batch in batch_manager.list()]})
+
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+@require_api_key
+async def retrieve_batch(batch_id):
+    if batch_manager is None:
+        return batches_disabled()
+    batch = batch_manager.get(batch_id)
+    if batch is None:
+        return batch_not_found(batch_id)
+    return jsonify(batch.to_dict())
+
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+@require_api_key
+async def cancel_batch(batch_id):
+    if batch_manager is None:
+        return batches_disabled()
+    batch = batch_manager.get(batch_id)
+    if batch is None:
+        return batch_not_found(batch_id)
+    batch_manager.cancel(batch)
+    return jsonify(batch.to_dict())
+
 
 def parse_cookies_from_file(filepath):
     """Reads a file and extracts the cookies dictionary."""
@@ -349,8 +1415,7 @@ def parse_cookies_from_file(filepath):
             content = f.read()
         start_index = content.find('cookies = {')
         if start_index == -1:
-            print(f"Error: Could not find 'cookies = {{' string in file "
-                  f"{filepath}")
+            log.error("Could not find 'cookies = {' string in cookie file", extra={"path": filepath})
             return None
 
         dict_str = content[start_index + len('cookies = '):]
@@ -359,15 +1424,39 @@ def parse_cookies_from_file(filepath):
         if isinstance(cookies_dict, dict):
             return cookies_dict
         else:
-            print(f"Error: Failed to parse dictionary from file {filepath}")
+            log.error("Failed to parse cookie dictionary", extra={"path": filepath})
             return None
     except FileNotFoundError:
-        print(f"Error: Cookie file not found at {filepath}")
+        log.error("Cookie file not found", extra={"path": filepath})
         return None
     except Exception as e:
-        print(f"Error reading or parsing cookie file {filepath}: {e}")
+        log.error("Error reading or parsing cookie file", extra={"path": filepath, "error": str(e)})
         return None
 
+def load_accounts(paths):
+    """
+    Loads one cookies dictionary per account from files and/or directories.
+
+    Every regular file inside a given directory is treated as a cookie file.
+
+    Returns:
+        A list of (account_name, cookies_dict) tuples for the files that parsed.
+    """
+    accounts = []
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths = sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if not name.startswith('.') and os.path.isfile(os.path.join(path, name))
+            )
+        else:
+            filepaths = [path]
+        for filepath in filepaths:
+            cookies = parse_cookies_from_file(filepath)
+            if cookies:
+                accounts.append((os.path.basename(filepath), cookies))
+    return accounts
+
 def setup_models(prefix):
     """Generates lists of models and API parameters based on the given prefix."""
     global ALL_MODELS_WITH_PREFIX, MODEL_ID_TO_API_PARAMS_MAP, DEFAULT_MODEL_ID
@@ -375,6 +1464,7 @@ def setup_models(prefix):
 
     ALL_MODELS_WITH_PREFIX.clear()
     MODEL_ID_TO_API_PARAMS_MAP.clear()
+    ROUTED_MODELS.clear()
     DEFAULT_PREFIX = prefix
 
     for mode, model_list in PERPLEXITY_MODES_MODELS.items():
@@ -398,6 +1488,11 @@ def setup_models(prefix):
                 ALL_MODELS_WITH_PREFIX.append(final_id)
                 MODEL_ID_TO_API_PARAMS_MAP[final_id] = (mode, api_model_param)
 
+    for alias, modes in ROUTING_ALIASES.items():
+        candidates = [model_id for model_id in ALL_MODELS_WITH_PREFIX if MODEL_ID_TO_API_PARAMS_MAP[model_id][0] in modes]
+        if candidates:
+            ROUTED_MODELS[f"{DEFAULT_PREFIX}/{alias}"] = candidates
+
     DEFAULT_MODEL_ID = f"{DEFAULT_PREFIX}/auto"
     if DEFAULT_MODEL_ID not in MODEL_ID_TO_API_PARAMS_MAP:
         DEFAULT_MODEL_ID = next((k for k in MODEL_ID_TO_API_PARAMS_MAP if k.startswith(f"{DEFAULT_PREFIX}/auto")),
@@ -407,11 +1502,12 @@ def setup_models(prefix):
         DEFAULT_MODE_FOR_FALLBACK, DEFAULT_MODEL_FOR_FALLBACK = MODEL_ID_TO_API_PARAMS_MAP.get(DEFAULT_MODEL_ID, ('auto', None))
     else:
         DEFAULT_MODE_FOR_FALLBACK, DEFAULT_MODEL_FOR_FALLBACK = ('auto', None)
-        print("Warning: No models could be generated. Check PERPLEXITY_MODES_MODELS.")
+        log.warning("No models could be generated. Check PERPLEXITY_MODES_MODELS.")
 
-    print(f"Models setup complete. Default prefix: '{DEFAULT_PREFIX}'. Default model ID: '{DEFAULT_MODEL_ID}'")
+    log.info("Models setup complete", extra={"prefix": DEFAULT_PREFIX, "default_model": DEFAULT_MODEL_ID})
 
-if __name__ == "__main__":
+def build_parser():
+    """Returns the command-line parser; most options default to an environment variable."""
     parser = argparse.ArgumentParser(description="Run the Perplexity API server.")
 
     parser.add_argument(
@@ -435,6 +1531,56 @@ if __name__ == "__main__":
         help="Port to run the server on."
     )
 
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='0.0.0.0',
+        help="Interface to bind the server to."
+    )
+
+    parser.add_argument(
+        '--dev-server',
+        action='store_true',
+        default=False,
+        help="Use the Quart development server instead of Hypercorn (debugging only)."
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=int(os.environ.get("WORKERS", 1)),
+        help=("Worker processes serving requests; above 1 they share the port and keep account, "
+              "admission, conversation and job state in --state-dir (env WORKERS).")
+    )
+
+    parser.add_argument(
+        '--state-dir',
+        type=str,
+        default=os.environ.get("STATE_DIR", "state"),
+        help="Directory for the state shared by worker processes (env STATE_DIR)."
+    )
+
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=int(os.environ.get("POOL_SIZE", 4)),
+        help="Number of warm Perplexity client sessions kept in the pool (env POOL_SIZE)."
+    )
+
+    parser.add_argument(
+        '--pool-max-idle',
+        type=float,
+        default=float(os.environ.get("POOL_MAX_IDLE", 300)),
+        help="Seconds a pooled client may stay idle before it is recycled, 0 disables (env POOL_MAX_IDLE)."
+    )
+
+    parser.add_argument(
+        '--pool-max-age',
+        type=float,
+        default=float(os.environ.get("POOL_MAX_AGE", 1800)),
+        help="Seconds after which a pooled client is recycled, 0 disables (env POOL_MAX_AGE)."
+    )
+
     parser.add_argument(
         '--language',
         type=str,
@@ -459,55 +1605,622 @@ if __name__ == "__main__":
     parser.add_argument(
         '--cookies-file',
         type=str,
-        default='cookies.txt',
-        help=("Path to the file containing cookies "
-              "(format 'cookies = {...}'). Defaults to 'cookies.txt'.")
+        nargs='+',
+        default=['cookies.txt'],
+        help=("Path(s) to files containing cookies (format 'cookies = {...}'), "
+              "or directories of such files. Each file is one Perplexity account. "
+              "Defaults to 'cookies.txt'.")
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '--account-concurrency',
+        type=int,
+        default=int(os.environ.get("ACCOUNT_CONCURRENCY", 4)),
+        help="Maximum concurrent upstream requests per account, 0 for unlimited (env ACCOUNT_CONCURRENCY)."
+    )
+
+    parser.add_argument(
+        '--account-quota',
+        type=str,
+        default=os.environ.get("ACCOUNT_QUOTA", ""),
+        help=("Per-account request quotas per window for metered modes, "
+              "e.g. 'pro=300,reasoning=50,deep-research=5' (env ACCOUNT_QUOTA).")
+    )
+
+    parser.add_argument(
+        '--quota-window',
+        type=float,
+        default=float(os.environ.get("QUOTA_WINDOW", 86400)),
+        help="Length of the account quota window in seconds (env QUOTA_WINDOW)."
+    )
+
+    parser.add_argument(
+        '--account-cooldown',
+        type=float,
+        default=float(os.environ.get("ACCOUNT_COOLDOWN", 60)),
+        help="Base cooldown in seconds after an account is rate limited (env ACCOUNT_COOLDOWN)."
+    )
+
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        default=os.environ.get("RESPONSE_CACHE", "false").lower() == "true",
+        help="Enable the completion response cache (env RESPONSE_CACHE=true)."
+    )
+
+    parser.add_argument(
+        '--cache-max-entries',
+        type=int,
+        default=int(os.environ.get("CACHE_MAX_ENTRIES", 1000)),
+        help="Maximum number of cached responses (env CACHE_MAX_ENTRIES)."
+    )
+
+    parser.add_argument(
+        '--cache-max-bytes',
+        type=int,
+        default=int(os.environ.get("CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        help="Maximum total size of cached responses in bytes (env CACHE_MAX_BYTES)."
+    )
+
+    parser.add_argument(
+        '--cache-ttl',
+        type=str,
+        default=os.environ.get("CACHE_TTL", ""),
+        help=("TTL overrides in seconds by mode or model ID, e.g. "
+              "'auto=300,pro=3600,deep-research=86400' (env CACHE_TTL).")
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=os.environ.get("CACHE_DIR"),
+        help="Directory (or SQLite file) for a persistent cache tier that survives restarts (env CACHE_DIR)."
+    )
+
+    parser.add_argument(
+        '--coalesce-max-wait',
+        type=float,
+        default=float(os.environ.get("COALESCE_MAX_WAIT", 300)),
+        help=("Seconds a request waits for an identical in-flight request before making "
+              "its own upstream call; 0 disables coalescing (env COALESCE_MAX_WAIT).")
+    )
+
+    parser.add_argument(
+        '--max-file-bytes',
+        type=int,
+        default=int(os.environ.get("MAX_FILE_BYTES", MAX_FILE_BYTES)),
+        help="Largest accepted single attachment in bytes, 0 for unlimited (env MAX_FILE_BYTES)."
+    )
+
+    parser.add_argument(
+        '--max-request-file-bytes',
+        type=int,
+        default=int(os.environ.get("MAX_REQUEST_FILE_BYTES", MAX_REQUEST_FILE_BYTES)),
+        help="Largest total of attachments per request in bytes, 0 for unlimited (env MAX_REQUEST_FILE_BYTES)."
+    )
+
+    parser.add_argument(
+        '--max-inflight-upload-bytes',
+        type=int,
+        default=int(os.environ.get("MAX_INFLIGHT_UPLOAD_BYTES", upload_bytes_in_flight.limit)),
+        help=("Upload bytes all in-flight requests may hold together before new ones get 413, "
+              "0 for unlimited (env MAX_INFLIGHT_UPLOAD_BYTES).")
+    )
+
+    parser.add_argument(
+        '--upload-spool-threshold',
+        type=int,
+        default=int(os.environ.get("UPLOAD_SPOOL_THRESHOLD", UPLOAD_SPOOL_THRESHOLD)),
+        help="Multipart uploads above this many bytes are spooled to a temp file (env UPLOAD_SPOOL_THRESHOLD)."
+    )
+
+    parser.add_argument(
+        '--file-store-dir',
+        type=str,
+        default=os.environ.get("FILE_STORE_DIR", "file_store"),
+        help=("Directory of the content-addressed attachment store behind /v1/files; "
+              "empty string disables it (env FILE_STORE_DIR).")
+    )
+
+    parser.add_argument(
+        '--file-store-max-bytes',
+        type=int,
+        default=int(os.environ.get("FILE_STORE_MAX_BYTES", 1024 * 1024 * 1024)),
+        help="Size of the attachment store before least-recently-used files are evicted (env FILE_STORE_MAX_BYTES)."
+    )
+
+    parser.add_argument(
+        '--upload-reuse-ttl',
+        type=float,
+        default=float(os.environ.get("UPLOAD_REUSE_TTL", 3600)),
+        help=("Seconds an attachment uploaded to Perplexity is reused by URL instead of "
+              "being uploaded again, 0 disables (env UPLOAD_REUSE_TTL).")
+    )
+
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default=os.environ.get("LOG_LEVEL", "INFO"),
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'debug', 'info', 'warning', 'error'],
+        help="Log level (env LOG_LEVEL)."
+    )
+
+    parser.add_argument(
+        '--log-format',
+        type=str,
+        default=os.environ.get("LOG_FORMAT", "text"),
+        choices=['text', 'json'],
+        help="Log line format: human-readable text or one JSON object per line (env LOG_FORMAT)."
+    )
+
+    parser.add_argument(
+        '--server-timing',
+        action='store_true',
+        default=os.environ.get("SERVER_TIMING", "false").lower() == "true",
+        help="Add a Server-Timing header with per-stage durations to chat completions (env SERVER_TIMING=true)."
+    )
+
+    parser.add_argument(
+        '--slow-requests',
+        type=int,
+        default=int(os.environ.get("SLOW_REQUESTS", 20)),
+        help="Slowest recent requests kept per model for GET /admin/slow-requests, 0 to disable (env SLOW_REQUESTS)."
+    )
+
+    parser.add_argument(
+        '--slow-request-window',
+        type=float,
+        default=float(os.environ.get("SLOW_REQUEST_WINDOW", 3600)),
+        help="Seconds a request stays in the slow-request log (env SLOW_REQUEST_WINDOW)."
+    )
+
+    parser.add_argument(
+        '--max-concurrency',
+        type=int,
+        default=int(os.environ.get("MAX_CONCURRENCY", admission.max_concurrency)),
+        help="Upstream searches allowed at once across all accounts, 0 for unlimited (env MAX_CONCURRENCY)."
+    )
+
+    parser.add_argument(
+        '--mode-concurrency',
+        type=str,
+        default=os.environ.get("MODE_CONCURRENCY", ""),
+        help="Per-mode concurrency limits, e.g. 'pro=16,reasoning=8,deep-research=2' (env MODE_CONCURRENCY)."
+    )
+
+    parser.add_argument(
+        '--max-queue',
+        type=int,
+        default=int(os.environ.get("MAX_QUEUE", admission.max_queue)),
+        help="Requests that may wait for an upstream slot before new ones get 429 (env MAX_QUEUE)."
+    )
+
+    parser.add_argument(
+        '--queue-timeout',
+        type=float,
+        default=float(os.environ.get("QUEUE_TIMEOUT", admission.queue_timeout)),
+        help="Seconds a request waits for an upstream slot before it gets 429 (env QUEUE_TIMEOUT)."
+    )
+
+    parser.add_argument(
+        '--api-key-priority',
+        type=str,
+        default=os.environ.get("API_KEY_PRIORITIES", ""),
+        help=("Additional API keys with their queue priority and optional queue timeout, "
+              "e.g. 'interactive-key=10,batch-key=-5:600' (env API_KEY_PRIORITIES).")
+    )
+
+    parser.add_argument(
+        '--job-workers',
+        type=int,
+        default=int(os.environ.get("JOB_WORKERS", job_manager.workers)),
+        help="Background jobs executed at once, 0 disables the job API (env JOB_WORKERS)."
+    )
+
+    parser.add_argument(
+        '--job-max-pending',
+        type=int,
+        default=int(os.environ.get("JOB_MAX_PENDING", job_manager.max_pending)),
+        help="Background jobs that may wait for a worker before new ones get 429 (env JOB_MAX_PENDING)."
+    )
+
+    parser.add_argument(
+        '--job-retention',
+        type=float,
+        default=float(os.environ.get("JOB_RETENTION", job_manager.retention)),
+        help="Seconds finished jobs and their results are kept for polling (env JOB_RETENTION)."
+    )
+
+    parser.add_argument(
+        '--background-modes',
+        type=str,
+        default=os.environ.get("BACKGROUND_MODES", ""),
+        help=("Comma-separated modes whose non-streaming requests always run as background jobs, "
+              "e.g. 'deep-research' (env BACKGROUND_MODES).")
+    )
+
+    parser.add_argument(
+        '--webhook-secret',
+        type=str,
+        default=os.environ.get("WEBHOOK_SECRET"),
+        help="Signs job webhook bodies with HMAC-SHA256 in an X-Signature header (env WEBHOOK_SECRET)."
+    )
+
+    parser.add_argument(
+        '--webhook-allowed-hosts',
+        type=str,
+        default=os.environ.get("WEBHOOK_ALLOWED_HOSTS", ""),
+        help=("Comma-separated webhook hosts that may resolve to loopback or private addresses; "
+              "others must be public (env WEBHOOK_ALLOWED_HOSTS).")
+    )
+
+    parser.add_argument(
+        '--conversation-index-size',
+        type=int,
+        default=int(os.environ.get("CONVERSATION_INDEX_SIZE", conversation_index.max_entries)),
+        help=("Conversations remembered for continuing them as upstream follow-ups, "
+              "0 disables (env CONVERSATION_INDEX_SIZE).")
+    )
+
+    parser.add_argument(
+        '--conversation-ttl',
+        type=float,
+        default=float(os.environ.get("CONVERSATION_TTL", conversation_index.ttl)),
+        help="Seconds an upstream thread is offered for follow-ups (env CONVERSATION_TTL)."
+    )
+
+    parser.add_argument(
+        '--batch-dir',
+        type=str,
+        default=os.environ.get("BATCH_DIR", "batches"),
+        help=("Directory for /v1/batches state and results; empty string disables the batch API. "
+              "Needs the file store (env BATCH_DIR).")
+    )
+
+    parser.add_argument(
+        '--batch-concurrency',
+        type=int,
+        default=int(os.environ.get("BATCH_CONCURRENCY", 4)),
+        help="Batch requests executed at once (env BATCH_CONCURRENCY)."
+    )
+
+    parser.add_argument(
+        '--batch-account-interval',
+        type=float,
+        default=float(os.environ.get("BATCH_ACCOUNT_INTERVAL", 1.0)),
+        help="Minimum seconds between batch requests on the same account, 0 disables pacing (env BATCH_ACCOUNT_INTERVAL)."
+    )
+
+    parser.add_argument(
+        '--batch-max-attempts',
+        type=int,
+        default=int(os.environ.get("BATCH_MAX_ATTEMPTS", 3)),
+        help="Attempts per batch request on 429/502/503 errors (env BATCH_MAX_ATTEMPTS)."
+    )
+
+    parser.add_argument(
+        '--fallback-models',
+        type=str,
+        default=os.environ.get("FALLBACK_MODELS", ""),
+        help=("Comma-separated fallback chains, e.g. 'pro-gpt-4.5>pro-sonar>auto' "
+              "(env FALLBACK_MODELS).")
+    )
+
+    parser.add_argument(
+        '--circuit-failures',
+        type=int,
+        default=int(os.environ.get("CIRCUIT_FAILURES", circuit_breaker.failures)),
+        help="Upstream errors within --circuit-window that open a model's circuit, 0 disables (env CIRCUIT_FAILURES)."
+    )
+
+    parser.add_argument(
+        '--circuit-window',
+        type=float,
+        default=float(os.environ.get("CIRCUIT_WINDOW", circuit_breaker.window)),
+        help="Seconds over which upstream errors are counted (env CIRCUIT_WINDOW)."
+    )
+
+    parser.add_argument(
+        '--circuit-open-seconds',
+        type=float,
+        default=float(os.environ.get("CIRCUIT_OPEN_SECONDS", circuit_breaker.open_for)),
+        help="Seconds an open circuit skips its model before a trial request (env CIRCUIT_OPEN_SECONDS)."
+    )
+
+    parser.add_argument(
+        '--hedge-modes',
+        type=str,
+        default=os.environ.get("HEDGE_MODES", ""),
+        help=("Comma-separated modes whose slow requests are hedged on a second account, "
+              "e.g. 'auto'; each hedge costs an extra query (env HEDGE_MODES).")
+    )
+
+    parser.add_argument(
+        '--hedge-quantile',
+        type=float,
+        default=float(os.environ.get("HEDGE_QUANTILE", HEDGE_QUANTILE)),
+        help="Latency quantile of the model after which a request is hedged (env HEDGE_QUANTILE)."
+    )
+
+    parser.add_argument(
+        '--hedge-min-delay',
+        type=float,
+        default=float(os.environ.get("HEDGE_MIN_DELAY", HEDGE_MIN_DELAY)),
+        help="Never hedge before this many seconds (env HEDGE_MIN_DELAY)."
+    )
+
+    parser.add_argument(
+        '--routing-half-life',
+        type=float,
+        default=float(os.environ.get("ROUTING_HALF_LIFE", latency_router.half_life)),
+        help="Seconds after which a latency sample counts half as much for 'fastest' routing (env ROUTING_HALF_LIFE)."
+    )
+
+    parser.add_argument(
+        '--routing-explore',
+        type=float,
+        default=float(os.environ.get("ROUTING_EXPLORE", latency_router.explore)),
+        help="Share of 'fastest' requests sent to a random candidate model (env ROUTING_EXPLORE)."
+    )
+
+    parser.add_argument(
+        '--tokenizer',
+        type=str,
+        default=os.environ.get("TOKENIZER", token_counter.encoding),
+        help=("Token counting for usage and prompt budgets: 'approx' (built-in estimate) or a tiktoken "
+              "encoding such as 'o200k_base', which needs the tiktoken package (env TOKENIZER).")
+    )
+
+    parser.add_argument(
+        '--prompt-token-budget',
+        type=str,
+        default=os.environ.get("PROMPT_TOKEN_BUDGET", ""),
+        help=("Prompt token budgets by mode or model ID, e.g. 'auto=8000,pro=16000'; older messages "
+              "beyond the budget are left out (env PROMPT_TOKEN_BUDGET).")
+    )
+
+    parser.add_argument(
+        '--backend',
+        type=str,
+        default=os.environ.get("BACKEND", "perplexity"),
+        choices=BACKEND_NAMES,
+        help="Upstream backend: perplexity.ai, or an offline fake for benchmarks (env BACKEND)."
+    )
+
+    parser.add_argument(
+        '--fake-backend',
+        type=str,
+        default=os.environ.get("FAKE_BACKEND", ""),
+        help=("Fake backend settings, e.g. 'latency_scale=0.01,error_rate=0.02,chunks=24' "
+              "(env FAKE_BACKEND).")
+    )
+
+    return parser
+
+
+def configure(args, parser, worker_index=0):
+    """
+    Sets up the gateway's module-level state from parsed command-line options.
+
+    Runs once per process: in the server process, or in each worker right
+    after it is forked, so no worker inherits open connections or event loop
+    objects from its parent.
+
+    Args:
+        args: Options from build_parser().
+        parser: The parser, for reporting invalid option values.
+        worker_index: Index of this worker process (0 runs the batches).
+    """
+    global SEARCH_SOURCES, SEARCH_LANGUAGE, SEARCH_INCOGNITO, EXPECTED_API_KEY, API_KEY_PRIORITIES
+    global MAX_FILE_BYTES, MAX_REQUEST_FILE_BYTES, UPLOAD_SPOOL_THRESHOLD
+    global BACKGROUND_MODES, FALLBACK_CHAINS, HEDGE_MODES, HEDGE_QUANTILE, HEDGE_MIN_DELAY, PROMPT_BUDGETS
+    global perplexity_accounts, client_factory, account_pool, file_store, single_flight, job_manager
+    global circuit_breaker, latency_router, token_counter, batch_manager, conversation_index
+    global admission, response_cache, shared_state, SERVER_TIMING
+
+    if args.workers > 1:
+        shared_state = SharedState(os.path.join(args.state_dir, SHARED_STATE_FILE))
 
     effective_prefix = args.prefix if args.prefix else "perplexity-chat"
 
+    if args.slow_requests < 0 or args.slow_request_window <= 0:
+        parser.error("--slow-requests must be >= 0 and --slow-request-window > 0")
+    SERVER_TIMING = args.server_timing
+    slow_requests.size = args.slow_requests
+    slow_requests.window = args.slow_request_window
+
+    SEARCH_SOURCES = args.sources
+    SEARCH_LANGUAGE = args.language
+    SEARCH_INCOGNITO = args.incognito
+
     setup_models(effective_prefix)
 
-    print("\n--- Startup Parameters ---")
-    print(f"Port: {args.port}")
-    print(f"API Prefix: {DEFAULT_PREFIX}")
-    print(f"Sources: {args.sources}")
-    print(f"Language: {args.language}")
-    print(f"Incognito Mode: {args.incognito}")
-    api_key_status = ('Yes' if EXPECTED_API_KEY != 'your-secret-api-key'
-                      else 'No (default placeholder)')
-    print(f"API Key Used: {api_key_status}")
-    print(f"Cookie File Path: {args.cookies_file}")
-    if DEFAULT_MODE_FOR_FALLBACK != 'auto':
-        print(f"Loaded {len(MODEL_ID_TO_API_PARAMS_MAP) - 1} cookies.")
+    EXPECTED_API_KEY = args.api_key or os.environ.get("PPLX_OPENAI_KEY", "your-secret-api-key")
+    if EXPECTED_API_KEY == "your-secret-api-key":
+        log.warning("PPLX_OPENAI_KEY is not set in environment and --api-key was not provided. "
+                    "Using default placeholder key.")
+
+    log.info("Startup parameters", extra={
+        "host": args.host, "port": args.port, "prefix": DEFAULT_PREFIX, "sources": args.sources,
+        "language": args.language, "incognito": args.incognito,
+        "cookie_files": args.cookies_file})
+
+    perplexity_accounts = load_accounts(args.cookies_file)
+
+    if perplexity_accounts:
+         log.info("Cookies loaded", extra={"accounts": [name for name, _ in perplexity_accounts]})
+    elif args.cookies_file == ['cookies.txt']:
+         log.warning("Could not load cookies from the default file 'cookies.txt'. Ensure it exists next "
+                     "to the script in the format 'cookies = {...}', or pass --cookies-file. "
+                     "Running without cookies.")
     else:
-        print("Cookies not loaded from file.")
-    print("--------------------------\n")
+         log.warning("Could not load cookies from the specified path(s); running without cookies.",
+                     extra={"cookie_files": args.cookies_file})
 
-    EXPECTED_API_KEY = args.api_key or os.environ.get("PPLX_OPENAI_KEY", "your-secret-api-key")
-    if EXPECTED_API_KEY == "your-secret-api-key" and not args.api_key:
-        print("Warning: PPLX_OPENAI_KEY is not set in environment and "
-              "--api-key was not provided. Using default placeholder key.")
+    client_factory = make_client_factory(args.backend, args.fake_backend)
+    if args.backend != 'perplexity':
+        log.warning("Using a non-Perplexity backend", extra={"backend": args.backend, "options": args.fake_backend})
+
+    try:
+        quotas = parse_quota_spec(args.account_quota)
+    except ValueError as e:
+        parser.error(f"--account-quota: {e}")
+    account_pool = AccountPool.from_cookies(
+        perplexity_accounts or [("anonymous", None)],
+        max_concurrency=args.account_concurrency,
+        quotas=quotas,
+        quota_window=args.quota_window,
+        cooldown=args.account_cooldown,
+        size=args.pool_size,
+        max_idle=args.pool_max_idle,
+        max_age=args.pool_max_age,
+        client_factory=client_factory,
+        shared=shared_state
+    )
+    log.info("Client pool per account", extra={
+        "size": args.pool_size, "max_idle": args.pool_max_idle, "max_age": args.pool_max_age,
+        "max_concurrency": args.account_concurrency})
+
+    MAX_FILE_BYTES = args.max_file_bytes
+    MAX_REQUEST_FILE_BYTES = args.max_request_file_bytes
+    UPLOAD_SPOOL_THRESHOLD = args.upload_spool_threshold
+    upload_bytes_in_flight.limit = args.max_inflight_upload_bytes
+    app.config['MAX_CONTENT_LENGTH'] = (max_body_bytes(MAX_REQUEST_FILE_BYTES)
+                                        if MAX_REQUEST_FILE_BYTES else None)
+
+    if args.file_store_dir:
+        file_store = FileStore(args.file_store_dir, max_bytes=args.file_store_max_bytes,
+                               shared=shared_state is not None)
+        log.info("File store enabled", extra={
+            "dir": args.file_store_dir, "files": len(file_store.list()), "max_bytes": args.file_store_max_bytes})
+    upstream_uploads.ttl = args.upload_reuse_ttl
+
+    single_flight = SingleFlight(max_wait=args.coalesce_max_wait) if args.coalesce_max_wait > 0 else None
+
+    if args.job_workers > 0:
+        job_manager = JobManager(workers=args.job_workers, max_pending=args.job_max_pending,
+                                 retention=args.job_retention, webhook_secret=args.webhook_secret,
+                                 webhook_allowed_hosts=[host.strip() for host in args.webhook_allowed_hosts.split(',')
+                                                        if host.strip()],
+                                 shared=shared_state)
+    else:
+        job_manager = None
+    BACKGROUND_MODES = {mode.strip().replace('-', ' ') for mode in args.background_modes.split(',') if mode.strip()}
+    if BACKGROUND_MODES - set(PERPLEXITY_MODES_MODELS):
+        parser.error(f"--background-modes: unknown mode(s) {sorted(BACKGROUND_MODES - set(PERPLEXITY_MODES_MODELS))}")
+
+    try:
+        FALLBACK_CHAINS = parse_fallback_chains(args.fallback_models, MODEL_ID_TO_API_PARAMS_MAP, DEFAULT_PREFIX)
+    except ValueError as e:
+        parser.error(f"--fallback-models: {e}")
+    circuit_breaker = CircuitBreaker(failures=args.circuit_failures, window=args.circuit_window,
+                                     open_for=args.circuit_open_seconds)
+    HEDGE_MODES = {mode.strip().replace('-', ' ') for mode in args.hedge_modes.split(',') if mode.strip()}
+    if HEDGE_MODES - set(PERPLEXITY_MODES_MODELS):
+        parser.error(f"--hedge-modes: unknown mode(s) {sorted(HEDGE_MODES - set(PERPLEXITY_MODES_MODELS))}")
+    HEDGE_QUANTILE = args.hedge_quantile
+    HEDGE_MIN_DELAY = args.hedge_min_delay
+    latency_router = LatencyRouter(half_life=args.routing_half_life, explore=args.routing_explore)
+
+    try:
+        token_counter = TokenCounter(args.tokenizer)
+    except ImportError:
+        parser.error("--tokenizer: tiktoken encodings need the tiktoken package (pip install tiktoken)")
+    except ValueError as e:
+        parser.error(f"--tokenizer: {e}")
+    try:
+        PROMPT_BUDGETS = parse_budget_spec(args.prompt_token_budget)
+    except ValueError as e:
+        parser.error(f"--prompt-token-budget: {e}")
+    if PROMPT_BUDGETS:
+        log.info("Prompt token budgets", extra={"budgets": PROMPT_BUDGETS, "tokenizer": args.tokenizer})
+    if FALLBACK_CHAINS or HEDGE_MODES:
+        log.info("Upstream resilience", extra={
+            "fallback_chains": {model: chain[1:] for model, chain in FALLBACK_CHAINS.items()},
+            "hedge_modes": sorted(HEDGE_MODES), "circuit_failures": args.circuit_failures})
+
+    if args.batch_dir and file_store is not None:
+        batch_manager = BatchManager(args.batch_dir, run_batch_line, publish_batch_file,
+                                     concurrency=args.batch_concurrency, max_attempts=args.batch_max_attempts,
+                                     account_interval=args.batch_account_interval,
+                                     leader=worker_index == 0, shared=shared_state is not None)
+        log.info("Batch API enabled", extra={
+            "dir": args.batch_dir, "concurrency": args.batch_concurrency,
+            "account_interval": args.batch_account_interval})
+    elif args.batch_dir:
+        log.warning("The batch API needs the file store (--file-store-dir); batches are disabled.")
+
+    if args.conversation_index_size > 0:
+        conversation_index = ConversationIndex(max_entries=args.conversation_index_size, ttl=args.conversation_ttl,
+                                               shared=shared_state)
+    else:
+        conversation_index = None
+
+    try:
+        API_KEY_PRIORITIES = parse_key_priorities(args.api_key_priority)
+    except ValueError as e:
+        parser.error(f"--api-key-priority: {e}")
+    try:
+        mode_limits = parse_mode_limits(args.mode_concurrency, PERPLEXITY_MODES_MODELS)
+    except ValueError as e:
+        parser.error(f"--mode-concurrency: {e}")
+    if args.max_concurrency or mode_limits:
+        admission = AdmissionController(max_concurrency=args.max_concurrency, mode_limits=mode_limits,
+                                        max_queue=args.max_queue, queue_timeout=args.queue_timeout,
+                                        shared=shared_state)
+        log.info("Admission control", extra={
+            "max_concurrency": args.max_concurrency, "mode_limits": mode_limits,
+            "max_queue": args.max_queue, "queue_timeout": args.queue_timeout,
+            "priority_keys": len(API_KEY_PRIORITIES)})
+    else:
+        admission = None
+
+    if args.cache:
+        try:
+            cache_ttls = parse_ttl_spec(args.cache_ttl)
+        except ValueError as e:
+            parser.error(f"--cache-ttl: {e}")
+        # Workers share hits through the disk tier; their memory tiers are separate.
+        cache_dir = args.cache_dir or (args.state_dir if shared_state is not None else None)
+        response_cache = ResponseCache(
+            max_entries=args.cache_max_entries,
+            max_bytes=args.cache_max_bytes,
+            ttls=cache_ttls,
+            disk_path=cache_dir
+        )
+        log.info("Response cache enabled", extra={
+            "max_entries": args.cache_max_entries, "max_bytes": args.cache_max_bytes,
+            "disk": cache_dir or 'off'})
+
+
+def run_server(bind):
+    """Serves the configured app with Hypercorn on `bind` (e.g. '0.0.0.0:5010' or 'fd://3')."""
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.bind = [bind]
+    # Route Hypercorn's access and error logs through the gateway's log format.
+    hypercorn_config.accesslog = logging.getLogger("hypercorn.access")
+    hypercorn_config.errorlog = logging.getLogger("hypercorn.error")
+    log.info("Starting ASGI server (Hypercorn)", extra={"bind": bind})
+    asyncio.run(serve(app, hypercorn_config))
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_format)
+
+    if args.workers > 1 and not args.dev_server:
+        def run_worker(index, sock):
+            configure(args, parser, worker_index=index)
+            run_server(f"fd://{sock.fileno()}")
 
-    perplexity_cookies = None
-    print(f"Attempting to load cookies from: {args.cookies_file}")
-    perplexity_cookies = parse_cookies_from_file(args.cookies_file)
+        log.info("Starting worker processes", extra={
+            "workers": args.workers, "bind": f"{args.host}:{args.port}", "state_dir": args.state_dir})
+        supervisor = Supervisor(args.workers, run_worker, os.path.join(args.state_dir, SHARED_STATE_FILE))
+        sys.exit(supervisor.run(bind_socket(args.host, args.port)))
 
-    if perplexity_cookies:
-         print("Cookies loaded successfully.")
+    configure(args, parser)
+    if args.dev_server:
+        app.run(host=args.host, port=args.port, debug=False)
     else:
-         if args.cookies_file == 'cookies.txt':
-             print(f"Could not load cookies from the default file "
-                   f"'{args.cookies_file}'.")
-             print("Ensure the file exists in the same directory as the script "
-                   "and has the correct format ('cookies = {...}').")
-             print("Or specify a different path using --cookies-file.")
-         else:
-
-             print(f"Could not load cookies from the specified file "
-                   f"'{args.cookies_file}'.")
-         print("Running without cookies loaded from file.")
-
-    app.run(host='0.0.0.0', port=args.port, debug=False)
+        run_server(f"{args.host}:{args.port}")
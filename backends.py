@@ -0,0 +1,29 @@
+import perplexity_async
+
+from fake_backend import FakePerplexityClient, FakeBackendSettings
+
+BACKEND_NAMES = ('perplexity', 'fake')
+
+
+def make_client_factory(name, options=''):
+    """
+    Returns the awaitable client factory the client pools build upstream clients with.
+
+    Every backend produces objects with perplexity_async.Client's search()
+    signature and return shapes, so the rest of the gateway does not care
+    which one it is talking to.
+
+    Args:
+        name: 'perplexity' for perplexity.ai, or 'fake' for the offline FakePerplexityClient.
+        options: Backend options; for 'fake' a FakeBackendSettings spec such as
+            'latency_scale=0.01,error_rate=0.02'.
+
+    Returns:
+        A callable taking a cookies dictionary (or None) and returning an awaitable client.
+    """
+    if name == 'perplexity':
+        return perplexity_async.Client
+    if name == 'fake':
+        settings = FakeBackendSettings.from_spec(options)
+        return lambda cookies: FakePerplexityClient(cookies, settings)
+    raise ValueError(f"Unknown backend '{name}' (expected one of {', '.join(BACKEND_NAMES)})")
@@ -0,0 +1,455 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+BATCH_ID_PREFIX = "batch_"
+BATCH_ENDPOINTS = ('/v1/chat/completions',)
+RETRYABLE_STATUS_CODES = (429, 502, 503)
+FINISHED_STATES = ('completed', 'failed', 'cancelled', 'expired')
+# Supported completion windows in seconds (OpenAI accepts only "24h" as well).
+COMPLETION_WINDOWS = {'24h': 24 * 3600}
+
+
+class BatchValidationError(Exception):
+    """Raised when a batch input file is not valid batch JSONL."""
+
+
+def parse_batch_input(data, endpoint):
+    """
+    Parses a batch input file: one JSON request per line.
+
+    Each line needs a unique `custom_id`, `method` POST, `url` equal to the
+    batch's endpoint and a `body` with `messages`.
+
+    Returns:
+        A list of (custom_id, body) pairs in file order.
+
+    Raises:
+        BatchValidationError: A line is malformed.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    requests = []
+    seen = set()
+    for line_number, line in enumerate(data.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as e:
+            raise BatchValidationError(f"Line {line_number}: invalid JSON ({e})")
+        custom_id = entry.get('custom_id') if isinstance(entry, dict) else None
+        if not isinstance(custom_id, str) or not custom_id:
+            raise BatchValidationError(f"Line {line_number}: missing 'custom_id'")
+        if custom_id in seen:
+            raise BatchValidationError(f"Line {line_number}: duplicate custom_id '{custom_id}'")
+        if str(entry.get('method', 'POST')).upper() != 'POST' or entry.get('url') != endpoint:
+            raise BatchValidationError(f"Line {line_number}: expected a POST to {endpoint}")
+        body = entry.get('body')
+        if not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+            raise BatchValidationError(f"Line {line_number}: 'body' needs a 'messages' list")
+        seen.add(custom_id)
+        requests.append((custom_id, body))
+    if not requests:
+        raise BatchValidationError("The input file contains no requests")
+    return requests
+
+
+class AccountPacer:
+    """Spaces batch requests out per account: one every `interval` seconds on each."""
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self._next_at = {}
+
+    async def wait(self, names):
+        """
+        Waits for the earliest free pacing slot among `names`.
+
+        Returns:
+            The account name the slot belongs to, or None when pacing is off
+            (or no account is eligible) and the pool should choose.
+        """
+        if not self.interval or not names:
+            return None
+        now = time.monotonic()
+        name = min(names, key=lambda n: self._next_at.get(n, 0.0))
+        slot = max(now, self._next_at.get(name, 0.0))
+        self._next_at[name] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        return name
+
+
+def _read_results(path):
+    """
+    Returns the custom_ids recorded in a result JSONL file.
+
+    A torn last line from a crash mid-write is cut off so appends continue cleanly.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    good_bytes = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(json.loads(line)['custom_id'])
+            except (ValueError, KeyError, TypeError):
+                break
+            good_bytes += len(line)
+    if good_bytes != os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(good_bytes)
+    return done
+
+
+class Batch:
+    """One batch: its OpenAI-style metadata plus the files in its directory."""
+
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.meta = meta
+        self.done = set()
+        self._cancel = asyncio.Event()
+
+    @property
+    def id(self):
+        return self.meta['id']
+
+    @property
+    def status(self):
+        return self.meta['status']
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self):
+        """Writes batch.json atomically, so a crash never leaves it half-written."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.meta, f)
+            os.replace(tmp_path, self.path('batch.json'))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def set_status(self, status):
+        self.meta['status'] = status
+        self.meta[f"{status}_at"] = int(time.time())
+        self.save()
+
+    def to_dict(self):
+        return dict(self.meta)
+
+
+class BatchManager:
+    """
+    Runs OpenAI-style batches of chat completions.
+
+    A batch copies its validated input JSONL into its own directory and runs
+    one batch at a time, `concurrency` lines at once. Every finished line is
+    appended to output.jsonl (successes) or errors.jsonl (final failures)
+    straight away; those files double as the checkpoint, so after a restart
+    unfinished batches resume with the lines that have no result yet. Lines
+    that fail with 429/502/503 are retried with backoff up to `max_attempts`.
+    A batch still unfinished at its `expires_at` (creation plus the
+    completion window) is stopped, lines in progress included, and moves to
+    `expired` with the results it has so far. Finished result files are published through `publish(batch, kind, data)`,
+    which returns the file ID clients download them by.
+
+    Several worker processes can share one directory: the `leader` runs
+    every batch and picks up batches and cancellations that the other
+    workers record on disk; the others only write and read those files.
+    """
+
+    def __init__(self, directory, run_line, publish, concurrency=4, max_attempts=3, max_backoff=60,
+                 account_interval=0.0, leader=True, shared=False, watch_interval=1.0):
+        """
+        Args:
+            directory: Where batch state and results are kept.
+            run_line: Coroutine function taking a request body and returning a
+                completion dict or a tuple (error_dict, status_code[, headers]).
+            publish: Callable(batch, kind, data) storing a finished 'output' or
+                'error' file and returning its file ID.
+            concurrency: Batch lines executed at the same time.
+            max_attempts: Attempts per line before a retryable error is final.
+            max_backoff: Upper bound in seconds on the wait before a retry.
+            account_interval: Minimum seconds between batch requests on one account (see AccountPacer).
+            leader: Whether this process runs batches (False for the other workers).
+            shared: Whether other worker processes use the directory too.
+            watch_interval: Seconds between the leader's scans for other workers' changes.
+        """
+        self.directory = directory
+        self.run_line = run_line
+        self.publish = publish
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.pacer = AccountPacer(account_interval)
+        self.leader = leader
+        self.shared = shared or not leader
+        self.watch_interval = watch_interval
+        self._batches = {}
+        self._queue = None
+        self._runner = None
+        self._watcher = None
+        self.stats = {"lines_succeeded": 0, "lines_failed": 0, "retries": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _load(self, name):
+        batch_dir = os.path.join(self.directory, name)
+        try:
+            with open(os.path.join(batch_dir, 'batch.json'), 'r', encoding='utf-8') as f:
+                return Batch(batch_dir, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def _adopt(self, batch):
+        self._batches[batch.id] = batch
+        if batch.status not in FINISHED_STATES:
+            if batch.status == 'cancelling':
+                batch._cancel.set()
+            self._queue.put_nowait(batch)
+
+    async def start(self):
+        """Loads stored batches and resumes those that had not finished."""
+        if not self.leader:
+            return
+        self._queue = asyncio.Queue()
+        for name in sorted(os.listdir(self.directory)):
+            batch = self._load(name)
+            if batch is not None:
+                if batch.status not in FINISHED_STATES:
+                    log.info("Resuming batch", extra={"batch_id": batch.id, "status": batch.status})
+                self._adopt(batch)
+        self._runner = asyncio.create_task(self._run())
+        if self.shared:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def close(self):
+        for task in (self._runner, self._watcher):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._runner = self._watcher = None
+
+    async def _watch(self):
+        """Picks up batches created, and cancellations requested, by other workers."""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            for name in os.listdir(self.directory):
+                batch = self._batches.get(name)
+                if batch is None:
+                    batch = self._load(name)
+                    if batch is not None:
+                        self._adopt(batch)
+                elif os.path.exists(batch.path('cancel')):
+                    os.remove(batch.path('cancel'))
+                    self.cancel(batch)
+
+    def create(self, input_file_id, input_data, endpoint, completion_window='24h', metadata=None):
+        """
+        Validates `input_data` and queues it as a new batch.
+
+        Raises:
+            BatchValidationError: The endpoint or completion window is unsupported,
+                or the input is malformed.
+        """
+        if endpoint not in BATCH_ENDPOINTS:
+            raise BatchValidationError(f"Unsupported endpoint '{endpoint}' (expected one of {BATCH_ENDPOINTS})")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise BatchValidationError(f"Unsupported completion_window '{completion_window}' "
+                                       f"(expected one of {tuple(COMPLETION_WINDOWS)})")
+        requests = parse_batch_input(input_data, endpoint)
+        batch_id = BATCH_ID_PREFIX + uuid.uuid4().hex
+        batch_dir = os.path.join(self.directory, batch_id)
+        os.makedirs(batch_dir)
+        with open(os.path.join(batch_dir, 'input.jsonl'), 'w', encoding='utf-8') as f:
+            for custom_id, body in requests:
+                f.write(json.dumps({"custom_id": custom_id, "body": body}) + "\n")
+        now = int(time.time())
+        batch = Batch(batch_dir, {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": len(requests), "completed": 0, "failed": 0},
+            "metadata": metadata,
+        })
+        batch.save()
+        if self.leader:
+            self._batches[batch_id] = batch
+            self._queue.put_nowait(batch)
+        log.info("Batch created", extra={"batch_id": batch_id, "requests": len(requests)})
+        return batch
+
+    def get(self, batch_id):
+        if not batch_id.startswith(BATCH_ID_PREFIX) or os.sep in batch_id:
+            return None
+        if not self.leader:
+            # The leader keeps batch.json current; there is no local copy to go stale.
+            return self._load(batch_id)
+        batch = self._batches.get(batch_id)
+        if batch is None and self.shared:
+            # Created by another worker since the last scan in _watch().
+            batch = self._load(batch_id)
+            if batch is not None:
+                self._adopt(batch)
+        return batch
+
+    def list(self):
+        if self.leader:
+            batches = self._batches.values()
+        else:
+            batches = [batch for batch in map(self._load, os.listdir(self.directory)) if batch is not None]
+        return sorted(batches, key=lambda b: b.meta['created_at'], reverse=True)
+
+    def cancel(self, batch):
+        """Stops a batch; lines already running finish. Returns False if it had already finished."""
+        if batch.status in FINISHED_STATES:
+            return False
+        if not self.leader:
+            # Leave a marker for the leader's watcher; report the state it is about to move to.
+            open(batch.path('cancel'), 'w').close()
+            batch.meta['status'] = 'cancelling'
+            return True
+        batch._cancel.set()
+        if batch.status == 'validating':
+            # Not started yet: nothing is running, so it can be closed right away.
+            self._finalize(batch)
+        elif batch.status != 'cancelling':
+            batch.set_status('cancelling')
+        return True
+
+    async def _run(self):
+        while True:
+            batch = await self._queue.get()
+            if batch.status in FINISHED_STATES:
+                continue
+            try:
+                await self._execute(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception("Batch failed", extra={"batch_id": batch.id})
+                batch.meta['errors'] = {"object": "list", "data": [{"code": "internal_error", "message": str(e)}]}
+                batch.set_status('failed')
+
+    def _pending_lines(self, batch):
+        with open(batch.path('input.jsonl'), 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['custom_id'] not in batch.done:
+                    yield entry['custom_id'], entry['body']
+
+    async def _execute(self, batch):
+        succeeded = _read_results(batch.path('output.jsonl'))
+        failed = _read_results(batch.path('errors.jsonl'))
+        batch.done = succeeded | failed
+        batch.meta['request_counts'].update(completed=len(succeeded), failed=len(failed))
+        if batch.status == 'validating':
+            batch.set_status('in_progress')
+
+        pending = self._pending_lines(batch)
+        started = time.monotonic()
+
+        async def worker():
+            for custom_id, body in pending:
+                if batch._cancel.is_set():
+                    return
+                await self._execute_line(batch, custom_id, body)
+
+        expired = False
+        if not batch._cancel.is_set():
+            try:
+                # A resumed batch may already be past its deadline; wait_for then stops it at once.
+                await asyncio.wait_for(asyncio.gather(*(worker() for _ in range(self.concurrency))),
+                                       max(0, batch.meta['expires_at'] - time.time()))
+            except asyncio.TimeoutError:
+                expired = True
+                log.warning("Batch expired", extra={"batch_id": batch.id,
+                                                    "unfinished": batch.meta['request_counts']['total']
+                                                    - len(batch.done)})
+        self._finalize(batch, expired)
+        log.info("Batch finished", extra={"batch_id": batch.id, "status": batch.status,
+                                          "seconds": round(time.monotonic() - started, 3),
+                                          **batch.meta['request_counts']})
+
+    async def _execute_line(self, batch, custom_id, body):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                outcome = await self.run_line(body)
+            except Exception as e:
+                log.warning("Batch line raised", extra={"batch_id": batch.id, "error": str(e)})
+                outcome = ({"error": {"message": f"Internal error: {e}", "type": "internal_server_error",
+                                      "code": 500}}, 500)
+            if not isinstance(outcome, tuple) or outcome[1] not in RETRYABLE_STATUS_CODES:
+                break
+            if attempt == self.max_attempts or batch._cancel.is_set():
+                break
+            headers = outcome[2] if len(outcome) > 2 else {}
+            retry_after = float(headers.get("Retry-After", 0) or 0)
+            self.stats["retries"] += 1
+            await asyncio.sleep(min(self.max_backoff, max(retry_after, 2 ** attempt)))
+
+        if isinstance(outcome, tuple):
+            status_code, response_body, file_name, counter = outcome[1], outcome[0], 'errors.jsonl', 'failed'
+        else:
+            status_code, response_body, file_name, counter = 200, outcome, 'output.jsonl', 'completed'
+        record = {
+            "id": "batch_req_" + uuid.uuid4().hex,
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "request_id": response_body.get("id"), "body": response_body},
+            "error": None,
+        }
+        with open(batch.path(file_name), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+        batch.done.add(custom_id)
+        batch.meta['request_counts'][counter] += 1
+        if self.shared:
+            # Other workers read progress from batch.json.
+            batch.save()
+        self.stats["lines_succeeded" if counter == 'completed' else "lines_failed"] += 1
+
+    def _finalize(self, batch, expired=False):
+        cancelled = batch._cancel.is_set()
+        if not cancelled and not expired:
+            batch.set_status('finalizing')
+        for kind, file_name in (('output', 'output.jsonl'), ('error', 'errors.jsonl')):
+            path = batch.path(file_name)
+            if os.path.exists(path) and os.path.getsize(path):
+                with open(path, 'rb') as f:
+                    batch.meta[f"{kind}_file_id"] = self.publish(batch, kind, f.read())
+        batch.set_status('cancelled' if cancelled else 'expired' if expired else 'completed')
+
+    def status(self):
+        by_status = {}
+        for batch in (self._batches.values() if self.leader else self.list()):
+            by_status[batch.status] = by_status.get(batch.status, 0) + 1
+        return {"batches": sum(by_status.values()), "in_progress": by_status.get('in_progress', 0),
+                "queued": by_status.get('validating', 0), **self.stats}
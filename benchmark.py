@@ -0,0 +1,269 @@
+"""
+Load benchmark for /v1/chat/completions.
+
+By default the gateway runs in-process against the fake backend, so the
+numbers measure the gateway's own overhead without network access:
+
+    python benchmark.py --concurrency 1 8 32 --requests 200
+
+Pass --url to drive a running gateway instead (start it with --backend fake
+for an offline run), and --pid to sample that server's RSS.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import resource
+import time
+
+REQUEST_PAYLOADS = ('text', 'multipart', 'data-url')
+
+
+def rss_bytes(pid=None):
+    """Current resident set size of `pid` (default: this process), or None if unavailable."""
+    try:
+        with open(f"/proc/{pid or 'self'}/status", 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class PayloadFactory:
+    """
+    Builds request bodies for each payload kind.
+
+    Every request gets distinct prompt text and attachment bytes, so neither
+    coalescing nor the attachment store can short-circuit the measured work.
+    """
+
+    def __init__(self, model, prompt_chars, file_bytes, stream):
+        self.model = model
+        self.prompt = ("Benchmark question about gateway overhead. " * (prompt_chars // 43 + 1))[:prompt_chars]
+        self.file_body = os.urandom(file_bytes)
+        self.image_base64 = base64.b64encode(self.file_body).decode('ascii')
+        self.stream = stream
+
+    def payload(self, index):
+        return {"model": self.model, "stream": self.stream,
+                "messages": [{"role": "user", "content": f"#{index} {self.prompt}"}]}
+
+    def file_bytes(self, index):
+        return index.to_bytes(8, 'big') + self.file_body[8:]
+
+    def data_url(self, index):
+        # 12 base64 characters encode exactly 9 bytes, so this stays valid base64.
+        prefix = base64.b64encode(index.to_bytes(9, 'big')).decode('ascii')
+        return "data:image/png;base64," + prefix + self.image_base64[12:]
+
+    def data_url_payload(self, index):
+        payload = self.payload(index)
+        payload["messages"][0]["content"] = [
+            {"type": "text", "text": payload["messages"][0]["content"]},
+            {"type": "image_url", "image_url": {"url": self.data_url(index)}},
+        ]
+        return payload
+
+
+class InProcessTarget:
+    """Sends requests through Quart's test client to the gateway app in this process."""
+
+    def __init__(self, args):
+        import app as gateway
+        from accounts import AccountPool
+        from backends import make_client_factory
+
+        gateway.setup_models(args.prefix)
+        gateway.EXPECTED_API_KEY = args.api_key
+        gateway.file_store = None
+        gateway.account_pool = AccountPool.from_cookies(
+            [(f"bench-{i}", None) for i in range(args.accounts)],
+            max_concurrency=0,
+            size=args.pool_size,
+            client_factory=make_client_factory('fake', args.fake_backend)
+        )
+        self.gateway = gateway
+        self.headers = {"Authorization": f"Bearer {args.api_key}"}
+        self._context = None
+        self.client = None
+
+    async def __aenter__(self):
+        self._context = self.gateway.app.test_app()
+        await self._context.__aenter__()
+        self.client = self.gateway.app.test_client()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._context.__aexit__(*exc_info)
+
+    async def post_json(self, payload):
+        response = await self.client.post('/v1/chat/completions', json=payload, headers=self.headers)
+        return response.status_code, await response.get_data()
+
+    async def post_multipart(self, payload, filename, data):
+        from quart.datastructures import FileStorage
+        response = await self.client.post(
+            '/v1/chat/completions',
+            form={"json_payload": json.dumps(payload)},
+            files={"file": FileStorage(io.BytesIO(data), filename=filename)},
+            headers=self.headers
+        )
+        return response.status_code, await response.get_data()
+
+    def rss(self):
+        return rss_bytes()
+
+
+class HttpTarget:
+    """Sends requests over HTTP to a running gateway."""
+
+    def __init__(self, args):
+        self.url = args.url.rstrip('/') + '/v1/chat/completions'
+        self.headers = {"Authorization": f"Bearer {args.api_key}"}
+        self.pid = args.pid
+        self.session = None
+
+    async def __aenter__(self):
+        from curl_cffi.requests import AsyncSession
+        self.session = AsyncSession(timeout=600)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def post_json(self, payload):
+        response = await self.session.post(self.url, json=payload, headers=self.headers)
+        return response.status_code, response.content
+
+    async def post_multipart(self, payload, filename, data):
+        from curl_cffi import CurlMime
+        mime = CurlMime()
+        mime.addpart(name="json_payload", data=json.dumps(payload).encode('utf-8'))
+        mime.addpart(name="file", filename=filename, content_type="application/octet-stream", data=data)
+        try:
+            response = await self.session.post(self.url, multipart=mime, headers=self.headers)
+        finally:
+            mime.close()
+        return response.status_code, response.content
+
+    def rss(self):
+        return rss_bytes(self.pid) if self.pid else None
+
+
+async def send(target, factory, kind, index):
+    """Sends one request; returns (status_code, body)."""
+    if kind == 'text':
+        return await target.post_json(factory.payload(index))
+    if kind == 'multipart':
+        return await target.post_multipart(factory.payload(index), f"bench_{index}.bin", factory.file_bytes(index))
+    return await target.post_json(factory.data_url_payload(index))
+
+
+async def run_level(target, factory, kind, concurrency, total_requests, first_index):
+    """Runs `total_requests` requests with `concurrency` workers; returns the level's results."""
+    latencies = []
+    errors = 0
+    next_index = first_index
+    end_index = first_index + total_requests
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < end_index:
+            index = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                status, body = await send(target, factory, kind, index)
+            except Exception:
+                status, body = None, b''
+            latencies.append(time.perf_counter() - started)
+            # Streams report upstream failures as an error event inside a 200 response.
+            if status != 200 or (factory.stream and b'data: {"error"' in body):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "payload": kind,
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": errors,
+        "throughput_rps": total_requests / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "rss_mb": (target.rss() or 0) / (1024 * 1024) or None,
+    }
+
+
+def format_row(result):
+    def fmt(value, digits=1):
+        return "-" if value is None else f"{value:.{digits}f}"
+    return (f"{result['payload']:<10} {result['concurrency']:>5} {result['requests']:>7} {result['errors']:>6} "
+            f"{fmt(result['throughput_rps']):>9} {fmt(result['p50_ms']):>9} {fmt(result['p95_ms']):>9} "
+            f"{fmt(result['p99_ms']):>9} {fmt(result['rss_mb']):>8}")
+
+
+async def main(args):
+    factory = PayloadFactory(f"{args.prefix}/{args.model}", args.prompt_chars, args.file_bytes, args.stream)
+    target = HttpTarget(args) if args.url else InProcessTarget(args)
+    results = []
+    async with target:
+        index = 0
+        for kind in args.payloads:
+            await run_level(target, factory, kind, 1, args.warmup, index)
+            index += args.warmup
+            for concurrency in args.concurrency:
+                result = await run_level(target, factory, kind, concurrency, args.requests, index)
+                index += args.requests
+                results.append(result)
+                if not args.json:
+                    if len(results) == 1:
+                        print(f"{'payload':<10} {'conc':>5} {'reqs':>7} {'errors':>6} {'req/s':>9} "
+                              f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rss MB':>8}")
+                    print(format_row(result))
+    if args.json:
+        print(json.dumps({"results": results,
+                          "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gateway's /v1/chat/completions endpoint.")
+    parser.add_argument('--url', type=str, default=None,
+                        help="Base URL of a running gateway; omitted, the gateway runs in-process on the fake backend.")
+    parser.add_argument('--pid', type=int, default=None, help="PID of the gateway behind --url, to report its RSS.")
+    parser.add_argument('--api-key', type=str, default=os.environ.get("PPLX_OPENAI_KEY", "your-secret-api-key"))
+    parser.add_argument('--prefix', type=str, default="perplexity-chat")
+    parser.add_argument('--model', type=str, default="auto", help="Model ID without the prefix.")
+    parser.add_argument('--payloads', nargs='+', choices=REQUEST_PAYLOADS, default=list(REQUEST_PAYLOADS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help="Requests per concurrency level.")
+    parser.add_argument('--warmup', type=int, default=10, help="Unmeasured requests before each payload kind.")
+    parser.add_argument('--prompt-chars', type=int, default=2000)
+    parser.add_argument('--file-bytes', type=int, default=256 * 1024,
+                        help="Attachment size for the multipart and data-url payloads.")
+    parser.add_argument('--stream', action='store_true', default=False, help="Request streaming responses.")
+    parser.add_argument('--fake-backend', type=str, default="latency_scale=0.01",
+                        help="In-process fake backend settings (see FakeBackendSettings).")
+    parser.add_argument('--accounts', type=int, default=1, help="In-process: number of fake accounts.")
+    parser.add_argument('--pool-size', type=int, default=8, help="In-process: warm clients per account.")
+    parser.add_argument('--json', action='store_true', default=False, help="Print results as JSON.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(main(args))
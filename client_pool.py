@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import perplexity_async
+
+log = logging.getLogger(__name__)
+
+
+class PooledClient:
+    """A perplexity_async.Client together with its bookkeeping timestamps."""
+
+    def __init__(self, client):
+        self.client = client
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+    def is_expired(self, max_idle, max_age):
+        now = time.monotonic()
+        if max_idle and now - self.last_used_at > max_idle:
+            return True
+        if max_age and now - self.created_at > max_age:
+            return True
+        return False
+
+
+class ClientPool:
+    """
+    Keeps warm perplexity_async.Client sessions and hands them out per request.
+
+    Clients are created (and their session bootstrapped) up front by start(),
+    checked out with `async with pool.client() as cli:`, and returned to the
+    pool afterwards. A client that raised during use (including a search
+    that came back empty, see accounts.EmptyUpstreamResponseError) is closed
+    instead of being returned and a fresh one is warmed in its place. Idle
+    clients older than max_idle / max_age seconds are replaced on checkout or
+    by the background refresher.
+    """
+
+    def __init__(self, cookies=None, size=4, max_idle=300, max_age=1800,
+                 client_factory=None):
+        """
+        Args:
+            cookies: Cookie dictionary passed to every client (or None).
+            size: Number of warm idle clients to keep around.
+            max_idle: Seconds a client may sit idle before being recycled (0 disables).
+            max_age: Seconds after which a client is recycled regardless of use (0 disables).
+            client_factory: Awaitable factory taking the cookies; defaults to perplexity_async.Client.
+        """
+        self.cookies = cookies
+        self.size = max(0, size)
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.client_factory = client_factory or perplexity_async.Client
+        self._idle = []
+        self._in_use = 0
+        self._lock = asyncio.Lock()
+        self._refresher = None
+        self._replacements = set()
+        self.stats = {"created": 0, "reused": 0, "recycled": 0, "discarded": 0}
+
+    async def _new_client(self):
+        client = await self.client_factory(self.cookies if self.cookies else None)
+        self.stats["created"] += 1
+        return PooledClient(client)
+
+    async def _close(self, pooled):
+        session = getattr(pooled.client, "session", None)
+        if session is not None:
+            try:
+                await session.close()
+            except Exception as e:
+                log.debug("Error closing Perplexity client session", extra={"error": str(e)})
+
+    async def start(self):
+        """Creates and warms `size` clients. Failures are reported but not fatal."""
+        results = await asyncio.gather(
+            *(self._new_client() for _ in range(self.size)),
+            return_exceptions=True
+        )
+        warmed = 0
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning("Failed to warm Perplexity client", extra={"error": str(result)})
+            else:
+                self._idle.append(result)
+                warmed += 1
+        log.info("Client pool started", extra={"warmed": warmed, "size": self.size})
+        if self.max_idle or self.max_age:
+            self._refresher = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        """Stops the refresher and closes every idle client."""
+        if self._refresher:
+            self._refresher.cancel()
+            self._refresher = None
+        for replacement in list(self._replacements):
+            replacement.cancel()
+        async with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            await self._close(pooled)
+
+    async def _checkout(self):
+        while True:
+            async with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                return await self._new_client()
+            if pooled.is_expired(self.max_idle, self.max_age):
+                self.stats["recycled"] += 1
+                await self._close(pooled)
+                continue
+            self.stats["reused"] += 1
+            return pooled
+
+    async def _checkin(self, pooled, healthy):
+        pooled.last_used_at = time.monotonic()
+        if healthy and not pooled.is_expired(self.max_idle, self.max_age):
+            async with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(pooled)
+                    return
+        else:
+            self.stats["discarded"] += 1
+            replacement = asyncio.create_task(self._replace())
+            self._replacements.add(replacement)
+            replacement.add_done_callback(self._replacements.discard)
+        await self._close(pooled)
+
+    async def _replace(self):
+        """Warms a client in place of a discarded one, unless the pool is already full."""
+        if len(self._idle) + self._in_use >= self.size:
+            return
+        try:
+            fresh = await self._new_client()
+        except Exception as e:
+            log.warning("Failed to replace Perplexity client", extra={"error": str(e)})
+            return
+        async with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(fresh)
+                return
+        await self._close(fresh)
+
+    @asynccontextmanager
+    async def client(self):
+        """Checks out a client for the duration of the `async with` block."""
+        pooled = await self._checkout()
+        self._in_use += 1
+        healthy = False
+        try:
+            yield pooled.client
+            healthy = True
+        finally:
+            self._in_use -= 1
+            await self._checkin(pooled, healthy)
+
+    async def _refresh_loop(self):
+        interval = min(t for t in (self.max_idle, self.max_age) if t) / 2
+        while True:
+            await asyncio.sleep(max(interval, 1))
+            async with self._lock:
+                stale = [p for p in self._idle if p.is_expired(self.max_idle, self.max_age)]
+                self._idle = [p for p in self._idle if p not in stale]
+            for pooled in stale:
+                self.stats["recycled"] += 1
+                await self._close(pooled)
+            missing = self.size - len(self._idle) - self._in_use
+            for _ in range(max(0, missing)):
+                try:
+                    fresh = await self._new_client()
+                except Exception as e:
+                    log.warning("Failed to refresh Perplexity client", extra={"error": str(e)})
+                    break
+                async with self._lock:
+                    self._idle.append(fresh)
+
+    def status(self):
+        return {"idle": len(self._idle), "in_use": self._in_use, "size": self.size, **self.stats}
@@ -0,0 +1,144 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class ConversationThread:
+    """An upstream Perplexity thread: the account it lives on and its latest entry."""
+
+    __slots__ = ('account', 'backend_uuid', 'attachments', 'created_at')
+
+    def __init__(self, account, backend_uuid, attachments=()):
+        self.account = account
+        self.backend_uuid = backend_uuid
+        self.attachments = list(attachments)
+        self.created_at = time.time()
+
+
+def _update_with_message(hasher, message):
+    """Feeds one chat message's role and content (text, images, file IDs) into `hasher`."""
+    hasher.update(b'\x1e' + str(message.get('role', '')).encode('utf-8') + b'\x1f')
+    content = message.get('content')
+    if isinstance(content, str):
+        hasher.update(b't' + content.strip().encode('utf-8') + b'\x1f')
+        return
+    for part in content or ():
+        kind = part.get('type')
+        if kind == 'text':
+            value = (part.get('text') or '').strip()
+        elif kind == 'image_url':
+            value = (part.get('image_url') or {}).get('url') or ''
+        elif kind == 'file':
+            value = (part.get('file') or {}).get('file_id') or ''
+        else:
+            continue
+        hasher.update(kind.encode('ascii', errors='replace') + b'\x1d' + value.encode('utf-8') + b'\x1f')
+
+
+class ConversationIndex:
+    """
+    Maps chat histories to the upstream thread that produced their last answer.
+
+    After an answer is returned, the conversation including that answer is
+    indexed by a running SHA-256 over its messages. A later request whose
+    messages start with an indexed conversation can then be sent as a
+    follow-up on that thread, carrying only the messages after the prefix.
+    Entries expire after `ttl` seconds and the index is LRU-bounded.
+
+    With a SharedState the index lives in the shared database, so a
+    follow-up is recognized whichever worker process receives it. Lookups
+    query it on the database thread and stores are deferred writes.
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600, shared=None):
+        """
+        Args:
+            max_entries: Conversations remembered at most.
+            ttl: Seconds a thread is offered for follow-ups.
+            shared: Optional SharedState of a multi-worker gateway.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._threads = OrderedDict()
+        # Threads in the shared database as of this worker's last store.
+        self._shared_threads = 0
+        self.stats = {"hits": 0, "misses": 0, "unavailable": 0, "stored": 0, "evicted": 0}
+
+    async def lookup(self, model_id, messages):
+        """
+        Finds the longest indexed prefix of `messages`.
+
+        Returns:
+            A tuple (thread, prefix_length, conversation_hasher). `thread` is
+            None on a miss; `conversation_hasher` covers all of `messages` and
+            is passed to remember() once the answer is known.
+        """
+        hasher = hashlib.sha256(str(model_id).encode('utf-8'))
+        candidates = []
+        for position, message in enumerate(messages):
+            _update_with_message(hasher, message)
+            # Only a history ending in one of our answers can be on file.
+            if message.get('role') == 'assistant' and position < len(messages) - 1:
+                candidates.append((position + 1, hasher.hexdigest()))
+
+        shared_rows = None
+        if self.shared is not None and candidates:
+            shared_rows = await self.shared.read(self.shared.get_threads, [key for _, key in candidates])
+        now = time.time()
+        for prefix_length, key in reversed(candidates):
+            thread = self._get(key, shared_rows)
+            if thread is None:
+                continue
+            if now - thread.created_at > self.ttl:
+                self._delete(key)
+                continue
+            self.stats["hits"] += 1
+            return thread, prefix_length, hasher
+        self.stats["misses"] += 1
+        return None, 0, hasher
+
+    def remember(self, conversation_hasher, answer, thread):
+        """Indexes the conversation extended by the assistant's `answer` under `thread`."""
+        hasher = conversation_hasher.copy()
+        _update_with_message(hasher, {"role": "assistant", "content": answer})
+        key = hasher.hexdigest()
+        self.stats["stored"] += 1
+        if self.shared is not None:
+            self.shared.defer(self._store_shared, key, thread)
+            return
+        self._threads[key] = thread
+        self._threads.move_to_end(key)
+        while len(self._threads) > self.max_entries:
+            self._threads.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def _store_shared(self, key, thread):
+        # Runs on the shared state's database thread.
+        self.stats["evicted"] += self.shared.put_thread(key, thread.account, thread.backend_uuid,
+                                                        thread.attachments, thread.created_at,
+                                                        self.max_entries)
+        self._shared_threads = self.shared.count_threads()
+
+    def _get(self, key, shared_rows=None):
+        if self.shared is not None:
+            row = (shared_rows or {}).get(key)
+            if row is None:
+                return None
+            thread = ConversationThread(*row[:3])
+            thread.created_at = row[3]
+            return thread
+        thread = self._threads.get(key)
+        if thread is not None:
+            self._threads.move_to_end(key)
+        return thread
+
+    def _delete(self, key):
+        if self.shared is not None:
+            self.shared.defer(self.shared.delete_thread, key)
+        else:
+            del self._threads[key]
+
+    def status(self):
+        threads = self._shared_threads if self.shared is not None else len(self._threads)
+        return {"threads": threads, **self.stats}
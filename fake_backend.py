@@ -0,0 +1,176 @@
+import asyncio
+import json
+import math
+import random
+import uuid
+
+# Median (first chunk, complete answer) latency in seconds for each mode,
+# roughly what perplexity.ai shows for short questions.
+MODE_LATENCY = {
+    'auto': (0.8, 2.5),
+    'pro': (1.5, 6.0),
+    'reasoning': (3.0, 15.0),
+    'deep research': (30.0, 180.0),
+}
+
+WORDS = ("the gateway answer search result source model request latency stream chunk token "
+         "cache account upload image document summary detail example value").split()
+
+
+class FakeBackendSettings:
+    """Latency, error and payload shape of the fake backend."""
+
+    def __init__(self, latency_scale=1.0, sigma=0.35, error_rate=0.0, rate_limit_rate=0.0,
+                 answer_chars=1200, chunks=24, web_results=5, seed=None):
+        """
+        Args:
+            latency_scale: Multiplier on MODE_LATENCY (0 answers immediately).
+            sigma: Spread of the log-normal latency distribution.
+            error_rate: Fraction of searches failing like an upstream 502.
+            rate_limit_rate: Fraction of searches refused like a 429, which the real client
+                reports as no response at all (puts the account on cooldown).
+            answer_chars: Approximate length of each answer.
+            chunks: Number of streamed chunks the answer is written in.
+            web_results: Number of web results attached to each answer.
+            seed: Seed for a reproducible run.
+        """
+        self.latency_scale = latency_scale
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.answer_chars = answer_chars
+        self.chunks = max(1, chunks)
+        self.web_results = web_results
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Parses 'latency_scale=0.01,error_rate=0.02,...' (keys are the __init__ arguments)."""
+        kwargs = {}
+        for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+            key, _, value = item.partition('=')
+            key = key.strip()
+            if key in ('answer_chars', 'chunks', 'web_results', 'seed'):
+                kwargs[key] = int(value)
+            else:
+                kwargs[key] = float(value)
+        return cls(**kwargs)
+
+    def sample_latency(self, median):
+        if not self.latency_scale:
+            return 0.0
+        return median * self.latency_scale * math.exp(self.random.gauss(0, self.sigma))
+
+
+class FakePerplexityClient:
+    """
+    Stand-in for perplexity_async.Client that never touches the network.
+
+    search() returns the same structures as the real client: a list of steps
+    (INITIAL_QUERY, SEARCH_WEB, SEARCH_RESULTS, FINAL) whose FINAL step holds
+    the answer as a JSON-encoded string, or cumulative chunks when streaming.
+    Each chunk is decoded from its wire form, as the real client does, so
+    parsing costs are part of a benchmark.
+    """
+
+    def __init__(self, cookies=None, settings=None):
+        self.settings = settings or FakeBackendSettings()
+        # own=False keeps attachments on the search() path; there is no upload endpoint to reuse.
+        self.own = False
+        self.copilot = float('inf')
+        self.file_upload = float('inf')
+        self.searches = 0
+
+    def __await__(self):
+        async def ready():
+            return self
+        return ready().__await__()
+
+    def _answer_text(self, query):
+        rnd = self.settings.random
+        words = []
+        length = 0
+        while length < self.settings.answer_chars:
+            word = rnd.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return f"Regarding {query[:40]!r}: " + " ".join(words) + "."
+
+    def _web_results(self, query):
+        return [
+            {"name": f"Result {i} for {query[:20]}", "url": f"https://example.com/{i}",
+             "snippet": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 3}
+            for i in range(self.settings.web_results)
+        ]
+
+    def _wire_message(self, query, mode, answer, web_results, completed, backend_uuid):
+        steps = [
+            {"uuid": str(uuid.uuid4()), "step_type": "INITIAL_QUERY", "content": {"query": query}},
+            {"uuid": str(uuid.uuid4()), "step_type": "SEARCH_WEB",
+             "content": {"queries": [{"engine": "search", "query": query[:100], "limit": 8}]}},
+            {"uuid": str(uuid.uuid4()), "step_type": "SEARCH_RESULTS", "content": {"web_results": web_results}},
+            {"uuid": str(uuid.uuid4()), "step_type": "FINAL", "content": {"answer": json.dumps({
+                "answer": answer, "web_results": web_results, "chunks": [], "extra_web_results": [],
+            })}},
+        ]
+        return json.dumps({
+            "backend_uuid": backend_uuid,
+            "context_uuid": backend_uuid,
+            "uuid": backend_uuid,
+            "mode": "concise" if mode == 'auto' else "copilot",
+            "status": "completed" if completed else "pending",
+            "final": completed,
+            "text": json.dumps(steps),
+        })
+
+    @staticmethod
+    def _decode(message):
+        content = json.loads(message)
+        content['text'] = json.loads(content['text'])
+        return content
+
+    def _maybe_fail(self):
+        """Raises like an upstream 502; returns True if the search is refused like a 429."""
+        rnd = self.settings.random
+        if self.settings.rate_limit_rate and rnd.random() < self.settings.rate_limit_rate:
+            return True
+        if self.settings.error_rate and rnd.random() < self.settings.error_rate:
+            raise Exception("Fake backend: upstream returned 502 Bad Gateway")
+        return False
+
+    async def search(self, query, mode='auto', model=None, sources=['web'], files={}, stream=False,
+                     language='en-US', follow_up=None, incognito=False):
+        assert mode in MODE_LATENCY, f'Search modes -> {list(MODE_LATENCY)}'
+        self.searches += 1
+        first_median, total_median = MODE_LATENCY[mode]
+        first_chunk = self.settings.sample_latency(first_median)
+        total = max(first_chunk, self.settings.sample_latency(total_median))
+        # Touch every attachment, like the real client reading it for upload.
+        sum(len(data) for data in (files or {}).values())
+
+        await asyncio.sleep(first_chunk)
+        refused = self._maybe_fail()
+
+        answer = self._answer_text(query)
+        web_results = self._web_results(query)
+        backend_uuid = str(uuid.uuid4())
+
+        if not stream:
+            if refused:
+                # perplexity_async never sees the end of the stream and returns nothing.
+                return None
+            await asyncio.sleep(total - first_chunk)
+            return self._decode(self._wire_message(query, mode, answer, web_results, True, backend_uuid))
+
+        async def chunks():
+            if refused:
+                return
+            count = self.settings.chunks
+            pause = (total - first_chunk) / count
+            for i in range(1, count + 1):
+                if i > 1:
+                    await asyncio.sleep(pause)
+                partial = answer[:len(answer) * i // count]
+                yield self._decode(self._wire_message(
+                    query, mode, partial, web_results, i == count, backend_uuid))
+        return chunks()
@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+FILE_ID_PREFIX = "file-"
+
+
+class StoredFile:
+    """An attachment held in the FileStore: its digest, name, size and (lazily) its bytes."""
+
+    __slots__ = ('digest', 'filename', 'size', 'purpose', 'created_at', '_data', '_store')
+
+    def __init__(self, store, digest, filename, size, purpose='assistants', created_at=None, data=None):
+        self._store = store
+        self.digest = digest
+        self.filename = filename
+        self.size = size
+        self.purpose = purpose
+        self.created_at = created_at or int(time.time())
+        self._data = data
+
+    @property
+    def file_id(self):
+        return FILE_ID_PREFIX + self.digest
+
+    def load(self):
+        """Returns the file contents, reading them from disk on first use."""
+        if self._data is None:
+            self._data = self._store.read(self.digest)
+        return self._data
+
+    async def load_async(self):
+        """Like load(), but reads from disk in a worker thread."""
+        if self._data is None:
+            self._data = await asyncio.to_thread(self._store.read, self.digest)
+        return self._data
+
+    def renamed(self, filename):
+        return StoredFile(self._store, self.digest, filename, self.size, self.purpose,
+                          self.created_at, self._data)
+
+    def to_openai(self):
+        return {
+            "id": self.file_id,
+            "object": "file",
+            "bytes": self.size,
+            "created_at": self.created_at,
+            "filename": self.filename,
+            "purpose": self.purpose,
+        }
+
+
+def sha256_of_base64(encoded, start=0, chunk_chars=1024 * 1024):
+    """Hashes a base64 payload in slices, so a known data URL can be recognised without decoding it."""
+    h = hashlib.sha256()
+    for offset in range(start, len(encoded), chunk_chars):
+        h.update(encoded[offset:offset + chunk_chars].encode('ascii', errors='replace'))
+    return h.hexdigest()
+
+
+class FileStore:
+    """
+    Content-addressed attachment store on disk.
+
+    Files are saved as <directory>/<sha256> with a small JSON sidecar and
+    evicted least-recently-used once the directory exceeds max_bytes. Base64
+    payloads seen before are remembered by the digest of their encoded text,
+    so repeating the same data URL maps straight to the stored file.
+
+    Files a request is using can be pinned; eviction skips them until they
+    are unpinned, so a concurrent put() cannot remove a file between its
+    lookup and its upload.
+
+    With `shared` set, several worker processes use the directory: lookups
+    fall back to the disk for files another worker stored and notice files
+    another worker deleted. Each worker evicts by its own view of the size
+    and only respects its own pins.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, max_aliases=10000, shared=False):
+        """
+        Args:
+            directory: Where file contents and metadata are kept.
+            max_bytes: Total size of stored contents before LRU eviction.
+            max_aliases: How many base64-text digests to remember.
+            shared: Whether other worker processes use the directory too.
+        """
+        self.directory = directory
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.max_aliases = max_aliases
+        self._index = OrderedDict()
+        self._aliases = OrderedDict()
+        self._pins = {}
+        self._bytes = 0
+        self.stats = {"stored": 0, "deduplicated": 0, "alias_hits": 0, "evicted": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def _read_meta(self, digest):
+        """Returns (last_used, StoredFile) from a file's sidecar, or None if it is missing."""
+        try:
+            with open(self._path(digest) + '.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            last_used = os.path.getmtime(self._path(digest))
+        except (OSError, ValueError):
+            return None
+        return last_used, StoredFile(self, digest, meta['filename'], meta['bytes'],
+                                     meta.get('purpose', 'assistants'), meta.get('created_at'))
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name[:-len('.json')] in self._index:
+                continue
+            entry = self._read_meta(name[:-len('.json')])
+            if entry is not None:
+                entries.append(entry)
+        for _, stored in sorted(entries, key=lambda entry: entry[0]):
+            self._index[stored.digest] = stored
+            self._bytes += stored.size
+
+    def _touch(self, digest):
+        self._index.move_to_end(digest)
+        try:
+            os.utime(self._path(digest))
+        except OSError:
+            pass
+
+    def _evict(self):
+        for digest in list(self._index):
+            if self._bytes <= self.max_bytes or len(self._index) <= 1:
+                break
+            if digest in self._pins:
+                continue
+            stored = self._index.pop(digest)
+            self._bytes -= stored.size
+            self.stats["evicted"] += 1
+            for path in (self._path(digest), self._path(digest) + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def pin(self, digest):
+        """Protects a stored file from eviction until a matching unpin()."""
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digest):
+        count = self._pins.pop(digest, 0) - 1
+        if count > 0:
+            self._pins[digest] = count
+
+    def _write(self, digest, data, filename, purpose, created_at):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(digest))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with open(self._path(digest) + '.json', 'w', encoding='utf-8') as f:
+            json.dump({"filename": filename, "bytes": len(data), "purpose": purpose,
+                       "created_at": created_at}, f)
+
+    def _add(self, digest, data, filename, purpose, created_at):
+        existing = self._index.get(digest)
+        if existing is not None:
+            self._touch(digest)
+            self.stats["deduplicated"] += 1
+            return StoredFile(self, digest, filename, existing.size, purpose, existing.created_at, data)
+        self._index[digest] = StoredFile(self, digest, filename, len(data), purpose, created_at)
+        self._bytes += len(data)
+        self.stats["stored"] += 1
+        self._evict()
+        return StoredFile(self, digest, filename, len(data), purpose, created_at, data)
+
+    def put(self, data, filename, purpose='assistants', digest=None):
+        """
+        Stores `data` (if not already present) and returns its StoredFile.
+
+        The returned object keeps `data` in memory, so the caller's copy is reused.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = digest or hashlib.sha256(data).hexdigest()
+        created_at = int(time.time())
+        if digest not in self._index:
+            self._write(digest, data, filename, purpose, created_at)
+        return self._add(digest, data, filename, purpose, created_at)
+
+    async def put_async(self, data, filename, purpose='assistants'):
+        """Like put(), but hashes and writes `data` in a worker thread instead of on the event loop."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        created_at = int(time.time())
+        if digest not in self._index:
+            await asyncio.to_thread(self._write, digest, data, filename, purpose, created_at)
+        return self._add(digest, data, filename, purpose, created_at)
+
+    def read(self, digest):
+        with open(self._path(digest), 'rb') as f:
+            return f.read()
+
+    def get(self, file_id_or_digest):
+        """Looks up a stored file by file ID or digest; returns None if unknown or evicted."""
+        digest = file_id_or_digest
+        if digest.startswith(FILE_ID_PREFIX):
+            digest = digest[len(FILE_ID_PREFIX):]
+        stored = self._index.get(digest)
+        if self.shared:
+            if stored is not None and not os.path.exists(self._path(digest)):
+                # Deleted or evicted by another worker.
+                del self._index[digest]
+                self._bytes -= stored.size
+                stored = None
+            elif stored is None and len(digest) == 64 and all(c in '0123456789abcdef' for c in digest):
+                entry = self._read_meta(digest)
+                if entry is not None:
+                    stored = self._index[digest] = entry[1]
+                    self._bytes += stored.size
+        if stored is None:
+            return None
+        self._touch(digest)
+        return stored
+
+    def delete(self, file_id_or_digest):
+        stored = self.get(file_id_or_digest)
+        if stored is None:
+            return False
+        del self._index[stored.digest]
+        self._bytes -= stored.size
+        for path in (self._path(stored.digest), self._path(stored.digest) + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+    def list(self):
+        if self.shared:
+            for digest in [digest for digest in self._index if not os.path.exists(self._path(digest))]:
+                self._bytes -= self._index.pop(digest).size
+            self._load_index()
+        return list(self._index.values())
+
+    def lookup_base64(self, encoded_digest):
+        """Returns the stored file previously decoded from this base64 text, if still present."""
+        digest = self._aliases.get(encoded_digest)
+        if digest is None:
+            return None
+        stored = self.get(digest)
+        if stored is None:
+            del self._aliases[encoded_digest]
+            return None
+        self._aliases.move_to_end(encoded_digest)
+        self.stats["alias_hits"] += 1
+        return stored
+
+    def remember_base64(self, encoded_digest, digest):
+        self._aliases[encoded_digest] = digest
+        self._aliases.move_to_end(encoded_digest)
+        while len(self._aliases) > self.max_aliases:
+            self._aliases.popitem(last=False)
+
+    def status(self):
+        return {"files": len(self._index), "bytes": self._bytes, "aliases": len(self._aliases),
+                "pinned": len(self._pins), **self.stats}
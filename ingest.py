@@ -0,0 +1,145 @@
+import binascii
+import io
+import tempfile
+
+
+class PayloadTooLargeError(Exception):
+    """Raised when an upload exceeds one of the configured byte limits (HTTP 413)."""
+
+
+class ByteBudget:
+    """Process-wide count of upload bytes held by in-flight requests."""
+
+    def __init__(self, limit=0):
+        """
+        Args:
+            limit: Maximum bytes held at once across all requests (0 disables).
+        """
+        self.limit = limit
+        self.in_use = 0
+        self.rejections = 0
+
+    def reserve(self, n):
+        if self.limit and self.in_use + n > self.limit:
+            self.rejections += 1
+            raise PayloadTooLargeError(
+                f"Server is at its in-flight upload limit ({self.limit} bytes); retry later.")
+        self.in_use += n
+
+    def release(self, n):
+        self.in_use -= n
+
+
+class UploadBudget:
+    """
+    Byte accounting for one request.
+
+    Attachment bytes are checked against the per-file and per-request limits
+    and charged to the shared ByteBudget; release() returns everything the
+    request reserved and runs the callbacks registered with on_release().
+    """
+
+    def __init__(self, shared_budget, max_file_bytes=0, max_request_bytes=0):
+        self.shared_budget = shared_budget
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.attachment_bytes = 0
+        self.reserved = 0
+        self._callbacks = []
+
+    def reserve_body(self, n):
+        """Charges the raw request body to the shared budget (before it is read)."""
+        self.shared_budget.reserve(n)
+        self.reserved += n
+
+    def reserve(self, n, filename):
+        """Charges `n` attachment bytes for `filename`, raising PayloadTooLargeError over a limit."""
+        if self.max_file_bytes and n > self.max_file_bytes:
+            raise PayloadTooLargeError(
+                f"File '{filename}' is larger than the per-file limit ({self.max_file_bytes} bytes).")
+        if self.max_request_bytes and self.attachment_bytes + n > self.max_request_bytes:
+            raise PayloadTooLargeError(
+                f"Attachments exceed the per-request limit ({self.max_request_bytes} bytes).")
+        self.shared_budget.reserve(n)
+        self.attachment_bytes += n
+        self.reserved += n
+
+    def on_release(self, callback):
+        """Runs `callback` on release(), e.g. to unpin a stored file the request uses."""
+        self._callbacks.append(callback)
+
+    def release(self):
+        self.shared_budget.release(self.reserved)
+        self.reserved = 0
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class BoundedSpool(tempfile.SpooledTemporaryFile):
+    """Spooled upload buffer that refuses to grow past the per-file limit."""
+
+    def __init__(self, spool_threshold, max_file_bytes, filename):
+        super().__init__(max_size=spool_threshold, mode='w+b')
+        self.max_file_bytes = max_file_bytes
+        self.filename = filename
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.max_file_bytes and self.written > self.max_file_bytes:
+            raise PayloadTooLargeError(
+                f"File '{self.filename}' is larger than the per-file limit ({self.max_file_bytes} bytes).")
+        return super().write(data)
+
+
+def make_stream_factory(spool_threshold, max_file_bytes):
+    """
+    Returns a multipart stream factory: uploads stay in memory up to
+    spool_threshold bytes, then move to a temporary file on disk.
+    """
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if max_file_bytes and content_length and content_length > max_file_bytes:
+            raise PayloadTooLargeError(
+                f"File '{filename}' is larger than the per-file limit ({max_file_bytes} bytes).")
+        return BoundedSpool(spool_threshold, max_file_bytes, filename)
+    return stream_factory
+
+
+def base64_decoded_size(encoded, start=0):
+    """Upper bound of the decoded size of a base64 string, without decoding it."""
+    return (len(encoded) - start) * 3 // 4
+
+
+def decode_base64_chunked(encoded, start=0, chunk_chars=256 * 1024):
+    """
+    Decodes base64 text slice by slice.
+
+    base64.b64decode() first copies the whole str into an ASCII bytes object;
+    decoding fixed-size slices keeps the extra memory to one slice.
+
+    Args:
+        encoded: String holding the base64 payload, e.g. a whole data URL.
+        start: Offset of the payload in `encoded` (avoids slicing off a data URL header).
+        chunk_chars: Slice length; rounded down to a multiple of 4.
+
+    Returns:
+        The decoded bytes.
+
+    Raises:
+        binascii.Error: If the payload is not valid base64.
+    """
+    chunk_chars -= chunk_chars % 4
+    out = io.BytesIO()
+    carry = ''
+    for offset in range(start, len(encoded), chunk_chars):
+        piece = carry + encoded[offset:offset + chunk_chars]
+        piece = ''.join(piece.split())
+        usable = len(piece) - len(piece) % 4
+        if usable:
+            out.write(binascii.a2b_base64(piece[:usable]))
+        carry = piece[usable:]
+    if carry:
+        out.write(binascii.a2b_base64(carry))
+    # getvalue() hands back the buffer without copying when it is not shared.
+    return out.getvalue()
@@ -0,0 +1,356 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import socket
+import time
+import urllib.parse
+import uuid
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+JOB_ID_PREFIX = "job-"
+FINISHED_STATES = ('succeeded', 'failed', 'cancelled')
+
+
+class JobQueueFullError(Exception):
+    """Raised when too many jobs are already waiting to run."""
+
+
+class WebhookURLError(ValueError):
+    """Raised for a webhook URL the gateway refuses to call."""
+
+
+async def check_webhook_url(url, allowed_hosts=()):
+    """
+    Refuses webhook URLs that would make the gateway call into its own network.
+
+    Hosts listed in `allowed_hosts` are accepted as they are. Any other host
+    must resolve to public addresses only: loopback, link-local (such as
+    cloud metadata endpoints), private, reserved and multicast addresses are
+    rejected.
+
+    Raises:
+        WebhookURLError: The URL is not http(s), cannot be resolved or is not allowed.
+    """
+    parsed = urllib.parse.urlsplit(str(url))
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise WebhookURLError("'webhook_url' must be an http(s) URL")
+    try:
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    except ValueError:
+        raise WebhookURLError("'webhook_url' has an invalid port") from None
+    host = parsed.hostname.lower()
+    if host in allowed_hosts:
+        return
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        raise WebhookURLError(f"Cannot resolve webhook host '{host}'") from None
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise WebhookURLError(f"Webhook host '{host}' resolves to a non-public address")
+
+
+class Job:
+    """One background chat completion and its outcome."""
+
+    def __init__(self, run, model, webhook_url=None, cleanup=None):
+        self.id = JOB_ID_PREFIX + uuid.uuid4().hex
+        self.model = model
+        self.webhook_url = webhook_url
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._run = run
+        self._cleanup = cleanup
+        self._task = None
+        self._done = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "object": "chat.completion.job",
+            "model": self.model,
+            "status": self.status,
+            "created_at": int(self.created_at),
+            "started_at": int(self.started_at) if self.started_at else None,
+            "completed_at": int(self.finished_at) if self.finished_at else None,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class RemoteJob:
+    """A job owned by another worker process, as last published to the shared state."""
+
+    def __init__(self, document):
+        self.id = document["id"]
+        self.status = document["status"]
+        self._document = document
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def to_dict(self):
+        return dict(self._document)
+
+
+class JobManager:
+    """
+    Runs long chat completions in the background.
+
+    Submitted jobs wait in a bounded queue for one of `workers` worker tasks.
+    A job's run() coroutine returns either a completion dict or a tuple
+    (error_dict, status_code), the same convention as
+    get_perplexity_response(). Finished jobs are kept for `retention`
+    seconds so clients can poll for them, and an optional webhook URL gets
+    the finished job POSTed to it.
+
+    With a SharedState every job's state is published there (as deferred
+    writes), so any worker process can list, poll and cancel jobs that
+    another worker runs.
+    """
+
+    def __init__(self, workers=4, max_pending=100, retention=3600, max_jobs=1000,
+                 webhook_secret=None, webhook_timeout=10, webhook_attempts=3, webhook_allowed_hosts=(),
+                 shared=None, poll_interval=0.5):
+        """
+        Args:
+            workers: Jobs executed at the same time.
+            max_pending: Jobs allowed to wait for a worker before submit() refuses more.
+            retention: Seconds a finished job (and its result) stays retrievable.
+            max_jobs: Upper bound on retained jobs; the oldest finished ones go first.
+            webhook_secret: If set, webhook bodies are signed with HMAC-SHA256 (X-Signature header).
+            webhook_timeout: Seconds per webhook delivery attempt.
+            webhook_attempts: Delivery attempts before a webhook is given up.
+            webhook_allowed_hosts: Webhook hosts exempt from the public-address check.
+            shared: Optional SharedState of a multi-worker gateway.
+            poll_interval: Seconds between checks of other workers' jobs and cancel requests.
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self.max_jobs = max_jobs
+        self.webhook_secret = webhook_secret
+        self.webhook_timeout = webhook_timeout
+        self.webhook_attempts = webhook_attempts
+        self.webhook_allowed_hosts = frozenset(host.lower() for host in webhook_allowed_hosts)
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self._jobs = OrderedDict()
+        self._queue = None
+        self._workers = []
+        self._deliveries = set()
+        self.stats = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0,
+                      "rejected": 0, "webhooks_delivered": 0, "webhooks_failed": 0}
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.shared is not None:
+            self._workers.append(asyncio.create_task(self._watch_cancellations()))
+
+    async def close(self):
+        for task in self._workers + list(self._deliveries):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._deliveries, return_exceptions=True)
+        self._workers = []
+
+    def pending(self):
+        return sum(1 for job in self._jobs.values() if job.status == 'queued')
+
+    def running(self):
+        return sum(1 for job in self._jobs.values() if job.status == 'running')
+
+    def submit(self, run, model, webhook_url=None, cleanup=None):
+        """
+        Queues `run` (a zero-argument coroutine factory) as a new job.
+
+        `cleanup` is called once the job has finished, whether or not it ever ran.
+
+        Raises:
+            JobQueueFullError: max_pending jobs are already waiting.
+        """
+        self._expire()
+        if self.pending() >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise JobQueueFullError(f"Too many queued jobs ({self.max_pending}); retry later.")
+        job = Job(run, model, webhook_url, cleanup)
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        self.stats["submitted"] += 1
+        self._publish(job)
+        return job
+
+    async def get(self, job_id):
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is None and self.shared is not None:
+            row = await self.shared.read(self.shared.get_job, job_id)
+            job = RemoteJob(row[1]) if row is not None else None
+        return job
+
+    async def list(self):
+        self._expire()
+        if self.shared is not None:
+            documents = await self.shared.read(self.shared.jobs)
+            return [self._jobs.get(document["id"]) or RemoteJob(document) for document in documents]
+        return list(self._jobs.values())
+
+    async def wait(self, job, timeout):
+        """
+        Waits up to `timeout` seconds for `job` to finish (long polling).
+
+        Returns:
+            The job; for another worker's job, a fresh snapshot of it.
+        """
+        if isinstance(job, RemoteJob):
+            deadline = time.monotonic() + timeout
+            while not job.finished and time.monotonic() < deadline:
+                await asyncio.sleep(min(self.poll_interval, deadline - time.monotonic()))
+                job = await self.get(job.id) or job
+            return job
+        if not job.finished and timeout > 0:
+            try:
+                await asyncio.wait_for(job._done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def cancel(self, job):
+        """Cancels a queued or running job; returns False if it had already finished."""
+        if job.finished:
+            return False
+        if isinstance(job, RemoteJob):
+            # The owning worker picks the request up in _watch_cancellations().
+            self.shared.defer(self.shared.request_job_cancel, job.id)
+        elif job._task is not None:
+            job._task.cancel()
+        else:
+            self._finish(job, 'cancelled', error={"message": "Job was cancelled.", "code": 499})
+        return True
+
+    def _expire(self):
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(self._jobs) - self.max_jobs
+        for job in finished:
+            if now - job.finished_at > self.retention or excess > 0:
+                del self._jobs[job.id]
+                excess -= 1
+                if self.shared is not None:
+                    self.shared.defer(self.shared.delete_job, job.id)
+
+    def _publish(self, job):
+        if self.shared is not None:
+            self.shared.defer(self.shared.put_job, job.to_dict(), job.finished)
+
+    async def _watch_cancellations(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                job_ids = await self.shared.read(self.shared.job_cancel_requests)
+            except Exception as e:
+                log.warning("Could not read job cancel requests", extra={"error": str(e)})
+                continue
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    self.cancel(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            if job.finished:
+                continue
+            job.status = 'running'
+            job.started_at = time.time()
+            self._publish(job)
+            job._task = asyncio.ensure_future(job._run())
+            try:
+                outcome = await job._task
+            except asyncio.CancelledError:
+                if not job._task.cancelled():
+                    raise
+                self._finish(job, 'cancelled', error={"message": "Job was cancelled.", "code": 499})
+                continue
+            except Exception as e:
+                log.exception("Background job failed", extra={"job_id": job.id})
+                self._finish(job, 'failed', error={"message": f"Internal error: {e}", "code": 500})
+                continue
+            if isinstance(outcome, tuple):
+                error_body, status_code = outcome[0], outcome[1]
+                self._finish(job, 'failed', error={**error_body.get("error", error_body), "code": status_code})
+            else:
+                self._finish(job, 'succeeded', result=outcome)
+
+    def _finish(self, job, status, result=None, error=None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job._run = None
+        job._task = None
+        job._done.set()
+        self._publish(job)
+        cleanup, job._cleanup = job._cleanup, None
+        if cleanup is not None:
+            cleanup()
+        self.stats[status] += 1
+        log.info("Job finished", extra={"job_id": job.id, "status": status, "model": job.model,
+                                        "seconds": round(job.finished_at - job.created_at, 3)})
+        if job.webhook_url:
+            delivery = asyncio.create_task(self._deliver(job))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+
+    async def check_webhook(self, url):
+        """Validates a webhook URL (see check_webhook_url); raises WebhookURLError."""
+        await check_webhook_url(url, self.webhook_allowed_hosts)
+
+    async def _deliver(self, job):
+        from curl_cffi.requests import AsyncSession
+
+        try:
+            # Checked again at delivery time, in case the host now resolves elsewhere.
+            await self.check_webhook(job.webhook_url)
+        except WebhookURLError as e:
+            self.stats["webhooks_failed"] += 1
+            log.warning("Webhook URL refused", extra={"job_id": job.id, "error": str(e)})
+            return
+        body = json.dumps(job.to_dict()).encode('utf-8')
+        headers = {"Content-Type": "application/json"}
+        if self.webhook_secret:
+            signature = hmac.new(self.webhook_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+            headers["X-Signature"] = f"sha256={signature}"
+        async with AsyncSession(timeout=self.webhook_timeout) as session:
+            for attempt in range(self.webhook_attempts):
+                try:
+                    response = await session.post(job.webhook_url, data=body, headers=headers,
+                                                  allow_redirects=False)
+                    if response.status_code < 500:
+                        self.stats["webhooks_delivered"] += 1
+                        return
+                    error = f"HTTP {response.status_code}"
+                except Exception as e:
+                    error = str(e)
+                await asyncio.sleep(2 ** attempt)
+        self.stats["webhooks_failed"] += 1
+        log.warning("Webhook delivery failed", extra={"job_id": job.id, "error": error})
+
+    def status(self):
+        return {"jobs": len(self._jobs), "queued": self.pending(), "running": self.running(),
+                "workers": self.workers, **self.stats}
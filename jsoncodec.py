@@ -0,0 +1,46 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The codec in use: 'orjson' when it is installed, else the standard library.
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so this catches both.
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def loads(data):
+    """Parses JSON from a str or UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_bytes(obj, default=None):
+    """
+    Serializes `obj` as compact UTF-8 JSON bytes.
+
+    Args:
+        obj: The value to serialize.
+        default: Optional callable converting otherwise unsupported objects.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=_OPTIONS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which the standard library handles.
+            pass
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj, default=None):
+    """Like dumps_bytes(), but returns a str (e.g. for server-sent event lines)."""
+    if orjson is not None:
+        return dumps_bytes(obj, default).decode('utf-8')
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':'))
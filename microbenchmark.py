@@ -0,0 +1,112 @@
+"""
+Micro-benchmarks for answer extraction and JSON encoding.
+
+Each case runs with the standard library codec and, when it is installed,
+with orjson (see jsoncodec), over Perplexity response shapes produced by the
+fake backend's wire format:
+
+    python microbenchmark.py
+    python microbenchmark.py --cases extract-deep-research serialize --json
+"""
+import argparse
+import json
+import timeit
+import uuid
+from contextlib import contextmanager
+
+import jsoncodec
+from answers import extract_answer
+from fake_backend import FakeBackendSettings, FakePerplexityClient
+
+
+def recorded_response(answer_chars, web_results, seed=0):
+    """A completed search() result as the client decodes it from the wire."""
+    client = FakePerplexityClient(settings=FakeBackendSettings(
+        answer_chars=answer_chars, web_results=web_results, seed=seed))
+    query = "How do gateways extract answers?"
+    message = client._wire_message(query, 'pro', client._answer_text(query), client._web_results(query),
+                                   True, str(uuid.uuid4()))
+    return client._decode(message)
+
+
+def partial_response(response, fraction):
+    """`response` as a mid-stream chunk: the FINAL step's JSON payload cut off at `fraction`."""
+    steps = [dict(step) for step in response['text']]
+    payload = steps[-1]['content']['answer']
+    steps[-1] = {**steps[-1], 'content': {'answer': payload[:int(len(payload) * fraction)]}}
+    return {**response, 'text': steps, 'status': 'pending'}
+
+
+def build_cases():
+    """Returns {name: (function, argument)}; each function is timed on its argument."""
+    auto = recorded_response(answer_chars=1200, web_results=5)
+    deep = recorded_response(answer_chars=40000, web_results=60)
+    answer = extract_answer(deep)
+    multi_step = {'text': [{'step_type': 'SEARCH_WEB', 'content': {'answer': "First part of the answer."}},
+                           {'step_type': 'SEARCH_RESULTS', 'content': {'answer': answer[:2000]}},
+                           {'step_type': 'FINAL', 'content': {}}]}
+    completion = {
+        "id": f"chatcmpl-{uuid.uuid4()}", "object": "chat.completion", "created": 0,
+        "model": "perplexity-chat/deep-research",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": 9000, "total_tokens": 10200},
+    }
+    chat_request = json.dumps({
+        "model": "perplexity-chat/auto",
+        "messages": [{"role": "user" if i % 2 == 0 else "assistant", "content": answer[:2000]} for i in range(40)],
+    })
+    return {
+        "extract-auto": (extract_answer, auto),
+        "extract-deep-research": (extract_answer, deep),
+        "extract-stream-partial": (lambda resp: extract_answer(resp, partial=True), partial_response(deep, 0.6)),
+        "extract-dict": (extract_answer, {'text': {'answer': answer}, 'step_type': 'FINAL'}),
+        "extract-multi-step": (extract_answer, multi_step),
+        "serialize": (jsoncodec.dumps_bytes, completion),
+        "parse-request": (jsoncodec.loads, chat_request),
+    }
+
+
+@contextmanager
+def codec(name):
+    """Switches jsoncodec to `name` ('json' or 'orjson') for the duration of the block."""
+    saved = jsoncodec.orjson
+    if name == 'json':
+        jsoncodec.orjson = None
+    try:
+        yield
+    finally:
+        jsoncodec.orjson = saved
+
+
+def measure(function, argument, repeat):
+    """Best-of-`repeat` seconds per call."""
+    timer = timeit.Timer(lambda: function(argument))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main(args):
+    cases = build_cases()
+    codecs = ['json'] + (['orjson'] if jsoncodec.orjson is not None else [])
+    results = []
+    for name in args.cases or list(cases):
+        function, argument = cases[name]
+        for codec_name in codecs:
+            with codec(codec_name):
+                seconds = measure(function, argument, args.repeat)
+            results.append({"case": name, "codec": codec_name, "us_per_op": seconds * 1e6})
+    if args.json:
+        print(json.dumps({"results": results}, indent=2))
+        return
+    print(f"{'case':<24} {'codec':<7} {'us/op':>10} {'ops/s':>11}")
+    for result in results:
+        print(f"{result['case']:<24} {result['codec']:<7} {result['us_per_op']:>10.1f} "
+              f"{1e6 / result['us_per_op']:>11.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark answer extraction and JSON encoding.")
+    parser.add_argument('--cases', nargs='+', default=None, help="Cases to run (default: all).")
+    parser.add_argument('--repeat', type=int, default=5, help="Timing repetitions; the best one counts.")
+    parser.add_argument('--json', action='store_true', default=False, help="Print results as JSON.")
+    main(parser.parse_args())
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from collections import deque
+
+
+def parse_fallback_chains(spec, known_models, prefix):
+    """
+    Parses model fallback chains such as 'pro-gpt-4.5>pro-sonar>auto,reasoning-r1>reasoning-default'.
+
+    Model IDs may be given with or without the '<prefix>/' part.
+
+    Returns:
+        A dictionary mapping each chain's first model ID to the full chain.
+    """
+    chains = {}
+    if not spec:
+        return chains
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        chain = []
+        for model_id in item.split('>'):
+            model_id = model_id.strip()
+            if not model_id.startswith(prefix + '/'):
+                model_id = f"{prefix}/{model_id}"
+            if model_id not in known_models:
+                raise ValueError(f"Unknown model '{model_id}' in fallback chain '{item}'")
+            chain.append(model_id)
+        chains[chain[0]] = chain
+    return chains
+
+
+class CircuitBreaker:
+    """
+    Per-model circuit breakers.
+
+    A model's circuit opens after `failures` upstream errors within `window`
+    seconds; requests then skip it for `open_for` seconds. After that one
+    trial request is let through (half-open) and the circuit stays shut to
+    everyone else for another `open_for` seconds: success closes it, failure
+    opens it again.
+    """
+
+    def __init__(self, failures=5, window=60, open_for=30):
+        """
+        Args:
+            failures: Errors within `window` that open a circuit (0 disables the breakers).
+            window: Seconds over which errors are counted.
+            open_for: Seconds an open circuit rejects requests before a trial.
+        """
+        self.failures = failures
+        self.window = window
+        self.open_for = open_for
+        self._errors = {}
+        self._open_until = {}
+        self.stats = {"opened": 0, "short_circuited": 0}
+
+    def allow(self, key):
+        """True if a request for `key` may go upstream now."""
+        open_until = self._open_until.get(key)
+        if open_until is None:
+            return True
+        now = time.monotonic()
+        if now < open_until:
+            self.stats["short_circuited"] += 1
+            return False
+        self._open_until[key] = now + self.open_for
+        return True
+
+    def retry_after(self, key):
+        """Seconds until an open circuit for `key` allows a trial request."""
+        return max(0.0, self._open_until.get(key, 0.0) - time.monotonic())
+
+    def record(self, key, success):
+        """Feeds the outcome of an upstream call for `key` into its breaker."""
+        if not self.failures:
+            return
+        if success:
+            self._errors.pop(key, None)
+            self._open_until.pop(key, None)
+            return
+        now = time.monotonic()
+        errors = self._errors.setdefault(key, deque())
+        errors.append(now)
+        while errors and now - errors[0] > self.window:
+            errors.popleft()
+        if key in self._open_until or len(errors) >= self.failures:
+            if key not in self._open_until:
+                self.stats["opened"] += 1
+            self._open_until[key] = now + self.open_for
+            errors.clear()
+
+    def is_open(self, key):
+        return key in self._open_until
+
+    def status(self):
+        return {"open": len(self._open_until), **self.stats}
+
+
+class LatencyTracker:
+    """Recent successful upstream latencies per model, for adaptive hedging delays."""
+
+    def __init__(self, samples=200, min_samples=20):
+        self.samples = samples
+        self.min_samples = min_samples
+        self._latencies = {}
+
+    def record(self, key, seconds):
+        self._latencies.setdefault(key, deque(maxlen=self.samples)).append(seconds)
+
+    def quantile(self, key, q):
+        """The `q` quantile of `key`'s recent latencies, or None with too few samples."""
+        latencies = self._latencies.get(key)
+        if not latencies or len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def hedged(attempt, delay):
+    """
+    Runs attempt(0) and, if it has not finished after `delay` seconds, a hedge attempt(1).
+
+    attempt(index) returns a coroutine, or None when no hedge can be made.
+    An attempt's outcome is a result, or a tuple (error_dict, status_code, ...)
+    for a failure. The first result wins and the other attempt is cancelled;
+    if both fail, the later failure is returned.
+
+    Returns:
+        A tuple (outcome, hedge_launched, hedge_won).
+    """
+    tasks = [asyncio.ensure_future(attempt(0))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return tasks[0].result(), False, False
+        hedge = attempt(1)
+        if hedge is None:
+            return await tasks[0], False, False
+        tasks.append(asyncio.ensure_future(hedge))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                outcome = task.result()
+                if not isinstance(outcome, tuple):
+                    return outcome, True, task is tasks[1]
+        return outcome, True, False
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
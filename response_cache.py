@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import jsoncodec
+
+DEFAULT_TTLS = {
+    'auto': 300,
+    'pro': 3600,
+    'reasoning': 3600,
+    'deep research': 86400,
+}
+
+
+def parse_ttl_spec(spec):
+    """
+    Parses a TTL specification such as 'auto=300,deep-research=86400'.
+
+    Keys may be Perplexity modes (dashes stand for spaces) or full model IDs.
+
+    Returns:
+        A dictionary of TTL overrides in seconds.
+    """
+    ttls = {}
+    if not spec:
+        return ttls
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, seconds = item.rpartition('=')
+        key = key.strip()
+        if '/' not in key:
+            key = key.replace('-', ' ')
+        ttls[key] = float(seconds)
+    return ttls
+
+
+def normalize_prompt(prompt):
+    """Normalizes line endings and trailing whitespace so trivial variations share a key."""
+    lines = prompt.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+
+def file_digest(content):
+    digest = getattr(content, 'digest', None)
+    if digest is not None:
+        return digest
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class DiskBackend:
+    """SQLite-backed second cache tier that survives restarts."""
+
+    def __init__(self, path, max_entries, max_bytes):
+        if os.path.isdir(path):
+            path = os.path.join(path, 'response_cache.sqlite3')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' key TEXT PRIMARY KEY, expires_at REAL, size INTEGER,'
+            ' accessed_at REAL, payload BLOB)'
+        )
+
+    def get(self, key, now):
+        row = self.conn.execute(
+            'SELECT expires_at, payload FROM entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        expires_at, payload = row
+        if expires_at <= now:
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            return None
+        self.conn.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+        return expires_at, payload
+
+    def put(self, key, payload, expires_at, now):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO entries (key, expires_at, size, accessed_at, payload) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, expires_at, len(payload), now, payload)
+        )
+        self._evict(now)
+
+    def _evict(self, now):
+        self.conn.execute('DELETE FROM entries WHERE expires_at <= ?', (now,))
+        count, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY accessed_at').fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            count -= 1
+            total -= size
+
+    def close(self):
+        self.conn.close()
+
+
+class ResponseCache:
+    """
+    LRU cache of completed chat completion responses.
+
+    Entries are bounded by count and by total serialized size, expire after a
+    per-model TTL, and can optionally be mirrored to an on-disk SQLite file.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttls=None, disk_path=None):
+        """
+        Args:
+            max_entries: Maximum number of cached responses.
+            max_bytes: Maximum total size of cached responses (serialized JSON).
+            ttls: TTL overrides by mode or model ID, merged over DEFAULT_TTLS.
+            disk_path: Optional SQLite file or directory for the persistent tier.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.disk = DiskBackend(disk_path, max_entries, max_bytes) if disk_path else None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bypasses": 0}
+
+    @staticmethod
+    def make_key(model_id_with_prefix, prompt, files_dict, language, sources):
+        """Builds the cache key from the model, prompt, attachment digests and search settings."""
+        files = sorted(
+            (filename, file_digest(content)) for filename, content in (files_dict or {}).items()
+        )
+        material = json.dumps(
+            [model_id_with_prefix, normalize_prompt(prompt), files, language, sorted(sources or [])],
+            separators=(',', ':')
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def ttl_for(self, model_id_with_prefix, mode):
+        if model_id_with_prefix in self.ttls:
+            return self.ttls[model_id_with_prefix]
+        return self.ttls.get(mode, self.ttls['auto'])
+
+    def _drop(self, key):
+        expires_at, payload = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+    def _store_memory(self, key, payload, expires_at):
+        if key in self._entries:
+            self._drop(key)
+        if len(payload) > self.max_bytes:
+            return
+        self._entries[key] = (expires_at, payload)
+        self._bytes += len(payload)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.stats["evictions"] += 1
+
+    def get(self, key):
+        """Returns the cached response dictionary for `key`, or None on a miss."""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, payload = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return jsoncodec.loads(payload)
+            self._drop(key)
+        if self.disk is not None:
+            row = self.disk.get(key, now)
+            if row is not None:
+                expires_at, payload = row
+                self._store_memory(key, payload, expires_at)
+                self.stats["hits"] += 1
+                return jsoncodec.loads(payload)
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, response, ttl):
+        if ttl <= 0:
+            return
+        now = time.time()
+        payload = jsoncodec.dumps_bytes(response)
+        self._store_memory(key, payload, now + ttl)
+        if self.disk is not None:
+            self.disk.put(key, payload, now + ttl, now)
+        self.stats["stores"] += 1
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def status(self):
+        return {"entries": len(self._entries), "bytes": self._bytes, **self.stats}
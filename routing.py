@@ -0,0 +1,83 @@
+import random
+import time
+
+
+class _ModelStats:
+    __slots__ = ('latency', 'error_rate', 'weight', 'updated_at')
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.weight = 0.0
+        self.updated_at = time.monotonic()
+
+
+class LatencyRouter:
+    """
+    Picks the currently quickest model for virtual model IDs such as `fastest`.
+
+    Every finished upstream call updates its model's latency and error rate
+    as exponentially decayed moving averages: a sample's influence halves
+    every `half_life` seconds, so the statistics follow upstream conditions
+    without a fixed window. A model's score is its expected time to a
+    successful answer, latency / (1 - error_rate). The best-scoring model
+    is chosen, except that a fraction `explore` of requests goes to a random
+    candidate so models that were slow (or never tried) get re-measured.
+    """
+
+    def __init__(self, half_life=300, explore=0.05, seed=None):
+        """
+        Args:
+            half_life: Seconds after which a sample counts half as much.
+            explore: Share of routed requests sent to a random candidate.
+            seed: Optional random seed (for reproducible tests and benchmarks).
+        """
+        self.half_life = half_life
+        self.explore = explore
+        self._random = random.Random(seed)
+        self._stats = {}
+        self.stats = {"routed": 0, "explored": 0}
+
+    def record(self, model_id, seconds, success):
+        """Feeds one finished upstream call for `model_id` into its averages."""
+        entry = self._stats.get(model_id)
+        if entry is None:
+            entry = self._stats[model_id] = _ModelStats()
+        now = time.monotonic()
+        decay = 0.5 ** ((now - entry.updated_at) / self.half_life) if self.half_life else 0.0
+        entry.updated_at = now
+        weight = entry.weight * decay
+        entry.weight = weight + 1.0
+        entry.error_rate = (entry.error_rate * weight + (0.0 if success else 1.0)) / entry.weight
+        # Failures often return quickly; only successes say how long an answer takes.
+        if success:
+            entry.latency = seconds if entry.latency is None else (
+                (entry.latency * weight + seconds) / entry.weight)
+
+    def score(self, model_id):
+        """Expected seconds to a successful answer from `model_id`, or None if it has no successes yet."""
+        entry = self._stats.get(model_id)
+        if entry is None or entry.latency is None:
+            return None
+        return entry.latency / max(1.0 - entry.error_rate, 0.01)
+
+    def choose(self, candidates):
+        """
+        Picks one of `candidates` (model IDs) for a routed request.
+
+        Returns:
+            The chosen model ID.
+        """
+        self.stats["routed"] += 1
+        scored = [(score, model_id) for model_id in candidates
+                  for score in (self.score(model_id),) if score is not None]
+        if not scored or self._random.random() < self.explore:
+            self.stats["explored"] += 1
+            return self._random.choice(candidates)
+        return min(scored)[1]
+
+    def status(self):
+        """Per-model statistics: {model_id: {"latency": s, "error_rate": r, "score": s}}."""
+        return {model_id: {"latency": entry.latency, "error_rate": entry.error_rate,
+                           "score": self.score(model_id)}
+                for model_id, entry in self._stats.items()}
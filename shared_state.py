@@ -0,0 +1,248 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    worker INTEGER NOT NULL, key TEXT NOT NULL, value INTEGER NOT NULL,
+    PRIMARY KEY (worker, key));
+CREATE TABLE IF NOT EXISTS account_health (
+    name TEXT PRIMARY KEY, cooldown_until REAL NOT NULL, strikes INTEGER NOT NULL, blocked TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS account_usage (name TEXT NOT NULL, mode TEXT NOT NULL, at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS account_usage_by_mode ON account_usage (mode, at);
+CREATE TABLE IF NOT EXISTS threads (
+    key TEXT PRIMARY KEY, account TEXT NOT NULL, backend_uuid TEXT NOT NULL,
+    attachments TEXT NOT NULL, created_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY, worker INTEGER NOT NULL, document TEXT NOT NULL,
+    finished INTEGER NOT NULL, cancel_requested INTEGER NOT NULL DEFAULT 0);
+"""
+
+
+class SharedState:
+    """
+    State shared by the worker processes of one gateway, in a SQLite file in WAL mode.
+
+    Every process opens its own connection (after forking). Per-process
+    counters such as in-flight requests are stored per worker PID and summed
+    by readers, so a crashed worker's share can be dropped with
+    forget_worker(). Account timestamps are time.monotonic() values, which
+    all processes on one host share; the file is recreated at every start.
+
+    The methods below are blocking. On the event loop, use defer() for
+    writes and `await read()` for queries: both run on one database thread
+    in submission order, so a read sees every write deferred before it, and
+    a busy database (another worker holding the write lock) never stalls
+    the loop.
+    """
+
+    def __init__(self, path, worker=None):
+        """
+        Args:
+            path: SQLite database file.
+            worker: ID this process writes its counters under (defaults to its PID).
+        """
+        self.path = path
+        self.worker = worker if worker is not None else os.getpid()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # The file only lives as long as the gateway, so durability is not needed.
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.executescript(_SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._writes = []
+        self._writes_lock = threading.Lock()
+        self._flush_scheduled = False
+
+    @classmethod
+    def create(cls, path):
+        """Starts a fresh database at `path`, discarding one left over from an earlier run."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        return cls(path)
+
+    def close(self):
+        """Writes out deferred writes and closes the database."""
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    def defer(self, method, *args):
+        """
+        Queues a write, e.g. defer(state.set_counter, key, value), and returns at once.
+
+        Writes queued while the database thread is busy are written together,
+        in order, by the next flush.
+        """
+        with self._writes_lock:
+            self._writes.append((method, args))
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._executor.submit(self._flush)
+
+    def _flush(self):
+        while True:
+            with self._writes_lock:
+                writes, self._writes = self._writes, []
+                if not writes:
+                    self._flush_scheduled = False
+                    return
+            for method, args in writes:
+                try:
+                    method(*args)
+                except Exception as e:
+                    log.warning("Shared state write failed",
+                                extra={"write": getattr(method, '__name__', str(method)), "error": str(e)})
+
+    async def read(self, method, *args):
+        """Runs a query such as read(state.get_job, job_id) on the database thread and returns its result."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(method, *args))
+
+    def set_counter(self, key, value):
+        """Publishes this worker's current value of counter `key`."""
+        self._db.execute("INSERT OR REPLACE INTO counters (worker, key, value) VALUES (?, ?, ?)",
+                         (self.worker, key, value))
+
+    def other_counters(self, prefix):
+        """Sums of the other workers' counters whose key starts with `prefix`: {key: total}."""
+        rows = self._db.execute(
+            "SELECT key, SUM(value) FROM counters WHERE worker != ? AND substr(key, 1, ?) = ? GROUP BY key",
+            (self.worker, len(prefix), prefix))
+        return dict(rows)
+
+    def claim_counters(self, values, limits):
+        """
+        Sets this worker's counters to `values` unless that takes a total over its limit.
+
+        The check and the write are one transaction, so two workers cannot
+        both take the last free slot.
+
+        Args:
+            values: {key: this worker's new value}.
+            limits: {key: limit for the total over all workers} (0 or missing for none).
+
+        Returns:
+            None if the counters were set, otherwise the other workers' totals {key: total}.
+        """
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            others = {key: self._db.execute(
+                "SELECT COALESCE(SUM(value), 0) FROM counters WHERE worker != ? AND key = ?",
+                (self.worker, key)).fetchone()[0] for key in values}
+            if any(limits.get(key) and others[key] + value > limits[key] for key, value in values.items()):
+                self._db.execute("ROLLBACK")
+                return others
+            self._db.executemany("INSERT OR REPLACE INTO counters (worker, key, value) VALUES (?, ?, ?)",
+                                 [(self.worker, key, value) for key, value in values.items()])
+            self._db.execute("COMMIT")
+            return None
+        except BaseException:
+            if self._db.in_transaction:
+                self._db.execute("ROLLBACK")
+            raise
+
+    def set_account_health(self, name, cooldown_until, strikes, blocked):
+        self._db.execute("INSERT OR REPLACE INTO account_health VALUES (?, ?, ?, ?)",
+                         (name, cooldown_until, strikes, json.dumps(blocked)))
+
+    def account_health(self):
+        """{account_name: (cooldown_until, strikes, {mode: blocked_until})} for accounts any worker penalized."""
+        return {name: (cooldown_until, strikes, json.loads(blocked))
+                for name, cooldown_until, strikes, blocked in self._db.execute("SELECT * FROM account_health")}
+
+    def record_usage(self, name, mode, at):
+        self._db.execute("INSERT INTO account_usage VALUES (?, ?, ?)", (name, mode, at))
+
+    def usage(self, mode, since):
+        """Request timestamps per account for `mode` after `since`, oldest first: {name: [at, ...]}."""
+        self._db.execute("DELETE FROM account_usage WHERE mode = ? AND at <= ?", (mode, since))
+        usage = {}
+        for name, at in self._db.execute(
+                "SELECT name, at FROM account_usage WHERE mode = ? ORDER BY at", (mode,)):
+            usage.setdefault(name, []).append(at)
+        return usage
+
+    def put_thread(self, key, account, backend_uuid, attachments, created_at, max_entries):
+        # Replacing a row gives it a new rowid, so rowid order is least recently stored first.
+        self._db.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?, ?)",
+                         (key, account, backend_uuid, json.dumps(attachments), created_at))
+        return self._db.execute(
+            "DELETE FROM threads WHERE rowid <= (SELECT MAX(rowid) FROM threads) - ?", (max_entries,)).rowcount
+
+    def get_threads(self, keys):
+        """{key: (account, backend_uuid, attachments, created_at)} for those of `keys` that are stored."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self._db.execute(
+            f"SELECT key, account, backend_uuid, attachments, created_at FROM threads "
+            f"WHERE key IN ({', '.join('?' * len(keys))})", keys)
+        return {key: (account, backend_uuid, json.loads(attachments), created_at)
+                for key, account, backend_uuid, attachments, created_at in rows}
+
+    def delete_thread(self, key):
+        self._db.execute("DELETE FROM threads WHERE key = ?", (key,))
+
+    def count_threads(self):
+        return self._db.execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+
+    def put_job(self, document, finished):
+        """Publishes a job owned by this worker (`document` is its to_dict())."""
+        self._db.execute(
+            "INSERT INTO jobs (id, worker, document, finished) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET document = excluded.document, finished = excluded.finished",
+            (document["id"], self.worker, json.dumps(document), int(finished)))
+
+    def get_job(self, job_id):
+        """Returns (owner_worker, document), or None."""
+        row = self._db.execute("SELECT worker, document FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def jobs(self):
+        return [json.loads(document) for document, in self._db.execute("SELECT document FROM jobs ORDER BY rowid")]
+
+    def delete_job(self, job_id):
+        self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def request_job_cancel(self, job_id):
+        self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND finished = 0", (job_id,))
+
+    def job_cancel_requests(self):
+        """IDs of this worker's jobs another worker asked to cancel (each is reported once)."""
+        ids = [job_id for job_id, in self._db.execute(
+            "SELECT id FROM jobs WHERE worker = ? AND cancel_requested = 1", (self.worker,))]
+        if ids:
+            self._db.execute("UPDATE jobs SET cancel_requested = 0 WHERE worker = ? AND cancel_requested = 1",
+                             (self.worker,))
+        return ids
+
+    def forget_worker(self, worker, finished_at):
+        """
+        Drops a dead worker's counters and fails the jobs it was still running.
+
+        Returns:
+            The number of jobs marked failed.
+        """
+        self._db.execute("DELETE FROM counters WHERE worker = ?", (worker,))
+        failed = 0
+        for job_id, document in list(self._db.execute(
+                "SELECT id, document FROM jobs WHERE worker = ? AND finished = 0", (worker,))):
+            document = json.loads(document)
+            document.update(status='failed', completed_at=int(finished_at),
+                            error={"message": "The worker running this job exited.", "code": 500})
+            self._db.execute("UPDATE jobs SET document = ?, finished = 1 WHERE id = ?",
+                             (json.dumps(document), job_id))
+            failed += 1
+        return failed
@@ -0,0 +1,75 @@
+import asyncio
+import copy
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls into one.
+
+    The first caller for a key starts the call in its own task; callers that
+    arrive with the same key while it is running wait for that task and get a
+    copy of its result. A follower that waits longer than max_wait gives up
+    and makes its own call. The shared task is cancelled only once every
+    caller waiting on it has gone away.
+    """
+
+    def __init__(self, max_wait=300):
+        """
+        Args:
+            max_wait: Seconds a follower waits for the shared call before
+                making its own (None waits indefinitely).
+        """
+        self.max_wait = max_wait
+        self._flights = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "follower_timeouts": 0}
+
+    def in_flight(self):
+        return len(self._flights)
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _wait(self, key, flight, timeout):
+        flight.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), timeout)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    async def do(self, key, coro_factory):
+        """
+        Runs `coro_factory()` once per key across concurrent callers.
+
+        Args:
+            key: Hashable identity of the call.
+            coro_factory: Zero-argument callable returning the coroutine to run.
+
+        Returns:
+            The call's result (followers receive a deep copy of it).
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+            try:
+                result = await self._wait(key, flight, self.max_wait)
+                return copy.deepcopy(result)
+            except asyncio.TimeoutError:
+                self.stats["follower_timeouts"] += 1
+                return await coro_factory()
+
+        task = asyncio.ensure_future(coro_factory())
+        flight = _Flight(task)
+        self._flights[key] = flight
+        task.add_done_callback(lambda _task: self._forget(key, flight))
+        self.stats["leaders"] += 1
+        return await self._wait(key, flight, None)
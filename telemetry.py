@@ -0,0 +1,346 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import (Counter, Gauge, Histogram, REGISTRY, CollectorRegistry, generate_latest,
+                               CONTENT_TYPE_LATEST)
+from prometheus_client.core import GaugeMetricFamily
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+REQUESTS = Counter(
+    'pplx_gateway_requests_total', 'Chat completion requests by model ID and HTTP status.',
+    ['model', 'status'])
+REQUEST_LATENCY = Histogram(
+    'pplx_gateway_request_duration_seconds', 'End-to-end chat completion latency.',
+    ['model'], buckets=LATENCY_BUCKETS)
+STAGE_LATENCY = Histogram(
+    'pplx_gateway_stage_duration_seconds', 'Time spent in each request stage.',
+    ['model', 'stage'], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    'pplx_gateway_requests_in_flight', 'Chat completion requests currently being handled.',
+    multiprocess_mode='livesum')
+UPSTREAM_IN_FLIGHT = Gauge(
+    'pplx_gateway_upstream_in_flight', 'Perplexity searches currently running, by model ID.',
+    ['model'], multiprocess_mode='livesum')
+UPLOAD_BYTES = Counter(
+    'pplx_gateway_upload_bytes_total', 'Attachment bytes received, by source.',
+    ['source'])
+TOKENS = Counter(
+    'pplx_gateway_tokens_total', 'Locally counted prompt and completion tokens, by model ID.',
+    ['model', 'kind'])
+PROMPT_MESSAGES_DROPPED = Counter(
+    'pplx_gateway_prompt_messages_dropped_total', 'Older messages left out to fit a prompt token budget.',
+    ['model'])
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+_STANDARD_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; anything passed via `extra=` becomes a field."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Human-readable lines with `extra=` fields appended as key=value pairs."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(
+            f"{key}={value}" for key, value in record.__dict__.items()
+            if key not in _STANDARD_RECORD_ATTRS
+        )
+        return f"{line} {fields}" if fields else line
+
+
+def setup_logging(level='INFO', fmt='text'):
+    """Configures the root logger for the gateway (text or json lines on stdout)."""
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(KeyValueFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+
+
+class RequestTimer:
+    """Accumulates per-stage durations (and a few descriptive fields) for one request."""
+
+    __slots__ = ('started', 'stages', 'fields')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """The stages so far as a Server-Timing header value (durations in milliseconds)."""
+        metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        metrics.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+class SlowRequestLog:
+    """
+    The slowest recently finished requests, per model, for GET /admin/slow-requests.
+
+    For each model label the `size` slowest requests finished within the
+    last `window` seconds are kept in a min-heap, so recording a request
+    that is not among them costs one comparison. Entries hold stage
+    timings and the fields passed to annotate() (model, sizes, flags),
+    never prompt text. A size of 0 disables the log.
+    """
+
+    def __init__(self, size=0, window=3600):
+        """
+        Args:
+            size: Requests kept per model (0 disables the log).
+            window: Seconds after which a request no longer counts as recent.
+        """
+        self.size = size
+        self.window = window
+        self._heaps = {}
+        self._sequence = itertools.count()
+        self._next_prune = 0.0
+
+    def record(self, timer, status):
+        if not self.size:
+            return
+        seconds = timer.elapsed()
+        now = time.time()
+        if now >= self._next_prune:
+            self._prune(now)
+        heap = self._heaps.setdefault(timer.fields.get('model') or 'unknown', [])
+        if len(heap) >= self.size and seconds <= heap[0][0]:
+            return
+        entry = {
+            "finished_at": round(now, 3),
+            "duration_ms": round(seconds * 1000, 1),
+            "status": status,
+            **timer.fields,
+            "stages_ms": {name: round(value * 1000, 1) for name, value in timer.stages.items()},
+        }
+        item = (seconds, next(self._sequence), entry)
+        if len(heap) >= self.size:
+            heapq.heapreplace(heap, item)
+        else:
+            heapq.heappush(heap, item)
+
+    def _prune(self, now):
+        cutoff = now - self.window
+        for model, heap in list(self._heaps.items()):
+            kept = [item for item in heap if item[2]["finished_at"] >= cutoff]
+            if not kept:
+                del self._heaps[model]
+            elif len(kept) < len(heap):
+                heapq.heapify(kept)
+                self._heaps[model] = kept
+        self._next_prune = now + min(60.0, self.window / 10)
+
+    def entries(self, model=None):
+        """Recent slow requests, slowest first (optionally only those of `model`)."""
+        self._prune(time.time())
+        heaps = [self._heaps.get(model, [])] if model else self._heaps.values()
+        items = sorted((item for heap in heaps for item in heap), reverse=True)
+        return [entry for _, _, entry in items]
+
+
+slow_requests = SlowRequestLog()
+
+_current_timer = ContextVar('request_timer', default=None)
+
+
+def start_request(started=None):
+    """
+    Starts timing a request and makes it the current one for stage() calls.
+
+    Args:
+        started: Optional earlier time.perf_counter() value the request began at.
+    """
+    timer = RequestTimer()
+    if started is not None:
+        timer.started = started
+    _current_timer.set(timer)
+    REQUESTS_IN_FLIGHT.inc()
+    return timer
+
+
+def current_timer():
+    return _current_timer.get()
+
+
+def annotate(**fields):
+    """Attaches fields such as the model ID to the current request."""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.fields.update(fields)
+
+
+def record_stage(name, seconds):
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as `name` on the current request, if any."""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def finish_request(timer, status):
+    """Records a finished request's counters and latency histograms."""
+    REQUESTS_IN_FLIGHT.dec()
+    model = timer.fields.get('model') or 'unknown'
+    REQUESTS.labels(model, str(status)).inc()
+    REQUEST_LATENCY.labels(model).observe(timer.elapsed())
+    for name, seconds in timer.stages.items():
+        STAGE_LATENCY.labels(model, name).observe(seconds)
+    slow_requests.record(timer, status)
+
+
+class _RecordedStream:
+    """
+    The body of a streaming response. Runs the request's release callbacks
+    and records it exactly once: when the stream ends, fails or is closed.
+    Unlike a generator's finally block this also covers a body that is
+    closed before it was ever iterated (a client that disconnected first).
+    """
+
+    def __init__(self, stream, timer, status, releases):
+        self._stream = stream
+        self._timer = timer
+        self._status = status
+        self._releases = releases
+        self._sent = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        _current_timer.set(self._timer)
+        try:
+            item = await self._stream.__anext__()
+        except BaseException:
+            self._finish()
+            raise
+        if slow_requests.size:
+            self._sent += len(item.encode('utf-8') if isinstance(item, str) else item)
+        return item
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        timer, self._timer = self._timer, None
+        if timer is None:
+            return
+        try:
+            for release in self._releases:
+                release()
+        finally:
+            timer.fields['response_bytes'] = self._sent
+            finish_request(timer, self._status)
+
+
+def finish_after_stream(stream, timer, status=200, releases=()):
+    """
+    Wraps a streaming body so the request is recorded once it has been sent.
+
+    Args:
+        stream: The async generator producing the body.
+        timer: The request's RequestTimer.
+        status: HTTP status to record.
+        releases: Callables run first, e.g. freeing the request's admission
+            slot and upload budget; also run if the body is never iterated.
+    """
+    return _RecordedStream(stream, timer, status, releases)
+
+
+class StatusCollector:
+    """
+    Exposes the gateway's in-process status counters (pools, caches) as gauges.
+
+    Each provider is a callable returning (name, help, labels, value) tuples.
+    """
+
+    def __init__(self):
+        self.providers = []
+
+    def add(self, provider):
+        self.providers.append(provider)
+
+    def collect(self):
+        families = {}
+        for provider in self.providers:
+            for name, help_text, labels, value in provider():
+                if value is None:
+                    continue
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = GaugeMetricFamily(
+                        f'pplx_gateway_{name}', help_text, labels=sorted(labels))
+                family.add_metric([str(labels[key]) for key in sorted(labels)], float(value))
+        return list(families.values())
+
+
+status_collector = StatusCollector()
+REGISTRY.register(status_collector)
+
+
+def render_metrics():
+    """
+    Renders all metrics in the Prometheus text format.
+
+    With PROMETHEUS_MULTIPROC_DIR set (multi-worker mode), the request
+    metrics are summed over all worker processes; the status gauges always
+    describe the worker answering the scrape.
+    """
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest(REGISTRY)
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    registry.register(status_collector)
+    return generate_latest(registry)
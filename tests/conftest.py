@@ -0,0 +1,58 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The gateway's modules live at the repository root, next to app.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+API_KEY = "test-key"
+HEADERS = {"Authorization": f"Bearer {API_KEY}"}
+
+
+@pytest.fixture(scope="session")
+def gateway(tmp_path_factory):
+    """The app module, configured once with the fake backend and one upstream slot."""
+    import app
+
+    state = tmp_path_factory.mktemp("state")
+    parser = app.build_parser()
+    args = parser.parse_args([
+        '--backend', 'fake', '--fake-backend', 'latency_scale=0.001,sigma=0', '--api-key', API_KEY,
+        '--cookies-file', str(state / 'missing-cookies.txt'), '--file-store-dir', str(state / 'files'),
+        '--batch-dir', str(state / 'batches'), '--max-concurrency', '1'])
+    app.configure(args, parser)
+    return app
+
+
+class UpstreamCalls:
+    """Searches the fake backend received, as (query, keyword arguments) pairs."""
+
+    def __init__(self):
+        self.searches = []
+        # Non-streaming responses, in the order they were returned.
+        self.responses = []
+        # Seconds each search is held open before answering.
+        self.delay = 0
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Records every search sent to the fake backend."""
+    from fake_backend import FakePerplexityClient
+
+    calls = UpstreamCalls()
+    search = FakePerplexityClient.search
+
+    async def recorded_search(self, query, **kwargs):
+        calls.searches.append((query, kwargs))
+        if calls.delay:
+            await asyncio.sleep(calls.delay)
+        response = await search(self, query, **kwargs)
+        if isinstance(response, dict):
+            calls.responses.append(response)
+        return response
+
+    monkeypatch.setattr(FakePerplexityClient, 'search', recorded_search)
+    return calls
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+from accounts import EmptyUpstreamResponseError, is_rate_limited, parse_quota_spec
+from fake_backend import FakePerplexityClient
+from resilience import CircuitBreaker
+
+MODEL = "perplexity-chat/auto"
+
+
+def test_parse_quota_spec():
+    assert parse_quota_spec("pro=300, reasoning=50,deep-research=5,") == {
+        'pro': 300, 'reasoning': 50, 'deep research': 5}
+    assert parse_quota_spec(None) == {}
+    with pytest.raises(ValueError):
+        parse_quota_spec("auto=10")
+    with pytest.raises(ValueError):
+        parse_quota_spec("pro=ten")
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_rate_limits_are_matched_by_status_not_digits():
+    assert is_rate_limited(Exception('File upload error', Response(429)))
+    assert is_rate_limited(EmptyUpstreamResponseError("Perplexity returned no response"))
+    assert not is_rate_limited(Exception('File upload error', Response(500)))
+    assert not is_rate_limited(Exception("request 4c29-403b failed after 4290 bytes"))
+
+
+@pytest.fixture
+def refusing_upstream(gateway, monkeypatch):
+    """Makes every search return nothing, as perplexity_async does for a refused session."""
+    async def search(self, query, stream=False, **kwargs):
+        if not stream:
+            return None
+
+        async def nothing():
+            return
+            yield
+        return nothing()
+
+    monkeypatch.setattr(FakePerplexityClient, 'search', search)
+    monkeypatch.setattr(gateway, 'circuit_breaker', CircuitBreaker())
+    account = gateway.account_pool.accounts[0]
+    monkeypatch.setattr(account, 'cooldown_until', 0.0)
+    monkeypatch.setattr(account, 'strikes', 0)
+    return account
+
+
+def test_empty_upstream_result_cools_the_account_down(gateway, refusing_upstream):
+    body, status = asyncio.run(gateway.get_perplexity_response("hi", MODEL))
+    assert status == 502
+    assert refusing_upstream.strikes == 1
+    assert refusing_upstream.cooldown_until > time.monotonic()
+
+
+def test_empty_upstream_stream_cools_the_account_down(gateway, refusing_upstream):
+    async def scenario():
+        return [event async for event in gateway.stream_perplexity_response("hi", MODEL)]
+
+    events = asyncio.run(scenario())
+    assert any('"code":502' in event.replace(' ', '') for event in events)
+    assert events[-1] == "data: [DONE]\n\n"
+    assert refusing_upstream.strikes == 1
+    assert refusing_upstream.cooldown_until > time.monotonic()
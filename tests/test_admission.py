@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejectedError, parse_key_priorities, parse_mode_limits
+
+MODES = ('auto', 'pro', 'reasoning', 'deep research')
+
+
+def test_parse_mode_limits():
+    assert parse_mode_limits("pro=8, deep-research=2,", MODES) == {'pro': 8, 'deep research': 2}
+    assert parse_mode_limits("", MODES) == {}
+    with pytest.raises(ValueError):
+        parse_mode_limits("turbo=1", MODES)
+    with pytest.raises(ValueError):
+        parse_mode_limits("pro=many", MODES)
+
+
+def test_parse_key_priorities():
+    assert parse_key_priorities("key-a=10,key=b=-5:120") == {'key-a': (10, None), 'key=b': (-5, 120.0)}
+    with pytest.raises(ValueError):
+        parse_key_priorities("key-a=high")
+
+
+def test_free_slot_is_granted_without_queueing():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=2)
+        granted_at = await admission.acquire('auto')
+        assert admission.status()["running"] == 1
+        admission.release('auto', granted_at)
+        assert admission.status()["running"] == 0
+        assert admission.stats["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_mode_limit_only_blocks_its_own_mode():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=0, mode_limits={'pro': 1}, queue_timeout=0.05)
+        await admission.acquire('pro')
+        await admission.acquire('auto')
+        with pytest.raises(AdmissionRejectedError):
+            await admission.acquire('pro')
+
+    asyncio.run(scenario())
+
+
+def test_released_slot_goes_to_highest_priority_then_oldest():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1)
+        granted_at = await admission.acquire('auto')
+        order = []
+
+        async def wait(name, priority):
+            slot = await admission.acquire('auto', priority)
+            order.append(name)
+            admission.release('auto', slot)
+
+        tasks = [asyncio.create_task(wait(name, priority))
+                 for name, priority in (("low", 0), ("high-1", 5), ("high-2", 5))]
+        await asyncio.sleep(0)
+        assert admission.status()["queue_depth"] == 3
+        admission.release('auto', granted_at)
+        await asyncio.gather(*tasks)
+        assert order == ["high-1", "high-2", "low"]
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_drops_its_lowest_priority_waiter_for_a_higher_one():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1, max_queue=1)
+        await admission.acquire('auto')
+        low = asyncio.create_task(admission.acquire('auto', priority=0))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejectedError):
+            await admission.acquire('auto', priority=0)
+        high = asyncio.create_task(admission.acquire('auto', priority=5))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejectedError) as rejected:
+            await low
+        assert rejected.value.retry_after >= 1
+        assert admission.stats["rejected_queue_full"] == 2
+        high.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_rejects_and_leaves_the_queue():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1)
+        await admission.acquire('auto')
+        with pytest.raises(AdmissionRejectedError):
+            await admission.acquire('auto', timeout=0.02)
+        status = admission.status()
+        assert status["queue_depth"] == 0
+        assert status["rejected_timeout"] == 1
+        assert status["running"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1)
+        granted_at = await admission.acquire('auto')
+        waiter = asyncio.create_task(admission.acquire('auto'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert admission.status()["queue_depth"] == 0
+        admission.release('auto', granted_at)
+        assert admission.status()["running"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_slot_granted_during_cancellation_is_not_lost():
+    async def scenario():
+        admission = AdmissionController(max_concurrency=1)
+        granted_at = await admission.acquire('auto')
+        waiter = asyncio.create_task(admission.acquire('auto'))
+        await asyncio.sleep(0)
+        admission.release('auto', granted_at)
+        waiter.cancel()
+        try:
+            slot = await waiter
+        except asyncio.CancelledError:
+            # The waiter gave the slot back.
+            assert admission.status()["running"] == 0
+        else:
+            # wait_for may deliver the grant instead of the cancellation.
+            assert admission.status()["running"] == 1
+            admission.release('auto', slot)
+            assert admission.status()["running"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,38 @@
+import json
+
+from answers import extract_answer
+
+
+def step(step_type, answer):
+    return {'step_type': step_type, 'content': {'answer': answer}}
+
+
+def test_final_step_json_answer_is_decoded():
+    resp = {'text': [step('INITIAL_QUERY', None), step('FINAL', json.dumps({'answer': "42", 'chunks': []}))]}
+    assert extract_answer(resp) == "42"
+
+
+def test_dict_text_needs_a_final_step():
+    assert extract_answer({'step_type': 'FINAL', 'text': {'answer': "done"}}) == "done"
+    assert extract_answer({'step_type': 'SEARCH_RESULTS', 'text': {'answer': "not yet"}}) is None
+
+
+def test_plain_text_answer_is_returned_as_is():
+    assert extract_answer({'text': [step('FINAL', "plain answer")]}) == "plain answer"
+
+
+def test_incomplete_json_is_hidden_only_mid_stream():
+    resp = {'text': [step('FINAL', '{"answer": "Hal')]}
+    assert extract_answer(resp, partial=True) is None
+    assert extract_answer(resp) == '{"answer": "Hal'
+
+
+def test_answers_of_all_steps_are_joined_without_a_final_answer():
+    resp = {'text': [step('SEARCH_WEB', "first"), step('SEARCH_RESULTS', "second")]}
+    assert extract_answer(resp) == "first second"
+
+
+def test_missing_answer():
+    assert extract_answer(None) is None
+    assert extract_answer({'text': []}) is None
+    assert extract_answer({'text': [{'step_type': 'FINAL', 'content': {}}]}) is None
@@ -0,0 +1,36 @@
+import asyncio
+
+from conftest import HEADERS
+
+
+def test_stream_body_closed_before_iteration_frees_its_slot(gateway):
+    async def scenario():
+        async with gateway.app.test_app():
+            payload = {"model": "perplexity-chat/auto", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+            async with gateway.app.test_request_context(
+                    '/v1/chat/completions', method='POST', json=payload, headers=HEADERS):
+                timer = gateway.start_request()
+                response = await gateway.app.make_response(await gateway.handle_chat_completion(timer))
+                assert response.mimetype == 'text/event-stream'
+                assert gateway.admission.status()["running"] == 1
+                # What Quart does when the client disconnects before the body is sent.
+                async with response.response:
+                    pass
+            assert gateway.admission.status()["running"] == 0
+            assert gateway.upload_bytes_in_flight.in_use == 0
+
+    asyncio.run(scenario())
+
+
+def test_streamed_completion_frees_its_slot(gateway):
+    async def scenario():
+        async with gateway.app.test_app():
+            client = gateway.app.test_client()
+            payload = {"model": "perplexity-chat/auto", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+            response = await client.post('/v1/chat/completions', json=payload, headers=HEADERS)
+            body = await response.get_data(as_text=True)
+            assert response.status_code == 200
+            assert body.rstrip().endswith("data: [DONE]")
+            assert gateway.admission.status()["running"] == 0
+
+    asyncio.run(scenario())
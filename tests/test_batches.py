@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from batches import BatchManager, BatchValidationError
+
+ENDPOINT = '/v1/chat/completions'
+
+
+def batch_input(*custom_ids):
+    return "\n".join(json.dumps({"custom_id": custom_id, "method": "POST", "url": ENDPOINT,
+                                 "body": {"messages": [{"role": "user", "content": custom_id}]}})
+                     for custom_id in custom_ids)
+
+
+class Upstream:
+    """run_line stand-in: answers at once, except for prompts listed in `slow`."""
+
+    def __init__(self, slow=()):
+        self.slow = set(slow)
+        self.prompts = []
+
+    async def __call__(self, body):
+        prompt = body["messages"][0]["content"]
+        self.prompts.append(prompt)
+        if prompt in self.slow:
+            await asyncio.sleep(60)
+        return {"id": f"chatcmpl-{prompt}", "choices": [{"message": {"content": f"answer {prompt}"}}]}
+
+
+def manager(directory, upstream, published):
+    def publish(batch, kind, data):
+        published[(batch.id, kind)] = data
+        return f"file-{kind}"
+
+    return BatchManager(str(directory), upstream, publish, concurrency=2, max_attempts=1)
+
+
+async def wait_until_finished(batches, batch, timeout=5):
+    deadline = time.monotonic() + timeout
+    while batch.status not in ('completed', 'failed', 'cancelled', 'expired'):
+        assert time.monotonic() < deadline, batch.status
+        await asyncio.sleep(0.01)
+
+
+def test_only_the_24h_completion_window_is_accepted(tmp_path):
+    async def scenario():
+        batches = manager(tmp_path, Upstream(), {})
+        await batches.start()
+        try:
+            with pytest.raises(BatchValidationError):
+                batches.create("file-in", batch_input("a"), ENDPOINT, completion_window="1h")
+            batch = batches.create("file-in", batch_input("a"), ENDPOINT)
+            assert batch.meta['expires_at'] == batch.meta['created_at'] + 24 * 3600
+        finally:
+            await batches.close()
+
+    asyncio.run(scenario())
+
+
+def test_batch_past_its_deadline_expires_with_partial_output(tmp_path):
+    published = {}
+
+    async def scenario():
+        batches = manager(tmp_path, Upstream(slow={"b", "c"}), published)
+        await batches.start()
+        try:
+            batch = batches.create("file-in", batch_input("a", "b", "c"), ENDPOINT)
+            batch.meta['expires_at'] = time.time() + 0.3
+            await wait_until_finished(batches, batch)
+            return batch
+        finally:
+            await batches.close()
+
+    batch = asyncio.run(scenario())
+    assert batch.status == 'expired'
+    assert batch.meta['expired_at'] is not None
+    assert batch.meta['request_counts'] == {"total": 3, "completed": 1, "failed": 0}
+    assert batch.meta['output_file_id'] == "file-output"
+    lines = published[(batch.id, 'output')].decode().splitlines()
+    assert [json.loads(line)["custom_id"] for line in lines] == ["a"]
+
+
+def test_batch_resumed_after_its_deadline_expires_without_running(tmp_path):
+    async def create_and_stop():
+        batches = manager(tmp_path, Upstream(slow={"a"}), {})
+        await batches.start()
+        batch = batches.create("file-in", batch_input("a", "b"), ENDPOINT)
+        await asyncio.sleep(0.05)
+        await batches.close()
+        batch.meta['expires_at'] = time.time() - 1
+        batch.save()
+        return batch.id
+
+    async def restart(batch_id):
+        upstream = Upstream()
+        batches = manager(tmp_path, upstream, {})
+        await batches.start()
+        try:
+            batch = batches.get(batch_id)
+            await wait_until_finished(batches, batch)
+            return batch, upstream
+        finally:
+            await batches.close()
+
+    batch, upstream = asyncio.run(restart(asyncio.run(create_and_stop())))
+    assert batch.status == 'expired'
+    assert upstream.prompts == []
+
+
+def test_resumed_batch_skips_lines_finished_before_the_restart(tmp_path):
+    published = {}
+
+    async def run_until_checkpoint():
+        batches = manager(tmp_path, Upstream(slow={"b", "c"}), {})
+        await batches.start()
+        batch = batches.create("file-in", batch_input("a", "b", "c"), ENDPOINT)
+        deadline = time.monotonic() + 5
+        while batch.meta['request_counts']['completed'] < 1:
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.01)
+        await batches.close()
+        return batch.id
+
+    async def restart(batch_id):
+        upstream = Upstream()
+        batches = manager(tmp_path, upstream, published)
+        await batches.start()
+        try:
+            batch = batches.get(batch_id)
+            await wait_until_finished(batches, batch)
+            return batch, upstream
+        finally:
+            await batches.close()
+
+    batch, upstream = asyncio.run(restart(asyncio.run(run_until_checkpoint())))
+    assert batch.status == 'completed'
+    assert sorted(upstream.prompts) == ["b", "c"]
+    assert batch.meta['request_counts'] == {"total": 3, "completed": 3, "failed": 0}
+    lines = published[(batch.id, 'output')].decode().splitlines()
+    assert sorted(json.loads(line)["custom_id"] for line in lines) == ["a", "b", "c"]
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from accounts import Account, AccountPool, EmptyUpstreamResponseError
+from client_pool import ClientPool
+
+
+class Client:
+    def __init__(self, cookies):
+        self.cookies = cookies
+
+    def __await__(self):
+        async def ready():
+            return self
+        return ready().__await__()
+
+
+def test_healthy_client_goes_back_to_the_pool():
+    async def scenario():
+        pool = ClientPool(size=1, client_factory=Client)
+        await pool.start()
+        async with pool.client() as first:
+            pass
+        async with pool.client() as second:
+            pass
+        assert second is first
+        assert pool.stats["reused"] == 2
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_refused_client_is_replaced():
+    async def scenario():
+        pool = ClientPool(size=1, client_factory=Client)
+        await pool.start()
+        with pytest.raises(EmptyUpstreamResponseError):
+            async with pool.client() as refused:
+                raise EmptyUpstreamResponseError("Perplexity returned no response")
+        await asyncio.sleep(0)
+        assert pool.stats["discarded"] == 1
+        assert pool.status()["idle"] == 1
+        async with pool.client() as fresh:
+            assert fresh is not refused
+        assert pool.stats["created"] == 2
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_lease_discards_the_client_of_an_empty_search():
+    async def scenario():
+        account = Account("a", None, 1, {}, 86400, size=1, client_factory=Client)
+        accounts = AccountPool([account])
+        await accounts.start()
+        with pytest.raises(EmptyUpstreamResponseError):
+            async with accounts.lease('auto') as (_, perplexity_cli):
+                refused = perplexity_cli
+                raise EmptyUpstreamResponseError("Perplexity returned no response")
+        async with account.client_pool.client() as fresh:
+            assert fresh is not refused
+        assert account.client_pool.stats["discarded"] == 1
+        await accounts.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,60 @@
+import asyncio
+
+from conftest import HEADERS
+from conversations import ConversationIndex, ConversationThread
+
+
+def test_history_ending_in_a_remembered_answer_finds_its_thread():
+    async def scenario():
+        index = ConversationIndex()
+        first = [{"role": "user", "content": "hello"}]
+        _, _, hasher = await index.lookup("m", first)
+        index.remember(hasher, "hi there", ConversationThread("acct", "uuid-1"))
+        follow_up = first + [{"role": "assistant", "content": "hi there"}, {"role": "user", "content": "and?"}]
+        other = first + [{"role": "assistant", "content": "something else"}, {"role": "user", "content": "and?"}]
+        return await index.lookup("m", follow_up), await index.lookup("m", other), await index.lookup("n", follow_up)
+
+    (thread, prefix_length, _), (missed, _, _), (other_model, _, _) = asyncio.run(scenario())
+    assert (thread.account, thread.backend_uuid, prefix_length) == ("acct", "uuid-1", 2)
+    assert missed is None and other_model is None
+
+
+def test_expired_threads_are_not_offered():
+    async def scenario():
+        index = ConversationIndex(ttl=60)
+        _, _, hasher = await index.lookup("m", [{"role": "user", "content": "hello"}])
+        thread = ConversationThread("acct", "uuid-1")
+        thread.created_at -= 61
+        index.remember(hasher, "hi", thread)
+        messages = [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi"},
+                    {"role": "user", "content": "again"}]
+        return index, await index.lookup("m", messages)
+
+    index, (thread, _, _) = asyncio.run(scenario())
+    assert thread is None
+    assert index.status()["threads"] == 0
+
+
+def test_follow_up_reuses_the_upstream_thread(gateway, upstream):
+    question = {"role": "user", "content": "what is a follow-up thread?"}
+
+    async def scenario():
+        async with gateway.app.test_app():
+            client = gateway.app.test_client()
+            first = await client.post('/v1/chat/completions', headers=HEADERS,
+                                      json={"model": "perplexity-chat/auto", "messages": [question]})
+            answer = (await first.get_json())["choices"][0]["message"]["content"]
+            messages = [question, {"role": "assistant", "content": answer},
+                        {"role": "user", "content": "and a second turn?"}]
+            second = await client.post('/v1/chat/completions', headers=HEADERS,
+                                       json={"model": "perplexity-chat/auto", "messages": messages})
+            return first.status_code, second.status_code
+
+    assert asyncio.run(scenario()) == (200, 200)
+    assert len(upstream.searches) == 2
+    (_, first_kwargs), (query, kwargs) = upstream.searches
+    assert first_kwargs.get('follow_up') is None
+    assert kwargs['follow_up']['backend_uuid'] == upstream.responses[0]['backend_uuid']
+    # Only the turn after the indexed prefix is sent upstream.
+    assert "and a second turn?" in query
+    assert "what is a follow-up thread?" not in query
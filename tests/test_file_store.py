@@ -0,0 +1,63 @@
+import asyncio
+import os
+
+from file_store import FileStore, sha256_of_base64
+
+
+def files_on_disk(store):
+    return sorted(name for name in os.listdir(store.directory) if not name.endswith('.json'))
+
+
+def test_identical_contents_are_stored_once(tmp_path):
+    store = FileStore(str(tmp_path))
+    first = store.put(b"same bytes", "a.txt")
+    second = asyncio.run(store.put_async(b"same bytes", "b.txt"))
+    assert first.digest == second.digest
+    assert (first.filename, second.filename) == ("a.txt", "b.txt")
+    assert files_on_disk(store) == [first.digest]
+    assert store.stats["stored"] == 1 and store.stats["deduplicated"] == 1
+    assert store.get(first.file_id).load() == b"same bytes"
+
+
+def test_least_recently_used_file_is_evicted(tmp_path):
+    store = FileStore(str(tmp_path), max_bytes=20)
+    old = store.put(b"o" * 10, "old.txt")
+    used = store.put(b"u" * 10, "used.txt")
+    store.put(b"n" * 10, "new.txt")
+    assert store.get(old.digest) is None
+    assert store.get(used.digest) is not None
+
+
+def test_pinned_file_survives_eviction_until_unpinned(tmp_path):
+    store = FileStore(str(tmp_path), max_bytes=20)
+    pinned = store.put(b"p" * 10, "pinned.txt")
+    store.pin(pinned.digest)
+    store.pin(pinned.digest)
+    store.put(b"a" * 10, "a.txt")
+    store.put(b"b" * 10, "b.txt")
+    # Checked on disk: get() would make the file the most recently used one.
+    assert pinned.digest in files_on_disk(store)
+    store.unpin(pinned.digest)
+    store.put(b"c" * 10, "c.txt")
+    assert pinned.digest in files_on_disk(store)
+    store.unpin(pinned.digest)
+    assert store.status()["pinned"] == 0
+    store.put(b"d" * 10, "d.txt")
+    assert pinned.digest not in files_on_disk(store)
+
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    stored = FileStore(str(tmp_path)).put(b"kept", "kept.txt", purpose='batch')
+    reopened = FileStore(str(tmp_path)).get(stored.file_id)
+    assert (reopened.filename, reopened.size, reopened.purpose) == ("kept.txt", 4, 'batch')
+    assert reopened.load() == b"kept"
+
+
+def test_repeated_base64_payload_maps_to_the_stored_file(tmp_path):
+    store = FileStore(str(tmp_path))
+    encoded = "aGVsbG8="
+    stored = store.put(b"hello", "image.png")
+    store.remember_base64(sha256_of_base64(encoded), stored.digest)
+    assert store.lookup_base64(sha256_of_base64(encoded)).digest == stored.digest
+    assert store.delete(stored.file_id)
+    assert store.lookup_base64(sha256_of_base64(encoded)) is None
@@ -0,0 +1,35 @@
+import asyncio
+import os
+
+from accounts import AccountUnavailableError
+
+MODEL = "perplexity-chat/auto"
+
+
+def test_no_free_account_is_a_429_that_spares_the_circuit(gateway, monkeypatch):
+    async def no_account(mode, account_name=None):
+        raise AccountUnavailableError("No Perplexity account available for mode 'auto'", retry_after=7)
+
+    monkeypatch.setattr(gateway.account_pool, 'acquire', no_account)
+    for _ in range(gateway.circuit_breaker.failures + 1):
+        body, status, headers = asyncio.run(gateway.get_resilient_response("hi", MODEL, None))
+        assert status == 429
+        assert headers["Retry-After"] == "7"
+        assert body["error"]["type"] == "rate_limit_error"
+    assert not gateway.circuit_breaker.is_open(MODEL)
+    assert gateway.circuit_breaker.allow(MODEL)
+
+
+def test_evicted_attachment_is_a_404_that_spares_the_circuit(gateway):
+    stored = gateway.file_store.put(b"attachment", "notes.txt")
+    os.remove(os.path.join(gateway.file_store.directory, stored.digest))
+    files = {"notes.txt": gateway.file_store.get(stored.digest).renamed("notes.txt")}
+
+    async def scenario():
+        async with gateway.app.test_app():
+            return await gateway.get_resilient_response("hi", MODEL, files)
+
+    for _ in range(gateway.circuit_breaker.failures + 1):
+        body, status, _ = asyncio.run(scenario())
+        assert status == 404
+    assert not gateway.circuit_breaker.is_open(MODEL)
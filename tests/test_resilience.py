@@ -0,0 +1,83 @@
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, parse_fallback_chains
+
+MODELS = ["perplexity-chat/auto", "perplexity-chat/pro-sonar", "perplexity-chat/pro-gpt-4.5"]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, 'monotonic', clock)
+    return clock
+
+
+def test_parse_fallback_chains():
+    chains = parse_fallback_chains("pro-gpt-4.5>perplexity-chat/pro-sonar>auto", MODELS, "perplexity-chat")
+    assert chains == {"perplexity-chat/pro-gpt-4.5": [
+        "perplexity-chat/pro-gpt-4.5", "perplexity-chat/pro-sonar", "perplexity-chat/auto"]}
+    with pytest.raises(ValueError):
+        parse_fallback_chains("auto>nonexistent", MODELS, "perplexity-chat")
+
+
+def test_opens_after_failures_within_the_window(clock):
+    breaker = CircuitBreaker(failures=3, window=10, open_for=30)
+    for _ in range(2):
+        breaker.record("m", False)
+    clock.now += 11
+    breaker.record("m", False)
+    assert not breaker.is_open("m")
+    breaker.record("m", False)
+    breaker.record("m", False)
+    assert breaker.is_open("m")
+    assert not breaker.allow("m")
+    assert breaker.retry_after("m") == 30
+    assert breaker.status() == {"open": 1, "opened": 1, "short_circuited": 1}
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failures=1, window=10, open_for=30)
+    breaker.record("m", False)
+    clock.now += 30
+    assert breaker.allow("m")
+    assert not breaker.allow("m")
+
+
+def test_successful_trial_closes_the_circuit(clock):
+    breaker = CircuitBreaker(failures=1, window=10, open_for=30)
+    breaker.record("m", False)
+    clock.now += 30
+    assert breaker.allow("m")
+    breaker.record("m", True)
+    assert not breaker.is_open("m")
+    assert breaker.allow("m")
+    assert breaker.allow("m")
+
+
+def test_failed_trial_reopens_the_circuit(clock):
+    breaker = CircuitBreaker(failures=3, window=10, open_for=30)
+    for _ in range(3):
+        breaker.record("m", False)
+    clock.now += 30
+    assert breaker.allow("m")
+    # A single failure while half-open is enough.
+    breaker.record("m", False)
+    assert not breaker.allow("m")
+    assert breaker.retry_after("m") == 30
+    assert breaker.stats["opened"] == 1
+
+
+def test_zero_failures_disables_the_breaker(clock):
+    breaker = CircuitBreaker(failures=0)
+    for _ in range(100):
+        breaker.record("m", False)
+    assert breaker.allow("m")
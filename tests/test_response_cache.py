@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import response_cache
+from conftest import HEADERS
+from response_cache import ResponseCache, parse_ttl_spec
+
+MODEL = "perplexity-chat/auto"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache, 'time', clock)
+    return clock
+
+
+def test_parse_ttl_spec():
+    assert parse_ttl_spec("auto=300,deep-research=86400,perplexity-chat/pro-sonar=0.5") == {
+        'auto': 300.0, 'deep research': 86400.0, 'perplexity-chat/pro-sonar': 0.5}
+    with pytest.raises(ValueError):
+        parse_ttl_spec("auto=forever")
+
+
+def test_key_ignores_trivial_prompt_differences():
+    key = ResponseCache.make_key(MODEL, "What is WAL?\r\n", {"a.txt": b"x"}, 'en-US', ['web'])
+    assert key == ResponseCache.make_key(MODEL, "What is WAL?  ", {"a.txt": b"x"}, 'en-US', ['web'])
+    assert key != ResponseCache.make_key(MODEL, "What is WAL?", {"a.txt": b"y"}, 'en-US', ['web'])
+    assert key != ResponseCache.make_key("perplexity-chat/pro-sonar", "What is WAL?", {"a.txt": b"x"},
+                                         'en-US', ['web'])
+
+
+def test_hit_after_miss_until_the_ttl_expires(clock):
+    cache = ResponseCache()
+    assert cache.get("k") is None
+    cache.put("k", {"answer": 42}, ttl=60)
+    clock.now += 59
+    assert cache.get("k") == {"answer": 42}
+    clock.now += 2
+    assert cache.get("k") is None
+    assert (cache.stats["hits"], cache.stats["misses"]) == (1, 2)
+
+
+def test_disk_tier_outlives_the_process(tmp_path, clock):
+    first = ResponseCache(disk_path=str(tmp_path))
+    first.put("k", {"answer": 42}, ttl=60)
+    first.close()
+    second = ResponseCache(disk_path=str(tmp_path))
+    assert second.get("k") == {"answer": 42}
+    clock.now += 61
+    assert ResponseCache(disk_path=str(tmp_path)).get("k") is None
+
+
+def test_completion_is_served_from_the_cache(gateway, upstream, clock, monkeypatch):
+    monkeypatch.setattr(gateway, 'response_cache', ResponseCache(ttls={'auto': 60}))
+    payload = {"model": MODEL, "messages": [{"role": "user", "content": "cache me"}]}
+
+    async def post():
+        async with gateway.app.test_app():
+            response = await gateway.app.test_client().post('/v1/chat/completions', json=payload, headers=HEADERS)
+            return response.headers.get('X-Cache'), await response.get_json()
+
+    first_state, first = asyncio.run(post())
+    second_state, second = asyncio.run(post())
+    assert (first_state, second_state) == ("MISS", "HIT")
+    assert second["choices"] == first["choices"]
+    assert len(upstream.searches) == 1
+    clock.now += 61
+    assert asyncio.run(post())[0] == "MISS"
+    assert len(upstream.searches) == 2
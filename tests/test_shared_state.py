@@ -0,0 +1,92 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejectedError
+from conversations import ConversationIndex, ConversationThread
+from shared_state import SharedState
+
+
+@pytest.fixture
+def shared_pair(tmp_path):
+    """Two workers' connections to one shared state file."""
+    path = str(tmp_path / "state.sqlite3")
+    first = SharedState.create(path)
+    first.worker = 1
+    second = SharedState(path, worker=2)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_reads_see_earlier_deferred_writes(shared_pair):
+    first, second = shared_pair
+
+    async def scenario():
+        for value in range(1, 6):
+            first.defer(first.set_counter, 'admission:', value)
+        # Queued behind the writes on the first worker's database thread.
+        await first.read(first.other_counters, 'admission:')
+        return await second.read(second.other_counters, 'admission:')
+
+    assert asyncio.run(scenario()) == {'admission:': 5}
+
+
+def test_claims_do_not_exceed_the_shared_limit(shared_pair):
+    first, second = shared_pair
+    limits = {'admission:': 2}
+    assert first.claim_counters({'admission:': 2}, limits) is None
+    assert second.claim_counters({'admission:': 1}, limits) == {'admission:': 2}
+    first.set_counter('admission:', 1)
+    assert second.claim_counters({'admission:': 1}, limits) is None
+
+
+def test_slot_freed_by_another_worker_goes_to_a_queued_request(shared_pair):
+    first, second = shared_pair
+
+    async def scenario():
+        a = AdmissionController(max_concurrency=1, shared=first, poll_interval=0.01)
+        b = AdmissionController(max_concurrency=1, shared=second, poll_interval=0.01)
+        await a.start()
+        await b.start()
+        granted_at = await a.acquire('auto')
+        with pytest.raises(AdmissionRejectedError):
+            await b.acquire('auto', timeout=0.05)
+        waiter = asyncio.create_task(b.acquire('auto', timeout=5))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        a.release('auto', granted_at)
+        await asyncio.wait_for(waiter, 2)
+        assert b.status()["running"] == 1
+        with pytest.raises(AdmissionRejectedError):
+            await a.acquire('auto', timeout=0.05)
+        await a.close()
+        await b.close()
+
+    asyncio.run(scenario())
+
+
+def test_locked_database_does_not_stall_the_event_loop(shared_pair):
+    first, _ = shared_pair
+    index = ConversationIndex(shared=first)
+    blocker = sqlite3.connect(first.path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.3, blocker.execute, "COMMIT")
+        started = time.monotonic()
+        hasher = (await index.lookup("m", [{"role": "user", "content": "hi"}]))[2]
+        index.remember(hasher, "hello", ConversationThread("acct", "uuid-1"))
+        # The write waits for the lock on the database thread, not here.
+        assert time.monotonic() - started < 0.1
+        messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"},
+                    {"role": "user", "content": "and then?"}]
+        thread, prefix_length, _ = await index.lookup("m", messages)
+        return thread, prefix_length
+
+    thread, prefix_length = asyncio.run(scenario())
+    blocker.close()
+    assert (thread.account, thread.backend_uuid, prefix_length) == ("acct", "uuid-1", 2)
@@ -0,0 +1,82 @@
+import asyncio
+
+from conftest import HEADERS
+from single_flight import SingleFlight
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(True)
+            await asyncio.sleep(0.01)
+            return {"answer": [1, 2]}
+
+        results = await asyncio.gather(*(flights.do("same", call) for _ in range(5)),
+                                       flights.do("other", call))
+        return flights, calls, results
+
+    flights, calls, results = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert all(result == {"answer": [1, 2]} for result in results)
+    # Followers get copies, so one caller mutating its result cannot affect another.
+    assert len({id(result) for result in results}) == len(results)
+    assert flights.stats == {"leaders": 2, "coalesced": 4, "follower_timeouts": 0}
+    assert flights.in_flight() == 0
+
+
+def test_call_survives_the_leader_going_away():
+    async def scenario():
+        flights = SingleFlight()
+        started = asyncio.Event()
+
+        async def call():
+            started.set()
+            await asyncio.sleep(0.02)
+            return "done"
+
+        leader = asyncio.create_task(flights.do("k", call))
+        await started.wait()
+        follower = asyncio.create_task(flights.do("k", call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(scenario()) == "done"
+
+
+def test_last_waiter_leaving_cancels_the_call():
+    async def scenario():
+        flights = SingleFlight()
+        finished = []
+
+        async def call():
+            await asyncio.sleep(1)
+            finished.append(True)
+
+        waiter = asyncio.create_task(flights.do("k", call))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        return flights.in_flight(), finished
+
+    assert asyncio.run(scenario()) == (0, [])
+
+
+def test_identical_completions_make_one_upstream_search(gateway, upstream):
+    upstream.delay = 0.05
+    payload = {"model": "perplexity-chat/auto", "messages": [{"role": "user", "content": "coalesce me"}]}
+
+    async def scenario():
+        async with gateway.app.test_app():
+            client = gateway.app.test_client()
+            responses = await asyncio.gather(*(client.post('/v1/chat/completions', json=payload, headers=HEADERS)
+                                               for _ in range(4)))
+            return [(response.status_code, await response.get_json()) for response in responses]
+
+    results = asyncio.run(scenario())
+    assert [status for status, _ in results] == [200] * 4
+    assert len({body["choices"][0]["message"]["content"] for _, body in results}) == 1
+    assert len(upstream.searches) == 1
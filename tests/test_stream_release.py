@@ -0,0 +1,82 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from admission import AdmissionController
+from ingest import ByteBudget, UploadBudget
+from telemetry import finish_after_stream, start_request
+
+
+def requests_in_flight():
+    return REGISTRY.get_sample_value('pplx_gateway_requests_in_flight')
+
+
+async def open_stream(admission, upload_bytes, chunks=("a", "b")):
+    """A streaming body holding an admission slot and 10 upload bytes, as chat_completions builds it."""
+    upload_budget = UploadBudget(upload_bytes)
+    upload_budget.reserve_body(10)
+    granted_at = await admission.acquire('pro')
+    started = []
+
+    async def body():
+        started.append(True)
+        for chunk in chunks:
+            yield chunk
+
+    timer = start_request()
+    releases = [upload_budget.release, lambda: admission.release('pro', granted_at)]
+    return finish_after_stream(body(), timer, releases=releases), started
+
+
+def test_closing_unstarted_stream_releases_everything():
+    async def scenario():
+        admission, upload_bytes = AdmissionController(max_concurrency=1), ByteBudget()
+        in_flight = requests_in_flight()
+        stream, started = await open_stream(admission, upload_bytes)
+        assert admission.status()["running"] == 1
+        assert upload_bytes.in_use == 10
+        await stream.aclose()
+        assert not started
+        assert admission.status()["running"] == 0
+        assert upload_bytes.in_use == 0
+        assert requests_in_flight() == in_flight
+
+    asyncio.run(scenario())
+
+
+def test_exhausted_stream_releases_once():
+    async def scenario():
+        admission, upload_bytes = AdmissionController(max_concurrency=1), ByteBudget()
+        in_flight = requests_in_flight()
+        stream, _ = await open_stream(admission, upload_bytes)
+        assert [chunk async for chunk in stream] == ["a", "b"]
+        await stream.aclose()
+        assert admission.status()["running"] == 0
+        assert upload_bytes.in_use == 0
+        assert requests_in_flight() == in_flight
+
+    asyncio.run(scenario())
+
+
+def test_failing_stream_releases():
+    async def scenario():
+        admission, upload_bytes = AdmissionController(max_concurrency=1), ByteBudget()
+
+        async def body():
+            yield "a"
+            raise RuntimeError("upstream went away")
+
+        upload_budget = UploadBudget(upload_bytes)
+        upload_budget.reserve_body(10)
+        granted_at = await admission.acquire('pro')
+        releases = [upload_budget.release, lambda: admission.release('pro', granted_at)]
+        stream = finish_after_stream(body(), start_request(), releases=releases)
+        assert await stream.__anext__() == "a"
+        try:
+            await stream.__anext__()
+        except RuntimeError:
+            pass
+        assert admission.status()["running"] == 0
+        assert upload_bytes.in_use == 0
+
+    asyncio.run(scenario())
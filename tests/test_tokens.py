@@ -0,0 +1,45 @@
+import pytest
+
+from tokens import MESSAGE_OVERHEAD, TokenCounter, parse_budget_spec
+
+
+def message(role, content):
+    return {'role': role, 'content': content}
+
+
+def test_parse_budget_spec():
+    assert parse_budget_spec("auto=4000, deep-research=1000,perplexity-chat/pro-gpt-4.5=32000") == {
+        'auto': 4000, 'deep research': 1000, 'perplexity-chat/pro-gpt-4.5': 32000}
+    assert parse_budget_spec("") == {}
+    with pytest.raises(ValueError):
+        parse_budget_spec("auto=lots")
+
+
+def test_fit_keeps_everything_under_budget():
+    counter = TokenCounter()
+    messages = [message('user', "hello"), message('assistant', "hi"), message('user', "how are you")]
+    kept, used, dropped = counter.fit(messages, 10_000)
+    assert kept == messages
+    assert used == counter.count_messages(messages)
+    assert dropped == 0
+
+
+def test_fit_drops_oldest_turns_and_keeps_system_and_latest():
+    counter = TokenCounter()
+    system = message('system', "Be brief.")
+    turns = [message('user' if i % 2 == 0 else 'assistant', f"turn {i} " + "word " * 20) for i in range(6)]
+    messages = [system] + turns
+    budget = counter.count_messages([system] + turns[-3:])
+    kept, used, dropped = counter.fit(messages, budget)
+    assert kept == [system] + turns[-3:]
+    assert used == budget
+    assert dropped == 3
+
+
+def test_fit_keeps_latest_message_even_over_budget():
+    counter = TokenCounter()
+    messages = [message('user', "old question"), message('user', "word " * 200)]
+    kept, used, dropped = counter.fit(messages, 10)
+    assert kept == messages[-1:]
+    assert used == counter.count_message(messages[-1]) + MESSAGE_OVERHEAD
+    assert dropped == 1
@@ -0,0 +1,73 @@
+import asyncio
+
+import perplexity_async
+
+from uploads import SEARCH_ENDPOINT, UPLOAD_URL_ENDPOINT, UpstreamUploads, upload_file
+
+OBJECT_URL = "https://uploads.example.com/user_uploads/abc/notes.txt"
+
+
+class Response:
+    ok = True
+
+    def __init__(self, body=None):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class Session:
+    """Records the requests perplexity_async sends and answers the upload ones."""
+
+    def __init__(self):
+        self.posts = []
+
+    async def post(self, url, **kwargs):
+        self.posts.append((url, kwargs))
+        if url.startswith(UPLOAD_URL_ENDPOINT):
+            return Response({"fields": {"key": "abc"}, "s3_bucket_url": "https://uploads.example.com/",
+                             "s3_object_url": OBJECT_URL})
+        if url.startswith(SEARCH_ENDPOINT):
+            raise AssertionError("the search request must not be sent")
+        return Response()
+
+
+def own_client():
+    client = perplexity_async.Client.__new__(perplexity_async.Client)
+    client.session = Session()
+    client.own = True
+    client.copilot = client.file_upload = 10
+    return client
+
+
+class Stored(bytes):
+    digest = "abc"
+
+    async def load_async(self):
+        return bytes(self)
+
+
+def test_upload_reports_the_payload_length_and_skips_the_search():
+    client = own_client()
+    data = b"x" * 1000
+    assert asyncio.run(upload_file(client, "notes.txt", data)) == OBJECT_URL
+    create_url, kwargs = client.session.posts[0]
+    assert kwargs["json"]["file_size"] == 1000
+    assert [url for url, _ in client.session.posts] == [create_url, "https://uploads.example.com/"]
+    assert client.file_upload == 10
+
+
+def test_uploaded_url_is_reused_per_account():
+    client = own_client()
+    uploads = UpstreamUploads()
+
+    async def scenario():
+        first = await uploads.prepare("a", client, {"notes.txt": Stored(b"hello")})
+        second = await uploads.prepare("a", client, {"notes.txt": Stored(b"hello")})
+        other_account = await uploads.prepare("b", client, {"notes.txt": Stored(b"hello")})
+        return first, second, other_account
+
+    first, second, other_account = asyncio.run(scenario())
+    assert first == second == other_account == ({}, [OBJECT_URL])
+    assert uploads.stats == {"reused": 1, "uploaded": 2, "upload_errors": 0}
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from jobs import WebhookURLError, check_webhook_url
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/hook",
+    "http://localhost:8080/hook",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://10.0.0.5/hook",
+    "https://192.168.1.20/hook",
+    "http://[::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "ftp://example.com/hook",
+    "not a url",
+    "http://example.com:99999/hook",
+])
+def test_refuses_internal_and_malformed_urls(url):
+    with pytest.raises(WebhookURLError):
+        asyncio.run(check_webhook_url(url))
+
+
+def test_accepts_public_addresses():
+    asyncio.run(check_webhook_url("https://93.184.215.14/hook"))
+
+
+def test_allowlisted_hosts_skip_the_address_check():
+    asyncio.run(check_webhook_url("http://LOCALHOST:9000/hook", allowed_hosts={"localhost"}))
+    asyncio.run(check_webhook_url("http://10.0.0.5/hook", allowed_hosts={"10.0.0.5"}))
@@ -0,0 +1,145 @@
+import hashlib
+import re
+from collections import OrderedDict
+
+# Tokens OpenAI's chat format adds per message (role and separators).
+MESSAGE_OVERHEAD = 3
+
+# Approximates BPE pre-tokenization: letter runs, numbers in groups of up to
+# three digits, newline runs and single punctuation characters.
+_PIECES = re.compile(r"[^\W\d_]+|\d{1,3}|\n+|[^\s\w]|_", re.UNICODE)
+
+
+def approximate_tokens(text):
+    """
+    Estimates the number of BPE tokens in `text` without a tokenizer vocabulary.
+
+    Latin letter runs count one token per started 8 characters (common words
+    are a single token, long ones split), other alphabets one per started 3
+    characters, CJK one per character and everything else one per piece.
+    A rough but cheap estimate; use a tiktoken encoding for exact counts.
+    """
+    count = 0
+    for piece in _PIECES.findall(text):
+        first = piece[0]
+        if first <= '\u024f' and first.isalpha():
+            count += 1 + (len(piece) - 1) // 8
+        elif first >= '\u2e80':
+            count += len(piece)
+        elif first.isalpha():
+            count += 1 + (len(piece) - 1) // 3
+        else:
+            count += 1
+    return count
+
+
+def parse_budget_spec(spec):
+    """
+    Parses prompt token budgets such as 'auto=4000,pro=16000,perplexity-chat/pro-gpt-4.5=32000'.
+
+    Keys may be Perplexity modes (dashes stand for spaces) or full model IDs.
+
+    Returns:
+        A dictionary mapping modes and model IDs to token budgets.
+    """
+    budgets = {}
+    if not spec:
+        return budgets
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, tokens = item.rpartition('=')
+        key = key.strip()
+        if '/' not in key:
+            key = key.replace('-', ' ')
+        budgets[key] = int(tokens)
+    return budgets
+
+
+def _message_text(message):
+    content = message.get('content')
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get('text', '') for part in content or () if part.get('type') == 'text')
+
+
+class TokenCounter:
+    """
+    Counts chat message tokens, caching per-message counts by content hash.
+
+    Chat clients resend the whole history every turn, so each message is
+    tokenized once and later turns only hash it. Counting uses tiktoken when
+    `encoding` names one of its encodings (and it is installed), otherwise
+    approximate_tokens().
+    """
+
+    def __init__(self, encoding='approx', max_entries=50000):
+        """
+        Args:
+            encoding: 'approx', or a tiktoken encoding name such as 'o200k_base'.
+            max_entries: Message counts kept in the LRU cache.
+        """
+        self.encoding = encoding
+        self.max_entries = max_entries
+        self._count = approximate_tokens
+        if encoding != 'approx':
+            import tiktoken
+            tokenizer = tiktoken.get_encoding(encoding)
+            self._count = lambda text: len(tokenizer.encode(text, disallowed_special=()))
+        self._cache = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def count_text(self, text):
+        return self._count(text) if text else 0
+
+    def count_message(self, message):
+        """Tokens of one chat message's text, including the per-message overhead."""
+        text = _message_text(message)
+        key = hashlib.blake2b(f"{message.get('role', '')}\x1f{text}".encode('utf-8', errors='replace'),
+                              digest_size=16).digest()
+        count = self._cache.get(key)
+        if count is not None:
+            self._cache.move_to_end(key)
+            self.stats["hits"] += 1
+            return count
+        self.stats["misses"] += 1
+        count = self.count_text(text) + MESSAGE_OVERHEAD
+        self._cache[key] = count
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return count
+
+    def count_messages(self, messages):
+        return sum(self.count_message(message) for message in messages) + MESSAGE_OVERHEAD
+
+    def fit(self, messages, budget):
+        """
+        Drops the oldest messages until `messages` fit in `budget` tokens.
+
+        System messages and the latest message are always kept, and the most
+        recent turns are kept before older ones, so the order of what remains
+        is unchanged.
+
+        Returns:
+            A tuple (kept_messages, prompt_tokens, dropped_count).
+        """
+        counts = [self.count_message(message) for message in messages]
+        total = sum(counts) + MESSAGE_OVERHEAD
+        if not budget or total <= budget or len(messages) < 2:
+            return messages, total, 0
+        keep = [message.get('role') == 'system' for message in messages]
+        keep[-1] = True
+        used = sum(count for count, kept in zip(counts, keep) if kept) + MESSAGE_OVERHEAD
+        for index in range(len(messages) - 2, -1, -1):
+            if keep[index]:
+                continue
+            if used + counts[index] > budget:
+                break
+            keep[index] = True
+            used += counts[index]
+        kept = [message for message, kept in zip(messages, keep) if kept]
+        return kept, used, len(messages) - len(kept)
+
+    def status(self):
+        return {"cached_messages": len(self._cache), **self.stats}
@@ -0,0 +1,136 @@
+import copy
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+UPLOAD_URL_ENDPOINT = 'https://www.perplexity.ai/rest/uploads/create_upload_url'
+SEARCH_ENDPOINT = 'https://www.perplexity.ai/rest/sse/perplexity_ask'
+
+
+class _Uploaded(Exception):
+    """Stops search() at the search request; carries the attachment URLs it would have sent."""
+
+    def __init__(self, attachments):
+        super().__init__("upload finished")
+        self.attachments = attachments
+
+
+class _UploadOnlySession:
+    """
+    Wraps a client's session so that search() only uploads its files.
+
+    Upload requests go to the real session, with the payload length as
+    file_size (perplexity_async sends sys.getsizeof() of the bytes object).
+    The search request itself is not sent: its attachment list is raised
+    as _Uploaded instead.
+    """
+
+    def __init__(self, session, sizes):
+        self.session = session
+        self.sizes = sizes
+
+    async def post(self, url, **kwargs):
+        if url.startswith(SEARCH_ENDPOINT):
+            raise _Uploaded(kwargs['json']['params']['attachments'])
+        if url.startswith(UPLOAD_URL_ENDPOINT):
+            body = kwargs['json']
+            kwargs['json'] = {**body, 'file_size': self.sizes.get(body['filename'], body['file_size'])}
+        return await self.session.post(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+async def upload_file(perplexity_cli, filename, data):
+    """
+    Uploads one attachment with the client's session and returns its attachment URL.
+
+    perplexity_async.Client.search() uploads files but does not expose the
+    resulting URLs, so it runs on a copy of the client whose session stops
+    at the search request (see _UploadOnlySession). The upload steps stay
+    the library's own, and the client's remaining-uploads counter is left
+    alone.
+    """
+    uploader = copy.copy(perplexity_cli)
+    uploader.session = _UploadOnlySession(perplexity_cli.session, {filename: len(data)})
+    try:
+        await uploader.search('', mode='auto', files={filename: data})
+    except _Uploaded as uploaded:
+        if uploaded.attachments:
+            return uploaded.attachments[-1]
+    raise RuntimeError(f"Perplexity returned no attachment URL for '{filename}'")
+
+
+class UpstreamUploads:
+    """
+    Remembers attachment URLs Perplexity returned for (account, content digest)
+    so the same file is not uploaded again while the URL is still valid.
+    """
+
+    def __init__(self, ttl=3600, max_entries=10000):
+        """
+        Args:
+            ttl: Seconds an uploaded URL is reused (0 disables reuse).
+            max_entries: Maximum number of remembered uploads.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._urls = OrderedDict()
+        self.stats = {"reused": 0, "uploaded": 0, "upload_errors": 0}
+
+    def get(self, account_name, digest):
+        key = (account_name, digest)
+        entry = self._urls.get(key)
+        if entry is None:
+            return None
+        url, expires_at = entry
+        if expires_at <= time.time():
+            del self._urls[key]
+            return None
+        self._urls.move_to_end(key)
+        return url
+
+    def put(self, account_name, digest, url):
+        self._urls[(account_name, digest)] = (url, time.time() + self.ttl)
+        self._urls.move_to_end((account_name, digest))
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+
+    async def prepare(self, account_name, perplexity_cli, files_dict):
+        """
+        Splits attachments into ones to pass to search() and already-uploaded URLs.
+
+        Stored files (objects with a `digest`) are uploaded once per account and
+        their URL reused afterwards; everything else, and anything whose upload
+        fails, is handed to search() as before.
+
+        Returns:
+            A tuple (files_for_search, attachment_urls).
+        """
+        files_for_search = {}
+        attachment_urls = []
+        for filename, content in (files_dict or {}).items():
+            digest = getattr(content, 'digest', None)
+            if digest is None or not self.ttl or not getattr(perplexity_cli, 'own', False):
+                files_for_search[filename] = await content.load_async() if digest else content
+                continue
+            url = self.get(account_name, digest)
+            if url:
+                self.stats["reused"] += 1
+                attachment_urls.append(url)
+                continue
+            data = await content.load_async()
+            try:
+                url = await upload_file(perplexity_cli, filename, data)
+            except Exception as e:
+                self.stats["upload_errors"] += 1
+                log.warning("Attachment upload failed, passing it to search instead",
+                            extra={"filename": filename, "error": str(e)})
+                files_for_search[filename] = data
+                continue
+            self.stats["uploaded"] += 1
+            self.put(account_name, digest, url)
+            attachment_urls.append(url)
+        return files_for_search, attachment_urls
@@ -0,0 +1,125 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+from shared_state import SharedState
+
+log = logging.getLogger(__name__)
+
+# A worker that exits this soon after starting is not respawned straight away.
+MIN_WORKER_LIFETIME = 5.0
+# Exit status of a worker that rejected its configuration (argparse's parser.error()).
+USAGE_ERROR_STATUS = 2
+
+
+def bind_socket(host, port, backlog=2048):
+    """Opens the listening socket all workers accept connections on."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    """
+    Pre-fork process manager for running the gateway on several cores.
+
+    The supervisor binds the listening socket once and forks `workers`
+    processes that all accept on it; the kernel spreads connections over
+    them. Each worker sets itself up after the fork by calling
+    run_worker(index, sock) and returns its exit status. Workers that die
+    are replaced, and what they held in the shared state (in-flight
+    counters, running jobs) is released. SIGTERM and SIGINT are passed on
+    to the workers, which shut down gracefully.
+    """
+
+    def __init__(self, workers, run_worker, shared_path):
+        """
+        Args:
+            workers: Number of worker processes.
+            run_worker: Called in each forked worker with (index, sock); returns an exit status.
+            shared_path: SQLite file of the SharedState the workers use; recreated on start.
+        """
+        self.workers = workers
+        self.run_worker = run_worker
+        self.shared_path = shared_path
+        self._children = {}
+        self._stopping = False
+
+    def _spawn(self, index, sock):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                status = self.run_worker(index, sock) or 0
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                log.exception("Worker crashed", extra={"worker": index})
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        self._children[pid] = (index, time.monotonic())
+        log.info("Worker started", extra={"worker": index, "pid": pid})
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reap(self, shared, pid, status):
+        index, started_at = self._children.pop(pid)
+        code = os.waitstatus_to_exitcode(status)
+        failed_jobs = shared.forget_worker(pid, time.time())
+        multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+        if multiproc_dir:
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid, multiproc_dir)
+        if self._stopping:
+            return index, code, 0
+        log.warning("Worker exited", extra={"worker": index, "pid": pid, "exit_code": code,
+                                            "failed_jobs": failed_jobs})
+        return index, code, time.monotonic() - started_at
+
+    def run(self, sock):
+        """Runs the workers until a shutdown signal; returns the supervisor's exit status."""
+        shared = SharedState.create(self.shared_path)
+        multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+            for name in os.listdir(multiproc_dir):
+                if name.endswith('.db'):
+                    os.remove(os.path.join(multiproc_dir, name))
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._spawn(index, sock)
+        exit_status = 0
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, code, lifetime = self._reap(shared, pid, status)
+            if self._stopping:
+                continue
+            if code == USAGE_ERROR_STATUS:
+                # A configuration error; every replacement would fail the same way.
+                exit_status = code
+                self._stop(None, None)
+                continue
+            if lifetime < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME - lifetime)
+            if not self._stopping:
+                self._spawn(index, sock)
+        shared.close()
+        sock.close()
+        log.info("All workers stopped")
+        return exit_status